@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import itertools
+import tempfile
+from typing import Any, Dict, List, Optional
+
+import httpx
+import uvicorn
+
+# Runs the bot's FastAPI app against local Telegram and 1Shot API stand-ins and drives synthetic users through
+# the whole token deployment conversation, then reports latency percentiles and throughput. Nothing leaves the
+# machine, so it can run anywhere, e.g. before and after a change:
+#
+#   python bench/loadtest.py --users 200 --concurrency 50 --save before.json
+#   python bench/loadtest.py --users 200 --concurrency 50 --baseline before.json
+#
+# Everything runs in one process and one event loop, so the numbers include the stand-ins' own overhead;
+# compare runs made on the same machine with the same options.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "src"))
+
+from standins import Faults, TelegramStandIn, OneShotStandIn
+
+BOT_TOKEN = "123456:bench"
+BUSINESS_ID = "bench-business"
+SEPOLIA_CHAIN_ID = "11155111"
+FIRST_USER_ID = 100000
+
+# the steps of one conversation: the update a user sends and the Bot API method the bot answers with
+CONVERSATION = [
+    ("start", "sendMessage"),
+    ("deploytoken", "editMessageText"),
+    ("name", "sendMessage"),
+    ("ticker", "sendMessage"),
+    ("description", "sendMessage"),
+    ("image", "sendMessage"),
+    ("premint", "sendMessage"),
+    ("callback", "sendPhoto"),
+    ("mytokens", "sendMessage"),
+]
+
+def reserve_socket() -> socket.socket:
+    """Bind a listening socket on a free local port, so the URLs are known before anything starts."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+def socket_url(sock: socket.socket) -> str:
+    host, port = sock.getsockname()
+    return f"http://{host}:{port}"
+
+async def serve(app: Any, sock: socket.socket) -> uvicorn.Server:
+    """Run an ASGI app with uvicorn on the event loop until it's ready to take requests."""
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="on"))
+    task = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        if task.done():
+            task.result()
+            raise RuntimeError("Server exited during startup")
+        await asyncio.sleep(0.01)
+    server.task = task
+    return server
+
+async def shutdown(server: uvicorn.Server) -> None:
+    server.should_exit = True
+    await server.task
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    """The q-th percentile (0-100) of the samples, by nearest rank."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+# Builds the Telegram updates one synthetic user sends, in the shape Telegram posts them to the webhook
+class SyntheticUser:
+    _update_ids = itertools.count(1)
+    _message_ids = itertools.count(1)
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"Bench {user_id}"}
+        self.chat = {"id": user_id, "type": "private", "first_name": f"Bench {user_id}"}
+        self.token_name = f"Bench Token {user_id}"
+
+    def _message(self, **fields: Any) -> Dict[str, Any]:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": self.chat,
+                "from": self.user,
+                **fields,
+            },
+        }
+
+    def update(self, step: str) -> Dict[str, Any]:
+        if step == "start":
+            return self._message(text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+        if step == "deploytoken":
+            return {
+                "update_id": next(self._update_ids),
+                "callback_query": {
+                    "id": str(next(self._update_ids)),
+                    "from": self.user,
+                    "chat_instance": str(self.user_id),
+                    "data": "deploytoken",
+                    "message": {
+                        "message_id": next(self._message_ids),
+                        "date": int(time.time()),
+                        "chat": self.chat,
+                        "text": "1Shot API is the easiest way to build Telegram bots with onchain functionality!",
+                    },
+                },
+            }
+        if step == "name":
+            return self._message(text=self.token_name)
+        if step == "ticker":
+            return self._message(text=f"B{self.user_id}")
+        if step == "description":
+            return self._message(text="A token deployed by the load generator.")
+        if step == "image":
+            file_id = f"bench-photo-{self.user_id}"
+            return self._message(photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}])
+        if step == "premint":
+            return self._message(text="1000")
+        if step == "mytokens":
+            return self._message(text="/mytokens", entities=[{"type": "bot_command", "offset": 0, "length": 9}])
+        raise ValueError(f"Unknown step {step}")
+
+# Collects timings while the load runs
+class Results:
+    def __init__(self):
+        # how long the bot took to answer the webhook POST, and from the POST until the user saw the reply
+        self.ack: List[float] = []
+        self.steps: Dict[str, List[float]] = {step: [] for step, _ in CONVERSATION}
+        self.completed = 0
+        self.failed = 0
+        self.errors: Dict[str, int] = {}
+
+    def error(self, reason: str) -> None:
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+async def run_conversation(
+    client: httpx.AsyncClient,
+    telegram: TelegramStandIn,
+    oneshot: OneShotStandIn,
+    user: SyntheticUser,
+    results: Results,
+    timeout: float,
+) -> None:
+    for step, reply_method in CONVERSATION:
+        if step == "callback":
+            transaction = await oneshot.wait_for_execution(user.token_name, timeout)
+            path, body = "/1shot", oneshot.callback(transaction, "0x" + f"{user.user_id:040x}")
+        else:
+            path, body = "/telegram", json.dumps(user.update(step)).encode()
+
+        started = time.perf_counter()
+        response = await client.post(path, content=body, headers={"Content-Type": "application/json"})
+        results.ack.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} answered {response.status_code}")
+        answered_at = await telegram.wait_for(user.user_id, reply_method, timeout)
+        results.steps[step].append(answered_at - started)
+
+async def run_user(client, telegram, oneshot, user, results, timeout, semaphore) -> None:
+    async with semaphore:
+        try:
+            await run_conversation(client, telegram, oneshot, user, results, timeout)
+            results.completed += 1
+        except (asyncio.TimeoutError, TimeoutError):
+            results.failed += 1
+            results.error("timeout")
+        except Exception as e:
+            results.failed += 1
+            results.error(type(e).__name__ if not isinstance(e, RuntimeError) else str(e))
+        finally:
+            telegram.forget(user.user_id)
+
+def configure_environment(args: argparse.Namespace, telegram_url: str, oneshot_url: str, bot_url: str, data_dir: str) -> None:
+    # the bot reads its settings from the environment when its modules are imported, so this runs before importing main
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_URL": telegram_url,
+        "ONESHOT_API_URL": oneshot_url,
+        "ONESHOT_API_KEY": "bench",
+        "ONESHOT_API_SECRET": "bench",
+        "ONESHOT_BUSINESS_ID": BUSINESS_ID,
+        "TUNNEL_BASE_URL": bot_url,
+        "BOT_DATA_DIR": data_dir,
+        "WORKER_COUNT": "1",
+    })
+    if not args.telegram_limits:
+        # the stand-in doesn't enforce Telegram's flood limits, and the send scheduler would otherwise dominate the numbers
+        os.environ.setdefault("GLOBAL_SEND_RATE", "1000000")
+        os.environ.setdefault("PRIVATE_CHAT_SEND_RATE", "1000000")
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    telegram = TelegramStandIn(Faults(args.telegram_latency, args.telegram_jitter, args.telegram_error_rate))
+    oneshot = OneShotStandIn(BUSINESS_ID, SEPOLIA_CHAIN_ID, Faults(args.oneshot_latency, args.oneshot_jitter, args.oneshot_error_rate))
+    telegram_socket, oneshot_socket, bot_socket = reserve_socket(), reserve_socket(), reserve_socket()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        configure_environment(args, socket_url(telegram_socket), socket_url(oneshot_socket), socket_url(bot_socket), data_dir)
+        import main
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+
+        servers = [await serve(telegram.app, telegram_socket), await serve(oneshot.app, oneshot_socket)]
+        servers.append(await serve(main.app, bot_socket))
+
+        results = Results()
+        users = [SyntheticUser(FIRST_USER_ID + index) for index in range(args.users)]
+        semaphore = asyncio.Semaphore(args.concurrency)
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=socket_url(bot_socket), limits=limits, timeout=args.timeout) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(run_user(client, telegram, oneshot, user, results, args.timeout, semaphore) for user in users))
+            elapsed = time.perf_counter() - started
+
+        for server in reversed(servers):
+            await shutdown(server)
+
+    updates = sum(len(samples) for samples in results.steps.values())
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "elapsed_seconds": elapsed,
+        "completed_conversations": results.completed,
+        "failed_conversations": results.failed,
+        "errors": results.errors,
+        "injected_errors": {"telegram": telegram.faults.injected_errors, "oneshot": oneshot.faults.injected_errors},
+        "updates_per_second": updates / elapsed,
+        "conversations_per_second": results.completed / elapsed,
+        "ack": {"p50": percentile(results.ack, 50), "p99": percentile(results.ack, 99)},
+        "steps": {
+            step: {"count": len(samples), "p50": percentile(samples, 50), "p99": percentile(samples, 99)}
+            for step, samples in results.steps.items()
+        },
+    }
+
+def milliseconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"{report['completed_conversations']}/{report['users']} conversations completed in {report['elapsed_seconds']:.2f}s "
+          f"({report['concurrency']} at a time)")
+    if report["errors"]:
+        print(f"errors: {report['errors']} (injected: {report['injected_errors']})")
+    print(f"throughput: {report['updates_per_second']:.1f} updates/s, {report['conversations_per_second']:.2f} conversations/s")
+    print(f"webhook ack: p50 {milliseconds(report['ack']['p50'])}  p99 {milliseconds(report['ack']['p99'])}")
+    print("update to reply:")
+    for step, stats in report["steps"].items():
+        print(f"  {step:<12} n={stats['count']:<6} p50 {milliseconds(stats['p50']):>9}  p99 {milliseconds(stats['p99']):>9}")
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """List the ways a run is worse than the baseline by more than the tolerance (a fraction)."""
+    regressions = []
+    if report["updates_per_second"] < baseline["updates_per_second"] * (1 - tolerance):
+        regressions.append(f"throughput {report['updates_per_second']:.1f} updates/s, was {baseline['updates_per_second']:.1f}")
+    latencies = [("ack", report["ack"], baseline["ack"])]
+    latencies += [(step, stats, baseline["steps"].get(step, {})) for step, stats in report["steps"].items()]
+    for name, stats, previous in latencies:
+        if stats.get("p99") is not None and previous.get("p99") and stats["p99"] > previous["p99"] * (1 + tolerance):
+            regressions.append(f"{name} p99 {milliseconds(stats['p99'])}, was {milliseconds(previous['p99'])}")
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test the bot against local Telegram and 1Shot API stand-ins.")
+    parser.add_argument("--users", type=int, default=100, help="synthetic users, each deploys one token")
+    parser.add_argument("--concurrency", type=int, default=20, help="users talking to the bot at the same time")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for each reply")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds added to each Telegram send")
+    parser.add_argument("--telegram-jitter", type=float, default=0.0, help="standard deviation of the Telegram latency")
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="fraction of Telegram sends answered with a flood error")
+    parser.add_argument("--oneshot-latency", type=float, default=0.0, help="seconds added to each 1Shot API execution")
+    parser.add_argument("--oneshot-jitter", type=float, default=0.0, help="standard deviation of the 1Shot API latency")
+    parser.add_argument("--oneshot-error-rate", type=float, default=0.0, help="fraction of 1Shot API executions that fail")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the bot's Telegram send rate limits")
+    parser.add_argument("--save", help="write the report as JSON to this file")
+    parser.add_argument("--baseline", help="compare against a report saved with --save, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much worse than the baseline is still fine")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's logs")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+import json
+import time
+import base64
+import random
+import asyncio
+import itertools
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+# Local stand-ins for the Telegram Bot API and 1Shot API, just faithful enough for the bot to run its whole
+# token deployment flow against them. Both record what the bot sent so the load generator can wait for replies.
+
+# latency and errors injected into the calls on the hot path (Telegram sends and 1Shot executions)
+class Faults:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.injected_errors = 0
+
+    async def delay(self) -> None:
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    def should_fail(self) -> bool:
+        if self.error_rate and random.random() < self.error_rate:
+            self.injected_errors += 1
+            return True
+        return False
+
+# methods that put something in front of the user, the ones we inject flood errors into and wait on
+TELEGRAM_SEND_METHODS = {"sendMessage", "editMessageText", "sendPhoto", "answerCallbackQuery"}
+
+# Serves /bot<token>/<method> like api.telegram.org. Failures are flood limits (429 with retry_after),
+# the error a busy bot actually sees most.
+class TelegramStandIn:
+    def __init__(self, faults: Optional[Faults] = None, retry_after: int = 1):
+        self.faults = faults or Faults()
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+        # chat id -> (method, time it was answered) of every successful send to that chat
+        self._sent: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        # what setWebhook was last called with, getWebhookInfo reports it back
+        self.webhook: Dict[str, Any] = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        self.app = FastAPI()
+        self.app.add_api_route("/bot{token}/{method}", self.handle, methods=["GET", "POST"])
+
+    def _message(self, chat_id: int, **fields: Any) -> Dict[str, Any]:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            **fields,
+        }
+
+    async def handle(self, token: str, method: str, request: Request) -> JSONResponse:
+        form = await request.form()
+        self.calls[method] += 1
+        if method in TELEGRAM_SEND_METHODS:
+            await self.faults.delay()
+            if self.faults.should_fail():
+                return JSONResponse(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": f"Too Many Requests: retry after {self.retry_after}",
+                        "parameters": {"retry_after": self.retry_after},
+                    },
+                    status_code=429,
+                )
+
+        chat_id = int(form["chat_id"]) if "chat_id" in form else None
+        if method == "getMe":
+            result: Any = {"id": int(token.split(":")[0]), "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText") and chat_id is not None:
+            result = self._message(chat_id, text=form.get("text", ""))
+        elif method == "setWebhook":
+            allowed_updates = json.loads(form["allowed_updates"]) if "allowed_updates" in form else None
+            self.webhook = {**self.webhook, "url": form.get("url", ""), "allowed_updates": allowed_updates}
+            result = True
+        elif method == "getWebhookInfo":
+            result = self.webhook
+        elif method == "sendPhoto" and chat_id is not None:
+            result = self._message(chat_id, photo=[{"file_id": form["photo"], "file_unique_id": form["photo"], "width": 512, "height": 512}])
+        else:
+            result = True
+
+        if chat_id is not None:
+            self._sent[chat_id].put_nowait((method, time.perf_counter()))
+        return JSONResponse({"ok": True, "result": result})
+
+    async def wait_for(self, chat_id: int, method: str, timeout: float) -> float:
+        """Wait until the bot calls a method for a chat and return when it did, earlier calls are skipped."""
+        async with asyncio.timeout(timeout):
+            while True:
+                sent_method, sent_at = await self._sent[chat_id].get()
+                if sent_method == method:
+                    return sent_at
+
+    def forget(self, chat_id: int) -> None:
+        self._sent.pop(chat_id, None)
+
+# Serves the parts of 1Shot API the bot uses. Executions are kept by the token name they deploy so the load
+# generator can find its own without decoding the memo, and callbacks are signed with a key the stand-in
+# hands out as the contract method's public key. Failures are plain 500s on execute.
+class OneShotStandIn:
+    def __init__(self, business_id: str, chain_id: str, faults: Optional[Faults] = None):
+        self.business_id = business_id
+        self.chain_id = int(chain_id)
+        self.faults = faults or Faults()
+        self.calls: Counter = Counter()
+        self._private_key = Ed25519PrivateKey.generate()
+        self.public_key = base64.b64encode(
+            self._private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        ).decode()
+        self._ids = itertools.count(1)
+        now = int(time.time())
+        self.wallet = {
+            "id": "bench-wallet",
+            "accountAddress": "0x" + "11" * 20,
+            "businessId": business_id,
+            "chainId": self.chain_id,
+            "name": "Bench Escrow Wallet",
+            "isAdmin": True,
+            "accountBalanceDetails": {
+                "type": 0,
+                "ticker": "ETH",
+                "chainId": self.chain_id,
+                "tokenAddress": "0x" + "00" * 20,
+                "accountAddress": "0x" + "11" * 20,
+                "balance": "10",
+                "decimals": 18,
+            },
+            "updated": now,
+            "created": now,
+        }
+        self.contract_methods: List[Dict[str, Any]] = []
+        self.transactions: List[Dict[str, Any]] = []
+        # token name -> the transaction that deploys it
+        self.executions: Dict[str, asyncio.Future] = defaultdict(lambda: asyncio.get_running_loop().create_future())
+
+        self.app = FastAPI()
+        self.app.add_api_route("/token", self.token, methods=["POST"])
+        self.app.add_api_route("/business/{business_id}/wallets", self.list_wallets, methods=["GET"])
+        self.app.add_api_route("/business/{business_id}/methods", self.list_contract_methods, methods=["GET"])
+        self.app.add_api_route("/business/{business_id}/methods", self.create_contract_method, methods=["POST"])
+        self.app.add_api_route("/methods/{contract_method_id}", self.get_contract_method, methods=["GET"])
+        self.app.add_api_route("/methods/{contract_method_id}/execute", self.execute, methods=["POST"])
+        self.app.add_api_route("/business/{business_id}/transactions/transactions", self.list_transactions, methods=["GET"])
+        self.app.add_api_route("/transactions/{transaction_id}", self.get_transaction, methods=["GET"])
+
+    @staticmethod
+    def _page(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {"response": items, "page": 1, "pageSize": 25, "totalResults": len(items)}
+
+    async def token(self) -> Dict[str, Any]:
+        self.calls["token"] += 1
+        return {"access_token": "bench", "token_type": "Bearer", "expires_in": 3600, "scope": ""}
+
+    async def list_wallets(self, business_id: str) -> Dict[str, Any]:
+        self.calls["wallets.list"] += 1
+        return self._page([self.wallet])
+
+    async def list_contract_methods(self, business_id: str, name: Optional[str] = None) -> Dict[str, Any]:
+        self.calls["contract_methods.list"] += 1
+        return self._page([cm for cm in self.contract_methods if name is None or cm["name"] == name])
+
+    async def create_contract_method(self, business_id: str, request: Request) -> Dict[str, Any]:
+        self.calls["contract_methods.create"] += 1
+        params = await request.json()
+        now = int(time.time())
+        contract_method = {
+            "id": f"bench-method-{next(self._ids)}",
+            "businessId": business_id,
+            "chainId": self.chain_id,
+            "contractAddress": params["contractAddress"],
+            "walletId": params["walletId"],
+            "name": params["name"],
+            "description": params.get("description", ""),
+            "functionName": params["functionName"],
+            "stateMutability": params["stateMutability"],
+            "inputs": params.get("inputs", []),
+            "outputs": params.get("outputs", []),
+            "callbackUrl": params.get("callbackUrl"),
+            "publicKey": self.public_key,
+            "updated": now,
+            "created": now,
+            "deleted": False,
+        }
+        self.contract_methods.append(contract_method)
+        return contract_method
+
+    async def get_contract_method(self, contract_method_id: str) -> JSONResponse:
+        self.calls["contract_methods.get"] += 1
+        for contract_method in self.contract_methods:
+            if contract_method["id"] == contract_method_id:
+                return JSONResponse(contract_method)
+        return JSONResponse({"error": "not found"}, status_code=404)
+
+    async def execute(self, contract_method_id: str, request: Request) -> JSONResponse:
+        self.calls["contract_methods.execute"] += 1
+        await self.faults.delay()
+        if self.faults.should_fail():
+            return JSONResponse({"error": "injected failure"}, status_code=500)
+        body = await request.json()
+        now = int(time.time())
+        transaction = {
+            "id": f"bench-tx-{next(self._ids)}",
+            "contractMethodId": contract_method_id,
+            "status": "Submitted",
+            "name": "deployToken",
+            "functionName": "deployToken",
+            "chainId": self.chain_id,
+            "memo": body.get("memo"),
+            "updated": now,
+            "created": now,
+            "deleted": False,
+        }
+        self.transactions.append(transaction)
+        # deployments are looked up by token name, other executions (airdrop transfers) aren't waited on
+        if "name" in body["params"]:
+            execution = self.executions[body["params"]["name"]]
+            if not execution.done():
+                execution.set_result(transaction)
+        return JSONResponse(transaction)
+
+    async def list_transactions(self, business_id: str, contractMethodId: Optional[str] = None) -> Dict[str, Any]:
+        self.calls["transactions.list"] += 1
+        return self._page([tx for tx in reversed(self.transactions) if contractMethodId in (None, tx["contractMethodId"])][:50])
+
+    async def get_transaction(self, transaction_id: str) -> JSONResponse:
+        self.calls["transactions.get"] += 1
+        for transaction in self.transactions:
+            if transaction["id"] == transaction_id:
+                return JSONResponse(transaction)
+        return JSONResponse({"error": "not found"}, status_code=404)
+
+    async def wait_for_execution(self, token_name: str, timeout: float) -> Dict[str, Any]:
+        """Wait for the bot to execute the deployment of a token and return the transaction."""
+        return await asyncio.wait_for(asyncio.shield(self.executions[token_name]), timeout)
+
+    def callback(self, transaction: Dict[str, Any], token_address: str) -> bytes:
+        """Build the signed TransactionExecutionSuccess webhook body 1Shot API would send for a transaction."""
+        payload = {
+            "eventName": "TransactionExecutionSuccess",
+            "data": {
+                "businessId": self.business_id,
+                "chain": self.chain_id,
+                "logs": [
+                    {
+                        "args": [token_address],
+                        "fragment": {
+                            "anonymous": False,
+                            "inputs": [{"baseType": "address", "components": None, "indexed": True, "name": "token", "type": "address"}],
+                            "name": "TokenCreated",
+                            "type": "event",
+                        },
+                        "name": "TokenCreated",
+                        "signature": "TokenCreated(address)",
+                        "topic": "0x" + "ab" * 32,
+                    }
+                ],
+                "transactionExecutionId": transaction["id"],
+                "transactionExecutionMemo": transaction["memo"],
+                "transactionId": transaction["contractMethodId"],
+            },
+            "timestamp": int(time.time()),
+            "apiVersion": 0,
+        }
+        # the same canonical form verify_webhook checks against
+        message = json.dumps(payload, separators=(",", ":"), sort_keys=True).encode()
+        payload["signature"] = base64.b64encode(self._private_key.sign(message)).decode()
+        return json.dumps(payload).encode()
@@ -0,0 +1,178 @@
+import os
+import time
+import asyncio
+import logging
+from enum import Enum
+from typing import Dict, Optional
+
+from telegram import Chat, Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from sendscheduler import SendPriority
+
+logger = logging.getLogger(__name__)
+
+# what a user can do before we start turning them away: a rate (per second) and a burst on top of it
+# messages and button presses are every update a user sends us, transactions spend escrow wallet gas (token deployments, airdrops)
+ADMISSION_MESSAGE_RATE = float(os.getenv("ADMISSION_MESSAGE_RATE", "1"))
+ADMISSION_MESSAGE_BURST = float(os.getenv("ADMISSION_MESSAGE_BURST", "20"))
+ADMISSION_TRANSACTION_RATE = float(os.getenv("ADMISSION_TRANSACTION_RATE", str(10 / 3600)))
+ADMISSION_TRANSACTION_BURST = float(os.getenv("ADMISSION_TRANSACTION_BURST", "3"))
+# a user is told they're being limited at most this often (in seconds), the rest of their updates are dropped quietly
+ADMISSION_NOTICE_INTERVAL = float(os.getenv("ADMISSION_NOTICE_INTERVAL", "10"))
+# how often (in seconds) buckets that have filled up again are forgotten
+ADMISSION_SWEEP_INTERVAL = float(os.getenv("ADMISSION_SWEEP_INTERVAL", "60"))
+# Telegram user ids allowed to change the limits with /limits, comma separated
+BOT_OPERATOR_IDS = [int(user_id) for user_id in os.getenv("BOT_OPERATOR_IDS", "").split(",") if user_id.strip()]
+
+class ActionClass(Enum):
+    MESSAGE = "message"
+    TRANSACTION = "transaction"
+
+# the limit of an action class, with the reply to a rejected user built once when the limit is set
+class AdmissionLimit:
+    __slots__ = ("rate", "burst", "reply")
+
+    def __init__(self, action: ActionClass, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        if action == ActionClass.TRANSACTION:
+            interval = f"{1 / rate / 60:.0f} minutes" if rate < 1 / 60 else f"{1 / rate:.0f} seconds"
+            self.reply = f"⏳ You can start {burst:g} transactions, and one more every {interval} after that. Please try again later."
+        else:
+            self.reply = "⏳ You're going a bit fast, please wait a moment."
+
+# Token buckets per user and action class, kept as one float per user: the time at which their bucket will be full
+# again (GCRA, the generic cell rate algorithm). Taking a token pushes that time 1/rate into the future, and a user
+# is turned away when it would end up more than burst tokens ahead of now. A bucket that's full again is the same
+# as no bucket, so the sweep forgets those; only users active within the last few minutes take memory.
+# Buckets live in the worker's memory. That holds the limit across workers because every update of a user is handled
+# by the worker that owns them (see sharding.py); limits changed with /limits only apply to the worker that handled it.
+class AdmissionControl:
+    def __init__(self):
+        self.limits: Dict[ActionClass, AdmissionLimit] = {
+            ActionClass.MESSAGE: AdmissionLimit(ActionClass.MESSAGE, ADMISSION_MESSAGE_RATE, ADMISSION_MESSAGE_BURST),
+            ActionClass.TRANSACTION: AdmissionLimit(ActionClass.TRANSACTION, ADMISSION_TRANSACTION_RATE, ADMISSION_TRANSACTION_BURST),
+        }
+        # action class -> user id -> time.monotonic() at which the user's bucket is full again
+        self._full_at: Dict[ActionClass, Dict[int, float]] = {action: {} for action in ActionClass}
+        # action class -> user id -> when we last told them they're over the limit
+        self._notified: Dict[ActionClass, Dict[int, float]] = {action: {} for action in ActionClass}
+        self.rejected: Dict[ActionClass, int] = {action: 0 for action in ActionClass}
+        self._sweep_task: Optional[asyncio.Task] = None
+
+    def buckets(self, action: ActionClass) -> int:
+        return len(self._full_at[action])
+
+    def set_limit(self, action: ActionClass, rate: float, burst: float) -> None:
+        """Change the limit of an action class, users who are already limited stay limited until their bucket fills up."""
+        if rate <= 0 or burst < 1:
+            raise ValueError("The rate must be positive and the burst at least 1")
+        self.limits[action] = AdmissionLimit(action, rate, burst)
+        logger.info("Admission limit for %s set to %s/s with a burst of %s", action.value, rate, burst)
+
+    def admit(self, user_id: int, action: ActionClass) -> bool:
+        """Take a token from the user's bucket, returns False if it's empty."""
+        limit = self.limits[action]
+        full_at = self._full_at[action]
+        now = time.monotonic()
+        # taking a token makes the bucket fill up 1/rate later, it can be at most burst tokens short
+        after = max(full_at.get(user_id, now), now) + 1 / limit.rate
+        if after - now > limit.burst / limit.rate:
+            self.rejected[action] += 1
+            return False
+        full_at[user_id] = after
+        return True
+
+    def refund(self, user_id: int, action: ActionClass) -> None:
+        """Give back a token admit() took, the action it was taken for didn't happen."""
+        full_at = self._full_at[action]
+        if user_id not in full_at:
+            return
+        before = full_at[user_id] - 1 / self.limits[action].rate
+        if before <= time.monotonic():
+            del full_at[user_id]
+        else:
+            full_at[user_id] = before
+
+    def should_notify(self, user_id: int, action: ActionClass) -> bool:
+        """Whether a rejected user should be told, we don't answer a flood with a flood."""
+        notified = self._notified[action]
+        now = time.monotonic()
+        if now - notified.get(user_id, 0.0) < ADMISSION_NOTICE_INTERVAL:
+            return False
+        notified[user_id] = now
+        return True
+
+    def sweep(self) -> int:
+        """Forget the buckets that are full again, returns how many were forgotten."""
+        now = time.monotonic()
+        forgotten = 0
+        for action in ActionClass:
+            full_at = self._full_at[action]
+            full = [user_id for user_id, at in full_at.items() if at <= now]
+            for user_id in full:
+                del full_at[user_id]
+            forgotten += len(full)
+            notified = self._notified[action]
+            for user_id in [user_id for user_id, at in notified.items() if now - at >= ADMISSION_NOTICE_INTERVAL]:
+                del notified[user_id]
+        return forgotten
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(ADMISSION_SWEEP_INTERVAL)
+            self.sweep()
+
+    async def start(self) -> None:
+        self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self) -> None:
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+
+# shared by the admission check in front of the handlers and the handlers that spend gas
+admission_control = AdmissionControl()
+
+async def send_rejection(update: Update, action: ActionClass) -> None:
+    """Tell a user they've hit a limit, unless we told them a moment ago."""
+    if not admission_control.should_notify(update.effective_user.id, action):
+        return
+    reply = admission_control.limits[action].reply
+    if update.callback_query:
+        # answering a button press is cheap and only the user sees it
+        await update.callback_query.answer(reply, show_alert=action == ActionClass.TRANSACTION)
+    elif update.message and update.effective_chat.type == Chat.PRIVATE:
+        await update.message.reply_text(reply, rate_limit_args={"priority": SendPriority.NOTIFICATION})
+
+# Runs before every other handler (group -1): updates from a user who is over their message limit stop here, so
+# they never reach a conversation or 1Shot API
+async def check_admission(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Drop updates from users who are sending them faster than their limit."""
+    # membership changes and the like aren't something a user can flood us with
+    if update.effective_user is None or not (update.message or update.callback_query):
+        return
+    if admission_control.admit(update.effective_user.id, ActionClass.MESSAGE):
+        return
+    await send_rejection(update, ActionClass.MESSAGE)
+    raise ApplicationHandlerStop
+
+async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the admission limits, or change one with /limits <message|transaction> <rate per second> <burst>."""
+    if len(context.args) == 3:
+        try:
+            admission_control.set_limit(ActionClass(context.args[0]), float(context.args[1]), float(context.args[2]))
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+    elif context.args:
+        await update.message.reply_text("Usage: /limits [message|transaction] [rate per second] [burst]")
+        return
+
+    lines = [
+        f"{action.value}: {limit.rate:g}/s, burst {limit.burst:g}, "
+        f"{admission_control.buckets(action)} active users, {admission_control.rejected[action]} rejected"
+        for action, limit in admission_control.limits.items()
+    ]
+    await update.message.reply_text("\n".join(lines))
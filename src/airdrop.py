@@ -0,0 +1,586 @@
+import os
+import re
+import time
+import uuid
+import asyncio
+import logging
+from collections import deque
+from itertools import islice
+from typing import AsyncIterator, Deque, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+from telegram import (
+    Bot,
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup
+)
+from telegram.error import TelegramError
+from telegram.ext import (
+    Application,
+    ContextTypes,
+    ConversationHandler,
+    CommandHandler,
+    MessageHandler,
+    filters,
+    CallbackQueryHandler
+)
+
+from helpers import (
+    canceler,
+    convert_to_wei,
+    data_path,
+    get_token_transfer_endpoint_creation_payload,
+    is_nonnegative_integer,
+    is_valid_ethereum_address,
+)
+from persistence import connect_sqlite
+from metrics import instrument_handler
+from objects import ConversationState, TransactionMemo, TxType
+from dispatcher import webhook_dispatcher, LogIndex
+from registry import resource_registry
+from sendscheduler import SendPriority
+from submitter import transaction_submitter, SUBMITTED
+from admission import admission_control, send_rejection, ActionClass
+from tokenregistry import token_registry, TokenRecord
+from transport import InstrumentedTransport, TransportSettings
+
+from oneshot import (
+    oneshot_client,
+    BUSINESS_ID
+)
+
+from uxly_1shot_client import WebhookPayload
+
+logger = logging.getLogger(__name__)
+
+# uploads are refused above this size, the Bot API doesn't let bots download more than 20MB anyway
+AIRDROP_MAX_FILE_BYTES = int(os.getenv("AIRDROP_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+# rows are read and validated this many at a time, and handed to the submitter in chunks of this size
+AIRDROP_BATCH_SIZE = int(os.getenv("AIRDROP_BATCH_SIZE", "1000"))
+AIRDROP_CHUNK_SIZE = int(os.getenv("AIRDROP_CHUNK_SIZE", "100"))
+# how many chunks may wait for 1Shot API at once, this bounds how much of a list is in memory at any time
+AIRDROP_CHUNKS_IN_FLIGHT = int(os.getenv("AIRDROP_CHUNKS_IN_FLIGHT", "4"))
+# the progress message is edited at most this often (in seconds)
+AIRDROP_PROGRESS_INTERVAL = float(os.getenv("AIRDROP_PROGRESS_INTERVAL", "3"))
+# uploaded lists are spooled here while they are validated and sent
+AIRDROP_DIR = os.getenv("AIRDROP_DIR", data_path("airdrops"))
+# the airdrops being sent are remembered here, so they carry on after a restart
+AIRDROP_STATE_PATH = os.getenv("AIRDROP_STATE_PATH", data_path("airdrops.sqlite3"))
+
+# where 1Shot API sends the callbacks of the transfer contract methods we create
+URL = os.getenv("TUNNEL_BASE_URL")
+
+# one row per line: an address and an amount of whole tokens, separated by a comma, semicolon or whitespace
+ROW_SEPARATOR = re.compile(r"[,;\s]+")
+# how many invalid rows we tell the user about
+MAX_REPORTED_ERRORS = 5
+
+def parse_row(line: str) -> Tuple[Optional[Tuple[str, str]], Optional[str]]:
+    """Parse one line of an address list into (address, amount in wei), or explain what's wrong with it."""
+    fields = [field for field in ROW_SEPARATOR.split(line.strip().lstrip("\ufeff")) if field]
+    if not fields:
+        return None, None
+    if len(fields) != 2:
+        return None, "expected an address and an amount"
+    address, amount = fields
+    if not is_valid_ethereum_address(address):
+        return None, f"{address[:42]} is not a valid address"
+    if not is_nonnegative_integer(amount) or int(amount) == 0:
+        return None, f"{amount[:20]} is not a positive whole number"
+    return (address, convert_to_wei(amount)), None
+
+# The result of validating a batch of rows; rows are (line number, address, amount in wei)
+class Batch:
+    __slots__ = ("rows", "invalid", "errors")
+
+    def __init__(self):
+        self.rows: List[Tuple[int, str, str]] = []
+        self.invalid = 0
+        self.errors: List[str] = []
+
+def validate_batch(lines: List[Tuple[int, str]]) -> Batch:
+    batch = Batch()
+    for number, line in lines:
+        row, error = parse_row(line)
+        if row is not None:
+            batch.rows.append((number, *row))
+        elif error is not None:
+            # a header line isn't an error
+            if number == 1 and "address" in line.lower():
+                continue
+            batch.invalid += 1
+            batch.errors.append(f"line {number}: {error}")
+    return batch
+
+async def read_batches(path: str, batch_size: int = AIRDROP_BATCH_SIZE) -> AsyncIterator[Batch]:
+    """Validate an address list a batch at a time, only one batch of lines is in memory at once."""
+    with open(path, encoding="utf-8", errors="replace", newline="") as f:
+        numbered: Iterator[Tuple[int, str]] = enumerate(f, start=1)
+
+        def read() -> Optional[Batch]:
+            lines = list(islice(numbered, batch_size))
+            return validate_batch(lines) if lines else None
+
+        while True:
+            # reading and validating happens off the event loop, a big list takes a while
+            batch = await asyncio.to_thread(read)
+            if batch is None:
+                return
+            yield batch
+
+# file downloads are streamed to disk instead of being read into memory like python-telegram-bot does
+_download_settings = TransportSettings("telegram")
+download_client = httpx.AsyncClient(transport=InstrumentedTransport(_download_settings), timeout=_download_settings.timeout)
+
+async def download_to_spool(bot: Bot, file_id: str) -> str:
+    """Stream an uploaded file into the spool directory and return its path."""
+    telegram_file = await bot.get_file(file_id)
+    os.makedirs(AIRDROP_DIR, exist_ok=True)
+    path = os.path.join(AIRDROP_DIR, f"{uuid.uuid4().hex}.txt")
+    if not telegram_file.file_path.startswith(("http://", "https://")):
+        # a local Bot API server gives us a path on disk
+        await asyncio.to_thread(lambda: os.link(telegram_file.file_path, path))
+        return path
+    async with download_client.stream("GET", telegram_file.file_path) as response:
+        response.raise_for_status()
+        with open(path, "wb") as f:
+            async for chunk in response.aiter_bytes():
+                f.write(chunk)
+    return path
+
+def transfer_method_name(token_address: str) -> str:
+    return f"Transfer {token_address.lower()}"
+
+async def get_transfer_method(chain_id: str, token_address: str):
+    """The contract method that transfers a token from the escrow wallet, created the first time it's needed."""
+    name = transfer_method_name(token_address)
+    contract_method = resource_registry.contract_method(chain_id, name)
+    if contract_method is None:
+        contract_method = await resource_registry.load_contract_method(chain_id, name)
+    if contract_method is None:
+        wallet = resource_registry.escrow_wallet(chain_id) or (await resource_registry.load_wallets(chain_id))[0]
+        contract_method = await oneshot_client.contract_methods.create(
+            business_id=BUSINESS_ID,
+            params=get_token_transfer_endpoint_creation_payload(
+                chain_id=chain_id,
+                contract_address=token_address,
+                escrow_wallet_id=wallet.id,
+                callback=f"{URL}/1shot",
+                name=name,
+            )
+        )
+        resource_registry.set_contract_method(contract_method)
+    return contract_method
+
+# A chunk of transfers handed to the submitter: the line after its last row, and what happened to its transfers
+class Chunk:
+    __slots__ = ("end_line", "submitted", "failed", "done")
+
+    def __init__(self, end_line: int):
+        self.end_line = end_line
+        self.submitted = 0
+        self.failed = 0
+        self.done = False
+
+# One airdrop being sent. Rows are read from the spooled file a batch at a time and handed to the submitter in
+# chunks; a new chunk is only read once fewer than AIRDROP_CHUNKS_IN_FLIGHT chunks are waiting for 1Shot API,
+# so memory stays flat however long the list is. Progress goes to a single message, edited at most every
+# AIRDROP_PROGRESS_INTERVAL seconds.
+# Each transfer's submission key is made from the airdrop id and its line number, and the airdrop store remembers
+# the line up to which every chunk is done. After a restart the airdrop carries on from that line; the chunks after
+# it are handed to the submitter again, which skips the transfers it already has, so no one is paid twice.
+class Airdrop:
+    def __init__(self, bot: Bot, user_id: int, chat_id: int, message_id: int, token: TokenRecord, path: str, total: int,
+                 id: Optional[str] = None, next_line: int = 1, submitted: int = 0, failed: int = 0):
+        self.id = id or uuid.uuid4().hex[:22]
+        self.bot = bot
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.token = token
+        self.path = path
+        self.total = total
+        # every row before next_line is done, and these are the counts up to it
+        self.next_line = next_line
+        self.settled_submitted = submitted
+        self.settled_failed = failed
+        self.queued = submitted + failed
+        self.submitted = submitted
+        self.failed = failed
+        self.invalid = 0
+        self._last_text: Optional[str] = None
+        self._last_edit = 0.0
+        self._slots = asyncio.Semaphore(AIRDROP_CHUNKS_IN_FLIGHT)
+        # the chunks handed to the submitter that aren't part of the done rows yet, oldest first
+        self._chunks: Deque[Chunk] = deque()
+        self.task: Optional[asyncio.Task] = None
+
+    def _key(self, line: int) -> str:
+        # as long as a random key, so it's never found inside another one (see TransactionSubmitter._find_existing)
+        return f"{self.id}{line:010d}"
+
+    def _progress_text(self, finished: bool) -> str:
+        done = self.submitted + self.failed
+        header = "✅ Airdrop finished" if finished else f"🪂 Airdropping {self.token.ticker}"
+        text = f"{header}\n\nSent: {self.submitted} of {self.total}"
+        if self.failed:
+            text += f"\nFailed: {self.failed}"
+        if self.invalid:
+            text += f"\nSkipped (invalid rows): {self.invalid}"
+        if not finished and self.queued > done:
+            text += f"\nWaiting for 1Shot API: {self.queued - done}"
+        return text
+
+    async def report(self, finished: bool = False) -> None:
+        """Edit the progress message, unless it was edited less than AIRDROP_PROGRESS_INTERVAL seconds ago."""
+        now = time.monotonic()
+        if not finished and now - self._last_edit < AIRDROP_PROGRESS_INTERVAL:
+            return
+        text = self._progress_text(finished)
+        # Telegram refuses edits that don't change anything
+        if text == self._last_text:
+            return
+        self._last_edit = now
+        self._last_text = text
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                text=text,
+                rate_limit_args={"priority": SendPriority.NOTIFICATION},
+            )
+        except TelegramError as e:
+            logger.warning("Could not update the progress of an airdrop in chat %s: %s", self.chat_id, e)
+
+    async def _settle(self) -> None:
+        # chunks finish in any order, the done rows only reach as far as the first chunk that isn't done
+        settled = False
+        while self._chunks and self._chunks[0].done:
+            chunk = self._chunks.popleft()
+            self.next_line = chunk.end_line
+            self.settled_submitted += chunk.submitted
+            self.settled_failed += chunk.failed
+            settled = True
+        if settled:
+            try:
+                await airdrop_store.save(self)
+            except Exception as e:
+                # the next chunk tries again, a restart before that sends a few more chunks to the submitter again
+                logger.warning("Could not save the progress of airdrop %s: %s", self.id, e)
+
+    async def _await_chunk(self, chunk: Chunk, keys: List[str]) -> None:
+        try:
+            outcomes = await asyncio.gather(*(transaction_submitter.outcome(key) for key in keys))
+            for outcome in outcomes:
+                if outcome == SUBMITTED:
+                    chunk.submitted += 1
+                else:
+                    chunk.failed += 1
+            self.submitted += chunk.submitted
+            self.failed += chunk.failed
+            chunk.done = True
+            await self._settle()
+            await self.report()
+        finally:
+            self._slots.release()
+
+    async def _submit_chunk(self, rows: List[Tuple[int, str, str]], contract_method_name: str, tasks: List[asyncio.Task]) -> None:
+        await self._slots.acquire()
+        memo = TransactionMemo(tx_type=TxType.TOKENS_TRANSFERRED, associated_user_id=self.user_id)
+        # no chat id, a failed transfer is counted here instead of being reported to the user one by one
+        try:
+            keys = await transaction_submitter.submit_many(
+                chat_id=None,
+                chain_id=self.token.chain_id,
+                contract_method_name=contract_method_name,
+                executions=[({"to": address, "value": amount}, memo.model_copy()) for _, address, amount in rows],
+                keys=[self._key(line) for line, _, _ in rows],
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        self.queued += len(keys)
+        chunk = Chunk(rows[-1][0] + 1)
+        self._chunks.append(chunk)
+        tasks[:] = [task for task in tasks if not task.done()]
+        tasks.append(asyncio.create_task(self._await_chunk(chunk, keys)))
+
+    async def run(self) -> None:
+        tasks: List[asyncio.Task] = []
+        try:
+            contract_method = await get_transfer_method(self.token.chain_id, self.token.address)
+            chunk: List[Tuple[int, str, str]] = []
+            async for batch in read_batches(self.path):
+                self.invalid += batch.invalid
+                for row in batch.rows:
+                    # sent before a restart
+                    if row[0] < self.next_line:
+                        continue
+                    chunk.append(row)
+                    if len(chunk) >= AIRDROP_CHUNK_SIZE:
+                        await self._submit_chunk(chunk, contract_method.name, tasks)
+                        chunk = []
+            if chunk:
+                await self._submit_chunk(chunk, contract_method.name, tasks)
+            await asyncio.gather(*tasks)
+            await self.report(finished=True)
+        except asyncio.CancelledError:
+            # we're shutting down, the airdrop carries on after the restart
+            for task in tasks:
+                task.cancel()
+            running.pop(self.user_id, None)
+            raise
+        except Exception as e:
+            logger.error("Airdrop for user %s stopped: %s", self.user_id, e)
+            for task in tasks:
+                task.cancel()
+            await stopped(self.bot, self.chat_id, self.message_id, self._progress_text(finished=False))
+        await finish(self)
+
+async def stopped(bot: Bot, chat_id: int, message_id: int, progress: str) -> None:
+    """Tell the user an airdrop stopped, in its progress message."""
+    try:
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=f"{progress}\n\n❌ The airdrop stopped because of an error.",
+            rate_limit_args={"priority": SendPriority.NOTIFICATION},
+        )
+    except TelegramError:
+        pass
+
+async def finish(airdrop: Airdrop) -> None:
+    """Forget an airdrop that is done (or can't go on), and its list."""
+    running.pop(airdrop.user_id, None)
+    try:
+        await airdrop_store.delete(airdrop.id)
+    except Exception as e:
+        logger.error("Could not forget airdrop %s: %s", airdrop.id, e)
+    try:
+        await asyncio.to_thread(os.remove, airdrop.path)
+    except FileNotFoundError:
+        pass
+
+# The airdrops being sent, with how far they got. All workers share the database, each one only resumes the
+# airdrops it started. Writes are single statements, one per finished chunk.
+class AirdropStore:
+    def __init__(self, path: Optional[str] = AIRDROP_STATE_PATH):
+        self._path = path
+        self._connection = None
+        # the worker we are
+        self._owner = 0
+
+    def _db(self):
+        if self._connection is None:
+            self._connection = connect_sqlite(self._path)
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS airdrops (
+                    id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL,
+                    token_id INTEGER NOT NULL, path TEXT NOT NULL, total INTEGER NOT NULL, next_line INTEGER NOT NULL,
+                    submitted INTEGER NOT NULL, failed INTEGER NOT NULL, owner INTEGER NOT NULL
+                )
+                """
+            )
+        return self._connection
+
+    async def save(self, airdrop: Airdrop) -> None:
+        row = (
+            airdrop.id, airdrop.user_id, airdrop.chat_id, airdrop.message_id, airdrop.token.id, airdrop.path, airdrop.total,
+            airdrop.next_line, airdrop.settled_submitted, airdrop.settled_failed, self._owner,
+        )
+        await asyncio.to_thread(lambda: self._db().execute("INSERT OR REPLACE INTO airdrops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row))
+
+    async def delete(self, airdrop_id: str) -> None:
+        await asyncio.to_thread(lambda: self._db().execute("DELETE FROM airdrops WHERE id = ?", (airdrop_id,)))
+
+    async def load(self, worker_index: int = 0) -> List[tuple]:
+        """The airdrops this worker was sending before a restart."""
+        self._owner = worker_index
+        return await asyncio.to_thread(
+            lambda: self._db().execute(
+                "SELECT id, user_id, chat_id, message_id, token_id, path, total, next_line, submitted, failed FROM airdrops WHERE owner = ?",
+                (worker_index,),
+            ).fetchall()
+        )
+
+airdrop_store = AirdropStore()
+
+# user id -> their airdrop that is being sent, one at a time per user
+running: Dict[int, Airdrop] = {}
+
+async def resume_airdrops(application: Application, worker_index: int = 0) -> None:
+    """Carry on with the airdrops this worker was sending before a restart, the transaction submitter must be started."""
+    for id, user_id, chat_id, message_id, token_id, path, total, next_line, submitted, failed in await airdrop_store.load(worker_index):
+        token = token_registry.get(token_id)
+        airdrop = Airdrop(application.bot, user_id, chat_id, message_id, token, path, total, id, next_line, submitted, failed)
+        if token is None or not os.path.exists(path):
+            logger.error("Can't resume airdrop %s for user %s, its token or list is gone", id, user_id)
+            await stopped(application.bot, chat_id, message_id, f"Sent: {submitted} of {total}")
+            await finish(airdrop)
+            continue
+        logger.info("Resuming airdrop %s for user %s from line %s", id, user_id, next_line)
+        running[user_id] = airdrop
+        airdrop.task = application.create_task(airdrop.run(), name=f"airdrop-{user_id}")
+
+async def stop_airdrops() -> None:
+    """Stop sending on shutdown, before the transaction submitter stops; the airdrops are resumed on the next start."""
+    tasks = [airdrop.task for airdrop in running.values() if airdrop.task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+@instrument_handler
+async def airdrop_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Ask the user for the list of addresses to airdrop a token to."""
+    token = token_registry.get(int(update.callback_query.data.split(":")[1]))
+    if token is None or token.owner_id != update.effective_user.id or not token.address:
+        await update.callback_query.answer("This token can't be airdropped yet.")
+        return ConversationState.MANAGE_TOKEN
+    if update.effective_user.id in running:
+        await update.callback_query.answer("Your previous airdrop is still being sent.")
+        return ConversationState.MANAGE_TOKEN
+
+    context.user_data.airdrop_token = token.id
+    await update.callback_query.answer()
+    await update.callback_query.edit_message_text(
+        text=(
+            f"Send me a CSV or text file with one recipient per line: an address and the number of {token.ticker} to send, e.g.\n\n"
+            "0x1234...abcd,100\n\n"
+            "or /cancel to stop."
+        )
+    )
+    return ConversationState.SENDER_LIST
+
+@instrument_handler
+async def receive_sender_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Download and validate the uploaded list, then ask the user to confirm the airdrop."""
+    document = update.message.document
+    if document.file_size and document.file_size > AIRDROP_MAX_FILE_BYTES:
+        await update.message.reply_text(f"❌ That file is too big, the limit is {AIRDROP_MAX_FILE_BYTES // (1024 * 1024)}MB.")
+        return ConversationState.SENDER_LIST
+
+    message = await update.message.reply_text("Checking your list...")
+    try:
+        path = await download_to_spool(context.bot, document.file_id)
+    except (TelegramError, httpx.HTTPError, OSError) as e:
+        logger.error("Could not download an address list: %s", e)
+        await message.edit_text("❌ I couldn't download that file, please try again.")
+        return ConversationState.SENDER_LIST
+    valid = invalid = 0
+    errors: List[str] = []
+    async for batch in read_batches(path):
+        valid += len(batch.rows)
+        invalid += batch.invalid
+        errors.extend(batch.errors[:MAX_REPORTED_ERRORS - len(errors)])
+
+    if valid == 0:
+        await asyncio.to_thread(os.remove, path)
+        await message.edit_text("❌ I couldn't find any valid rows in that file, please send another one.\n\n" + "\n".join(errors))
+        return ConversationState.SENDER_LIST
+
+    previous = context.user_data.airdrop_path
+    if previous and os.path.exists(previous):
+        await asyncio.to_thread(os.remove, previous)
+    context.user_data.airdrop_path = path
+    context.user_data.airdrop_total = valid
+
+    text = f"Found {valid} recipients."
+    if invalid:
+        text += f"\n{invalid} rows are invalid and will be skipped:\n" + "\n".join(errors)
+        if invalid > len(errors):
+            text += "\n..."
+    buttons = [[
+        InlineKeyboardButton("🪂 Send", callback_data="airdrop_confirm"),
+        InlineKeyboardButton("Cancel", callback_data="airdrop_cancel"),
+    ]]
+    await message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+    return ConversationState.SENDER_LIST
+
+@instrument_handler
+async def airdrop_not_a_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Remind the user we're waiting for a file."""
+    await update.message.reply_text("Please send the list as a file, or /cancel.")
+    return ConversationState.SENDER_LIST
+
+@instrument_handler
+async def airdrop_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start sending the airdrop in the background."""
+    session = context.user_data
+    path, token, total = session.airdrop_path, token_registry.get(session.airdrop_token or 0), session.airdrop_total
+    if path is None or token is None or not os.path.exists(path):
+        session.clear_airdrop()
+        await update.callback_query.answer("Please send the list again.")
+        return ConversationState.SENDER_LIST
+
+    # the transfers spend escrow wallet gas, an airdrop counts as one transaction against the user's limit
+    # the list is kept, so the user can press Send again once they have room
+    if not admission_control.admit(update.effective_user.id, ActionClass.TRANSACTION):
+        await send_rejection(update, ActionClass.TRANSACTION)
+        return ConversationState.SENDER_LIST
+    session.clear_airdrop()
+
+    await update.callback_query.answer()
+    # this message becomes the progress message
+    await update.callback_query.edit_message_text(f"🪂 Airdropping {token.ticker}\n\nSent: 0 of {total}")
+    airdrop = Airdrop(
+        bot=context.bot,
+        user_id=update.effective_user.id,
+        chat_id=update.effective_chat.id,
+        message_id=update.callback_query.message.message_id,
+        token=token,
+        path=path,
+        total=total,
+    )
+    running[airdrop.user_id] = airdrop
+    # remembered before it starts, so a restart from here on resumes it
+    await airdrop_store.save(airdrop)
+    airdrop.task = context.application.create_task(airdrop.run(), update=update, name=f"airdrop-{airdrop.user_id}")
+    return ConversationState.MANAGE_TOKEN
+
+@instrument_handler
+async def airdrop_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Drop the uploaded list."""
+    path = context.user_data.airdrop_path
+    context.user_data.clear_airdrop()
+    if path and os.path.exists(path):
+        await asyncio.to_thread(os.remove, path)
+    await update.callback_query.answer()
+    await update.callback_query.edit_message_text(
+        "Airdrop cancelled.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Back to my tokens", callback_data="mytokens")]]),
+    )
+    return ConversationState.MANAGE_TOKEN
+
+# the transfers report back one by one, the airdrop already counted them when 1Shot API accepted them
+@webhook_dispatcher.handler("TransactionExecutionSuccess", TxType.TOKENS_TRANSFERRED)
+async def transfer_succeeded(update: WebhookPayload, memo: TransactionMemo, logs: LogIndex, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Nothing to tell the user about a single transfer."""
+
+@webhook_dispatcher.handler("TransactionExecutionFailure", TxType.TOKENS_TRANSFERRED)
+async def transfer_failed(update: WebhookPayload, memo: TransactionMemo, logs: LogIndex, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Log a failed transfer instead of messaging the user once per recipient."""
+    logger.warning("Airdrop transfer %s for user %s failed onchain", update.data.transaction_execution_id, memo.associated_user_id)
+
+def get_airdrop_conversation_handler() -> ConversationHandler:
+    """Create and return the conversation handler for airdropping a token to an uploaded list of addresses."""
+    return ConversationHandler(
+        entry_points=[CallbackQueryHandler(airdrop_start, pattern=r"^airdrop:\d+$")],
+        states={
+            ConversationState.SENDER_LIST: [
+                MessageHandler(filters.Document.ALL, receive_sender_list),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, airdrop_not_a_file),
+                CallbackQueryHandler(airdrop_confirm, pattern="^airdrop_confirm$"),
+                CallbackQueryHandler(airdrop_cancel, pattern="^airdrop_cancel$"),
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", canceler)],
+        map_to_parent={
+            ConversationState.MANAGE_TOKEN: ConversationState.MANAGE_TOKEN,
+            ConversationHandler.END: ConversationHandler.END
+        },
+        name="airdrop",
+        persistent=True,
+    )
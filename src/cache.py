@@ -0,0 +1,65 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+# A small in-process cache for values we would otherwise fetch from an API on every request
+# entries expire after a TTL, the least recently used entry is evicted once the cache is full,
+# and concurrent misses for the same key share a single fetch (single-flight) instead of
+# stampeding the upstream API
+class AsyncTTLCache(Generic[K, V]):
+    def __init__(self, loader: Callable[[K], Awaitable[Optional[V]]], ttl: float, max_size: int):
+        self._loader = loader
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries: "OrderedDict[K, Tuple[V, float]]" = OrderedDict()
+        self._inflight: Dict[K, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, key: K) -> Optional[V]:
+        """Return the cached value for key if it is present and fresh, without fetching."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        """Store a value, evicting the least recently used entry if the cache is full."""
+        self._entries[key] = (value, time.monotonic() + (self._ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: K) -> None:
+        self._entries.pop(key, None)
+
+    async def get(self, key: K, refresh: bool = False) -> Optional[V]:
+        """Return the value for key, calling the loader at most once for concurrent misses."""
+        if not refresh:
+            value = self.peek(key)
+            if value is not None:
+                return value
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield the shared fetch so one cancelled caller doesn't cancel it for everybody else
+        return await asyncio.shield(task)
+
+    async def _load(self, key: K) -> Optional[V]:
+        value = await self._loader(key)
+        if value is not None:
+            self.put(key, value)
+        return value
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from telegram import Bot, Chat
+from telegram.error import TelegramError
+
+from cache import AsyncTTLCache
+from helpers import data_path
+from persistence import connect_sqlite
+
+logger = logging.getLogger(__name__)
+
+# how long (in seconds) a chat's admin list is trusted before we ask Telegram again, and how many we keep in memory
+CHAT_ADMIN_TTL = float(os.getenv("CHAT_ADMIN_TTL", "600"))
+CHAT_ADMIN_CACHE_SIZE = int(os.getenv("CHAT_ADMIN_CACHE_SIZE", "10000"))
+CHAT_REGISTRY_PATH = os.getenv("CHAT_REGISTRY_PATH", data_path("chats.sqlite3"))
+CHAT_REGISTRY_FLUSH_INTERVAL = float(os.getenv("CHAT_REGISTRY_FLUSH_INTERVAL", "5"))
+
+# the chat types where group features make sense
+GROUP_CHAT_TYPES = {Chat.GROUP, Chat.SUPERGROUP, Chat.CHANNEL}
+
+# what we know about a chat the bot has been in
+class ChatRecord:
+    __slots__ = ("chat_id", "type", "title", "is_member", "updated")
+
+    def __init__(self, chat_id: int, type: str, title: Optional[str], is_member: bool, updated: float):
+        self.chat_id = chat_id
+        self.type = type
+        self.title = title
+        self.is_member = is_member
+        self.updated = updated
+
+# Keeps track of the chats the bot is in (maintained by track_chats) and who administers them, so group
+# features can answer "which groups is the bot in" and "is this user an admin here" from memory.
+# Admin lists are fetched from Telegram on demand, cached for CHAT_ADMIN_TTL, and concurrent lookups for
+# the same chat share one fetch. Everything is written behind to SQLite and loaded again on startup.
+class ChatRegistry:
+    def __init__(self, admin_ttl: float = CHAT_ADMIN_TTL, admin_cache_size: int = CHAT_ADMIN_CACHE_SIZE, path: Optional[str] = CHAT_REGISTRY_PATH):
+        self._admin_ttl = admin_ttl
+        self._path = path
+        self._chats: Dict[int, ChatRecord] = {}
+        # the group and channel chats the bot is currently a member of
+        self._groups: Set[int] = set()
+        self._admins: AsyncTTLCache[int, FrozenSet[int]] = AsyncTTLCache(self._fetch_admins, ttl=admin_ttl, max_size=admin_cache_size)
+        self._bot: Optional[Bot] = None
+        self._connection = None
+        # changes waiting to be written to disk
+        self._pending_chats: Dict[int, ChatRecord] = {}
+        self._pending_admins: Dict[int, Optional[Tuple[FrozenSet[int], float]]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def chat(self, chat_id: int) -> Optional[ChatRecord]:
+        return self._chats.get(chat_id)
+
+    def is_member(self, chat_id: int) -> bool:
+        """Whether the bot is currently in a chat."""
+        record = self._chats.get(chat_id)
+        return record is not None and record.is_member
+
+    def groups(self) -> List[int]:
+        """The ids of the groups and channels the bot is in."""
+        return list(self._groups)
+
+    def set_membership(self, chat: Chat, is_member: bool) -> None:
+        """Record that the bot joined or left a chat (or a user blocked or unblocked it)."""
+        record = ChatRecord(chat.id, chat.type, chat.title, is_member, time.time())
+        self._chats[chat.id] = record
+        if is_member and chat.type in GROUP_CHAT_TYPES:
+            self._groups.add(chat.id)
+        else:
+            self._groups.discard(chat.id)
+        if not is_member:
+            self.invalidate_admins(chat.id)
+        self._pending_chats[chat.id] = record
+
+    async def _fetch_admins(self, chat_id: int) -> Optional[FrozenSet[int]]:
+        if self._bot is None:
+            return None
+        try:
+            administrators = await self._bot.get_chat_administrators(chat_id)
+        except TelegramError as e:
+            # e.g. the bot was removed in the meantime, don't cache anything
+            logger.warning("Could not fetch the admins of chat %s: %s", chat_id, e)
+            return None
+        admins = frozenset(member.user.id for member in administrators)
+        self._pending_admins[chat_id] = (admins, time.time())
+        return admins
+
+    async def admins(self, chat_id: int, refresh: bool = False) -> FrozenSet[int]:
+        """The user ids of a chat's administrators, empty if we can't find out."""
+        return await self._admins.get(chat_id, refresh=refresh) or frozenset()
+
+    async def is_admin(self, chat_id: int, user_id: int) -> bool:
+        """Whether a user administers a chat."""
+        return user_id in await self.admins(chat_id)
+
+    def invalidate_admins(self, chat_id: int) -> None:
+        """Forget a chat's admin list, e.g. because someone was promoted, so it's fetched again when needed."""
+        self._admins.invalidate(chat_id)
+        self._pending_admins[chat_id] = None
+
+    def _write(self, chats: Dict[int, ChatRecord], admins: Dict[int, Optional[Tuple[FrozenSet[int], float]]]) -> None:
+        self._connection.execute("BEGIN")
+        try:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO chats (chat_id, type, title, is_member, updated) VALUES (?, ?, ?, ?, ?)",
+                [(r.chat_id, r.type, r.title, int(r.is_member), r.updated) for r in chats.values()],
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO chat_admins (chat_id, admins, fetched) VALUES (?, ?, ?)",
+                [(chat_id, json.dumps(sorted(entry[0])), entry[1]) for chat_id, entry in admins.items() if entry is not None],
+            )
+            self._connection.executemany(
+                "DELETE FROM chat_admins WHERE chat_id = ?",
+                [(chat_id,) for chat_id, entry in admins.items() if entry is None],
+            )
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    async def flush(self) -> None:
+        if self._connection is None or not (self._pending_chats or self._pending_admins):
+            return
+        chats, self._pending_chats = self._pending_chats, {}
+        admins, self._pending_admins = self._pending_admins, {}
+        try:
+            await asyncio.to_thread(self._write, chats, admins)
+        except Exception:
+            # write them with the next flush, changes made since then are newer
+            self._pending_chats = {**chats, **self._pending_chats}
+            self._pending_admins = {**admins, **self._pending_admins}
+            raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(CHAT_REGISTRY_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning("Failed to write the chat registry to disk: %s", e)
+
+    async def start(self, bot: Bot) -> None:
+        """Load the chats and admin lists we knew about before a restart."""
+        self._bot = bot
+        if not self._path:
+            return
+        self._connection = connect_sqlite(self._path)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY, type TEXT NOT NULL, title TEXT, is_member INTEGER NOT NULL, updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chat_admins (chat_id INTEGER PRIMARY KEY, admins TEXT NOT NULL, fetched REAL NOT NULL);
+            """
+        )
+        for chat_id, type, title, is_member, updated in self._connection.execute("SELECT * FROM chats"):
+            self._chats[chat_id] = ChatRecord(chat_id, type, title, bool(is_member), updated)
+            if is_member and type in GROUP_CHAT_TYPES:
+                self._groups.add(chat_id)
+        now = time.time()
+        for chat_id, admins, fetched in self._connection.execute("SELECT * FROM chat_admins WHERE fetched > ?", (now - self._admin_ttl,)):
+            # only for what's left of their TTL
+            self._admins.put(chat_id, frozenset(json.loads(admins)), ttl=self._admin_ttl - (now - fetched))
+        logger.info("Loaded %s chats, the bot is in %s groups and channels", len(self._chats), len(self._groups))
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._connection is not None:
+            await self.flush()
+            self._connection.close()
+            self._connection = None
+
+# track_chats keeps it up to date, group features read from it
+chat_registry = ChatRegistry()
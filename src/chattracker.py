@@ -8,6 +8,9 @@ from telegram import (
 )
 from telegram.ext import ContextTypes
 
+from metrics import instrument_handler
+from chatregistry import chat_registry
+
 
 import logging
 
@@ -38,6 +41,7 @@ def extract_status_change(chat_member_update: ChatMemberUpdated) -> Optional[tup
 
     return was_member, is_member
 
+@instrument_handler
 async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Tracks the chats the bot is in."""
     result = extract_status_change(update.my_chat_member)
@@ -50,6 +54,7 @@ async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     chat = update.effective_chat
     chat_id = chat.id
+    chat_registry.set_membership(chat, is_member)
 
     # Handle chat types differently:
     if chat.type == Chat.PRIVATE:
@@ -63,12 +68,25 @@ async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             logger.info("%s blocked the bot", cause_name)
     elif chat.type in [Chat.GROUP, Chat.SUPERGROUP]:
         if not was_member and is_member:
-            admins = await context.bot.get_chat_administrators(chat_id)
+            # warm the admin cache, group features will ask for it soon
+            await chat_registry.admins(chat_id, refresh=True)
             logger.info("%s added the bot to the group %s - ID: %s", cause_name, chat.title, chat.id)
         elif was_member and not is_member:
             logger.info("%s removed the bot from the group %s", cause_name, chat.title)
     elif not was_member and is_member:
-        admins = await context.bot.get_chat_administrators(chat_id)
+        await chat_registry.admins(chat_id, refresh=True)
         logger.info("%s added the bot to the channel %s", cause_name, chat.title)
     elif was_member and not is_member:
         logger.info("%s removed the bot from the channel %s", cause_name, chat.title)
+
+# the admin and owner statuses, a change to or from one of these changes a chat's admin list
+ADMIN_STATUSES = {ChatMember.ADMINISTRATOR, ChatMember.OWNER}
+
+@instrument_handler
+async def track_chat_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Drops a chat's cached admin list when someone is promoted or demoted."""
+    was_admin = update.chat_member.old_chat_member.status in ADMIN_STATUSES
+    is_admin = update.chat_member.new_chat_member.status in ADMIN_STATUSES
+    # changes to an admin's rights also arrive here, they don't change who the admins are
+    if was_admin != is_admin:
+        chat_registry.invalidate_admins(update.effective_chat.id)
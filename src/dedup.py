@@ -0,0 +1,152 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from telegram import Update
+
+from uxly_1shot_client import WebhookPayload
+
+from helpers import data_path
+from persistence import connect_sqlite
+
+logger = logging.getLogger(__name__)
+
+# how long (in seconds) we remember an update, how many we remember at most, and where they are spilled to disk
+# set DEDUP_PATH to an empty string to keep the index in memory only
+DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", "3600"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
+DEDUP_PATH = os.getenv("DEDUP_PATH", data_path("dedup.sqlite3"))
+DEDUP_FLUSH_INTERVAL = float(os.getenv("DEDUP_FLUSH_INTERVAL", "2"))
+
+# results the reconciler looked up aren't signed, the callbacks 1Shot API sends always are (see reconciler.py)
+def is_reconciled(update: object) -> bool:
+    return isinstance(update, WebhookPayload) and not update.signature
+
+def callback_dedup_key(update: WebhookPayload) -> str:
+    return f"1shot:{update.event_name}:{update.data.transaction_execution_id}"
+
+def reconciled_dedup_key(update: WebhookPayload) -> str:
+    return f"{callback_dedup_key(update)}:reconciled"
+
+# Telegram resends an update (same update_id) when we are slow to answer, and 1Shot API may resend a callback
+# for the same transaction execution; this is the key we recognize them by. A reconciled result has no logs, so it
+# gets a key of its own: the real callback that may still follow isn't dropped as its duplicate, and the handlers
+# that need its logs get to use it (see WebhookDispatcher)
+def update_dedup_key(update: object) -> Optional[str]:
+    """Return the idempotency key of an update, None if it can't be deduplicated."""
+    if isinstance(update, Update):
+        return f"tg:{update.update_id}"
+    if isinstance(update, WebhookPayload):
+        return reconciled_dedup_key(update) if is_reconciled(update) else callback_dedup_key(update)
+    return None
+
+# A time-windowed set of update keys we've already accepted. Memory is bounded by DEDUP_MAX_ENTRIES;
+# new keys are also written to a small SQLite table in the background so the window survives restarts.
+class DedupIndex:
+    def __init__(self, window: float = DEDUP_WINDOW, max_entries: int = DEDUP_MAX_ENTRIES, path: Optional[str] = DEDUP_PATH):
+        self._window = window
+        self._max_entries = max_entries
+        self._path = path
+        # key -> time first seen, oldest first
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._pending: List[Tuple[str, float]] = []
+        self._connection = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self.duplicates = 0
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def _expire(self, now: float) -> None:
+        cutoff = now - self._window
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if seen_at >= cutoff and len(self._seen) <= self._max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def seen_before(self, key: str) -> bool:
+        """Record a key and tell whether it was already recorded within the window."""
+        now = time.time()
+        self._expire(now)
+        if key in self._seen:
+            self.duplicates += 1
+            return True
+        self._seen[key] = now
+        if len(self._seen) > self._max_entries:
+            self._seen.popitem(last=False)
+        if self._connection is not None:
+            self._pending.append((key, now))
+        return False
+
+    def contains(self, key: str) -> bool:
+        """Tell whether a key was recorded within the window, without recording it."""
+        now = time.time()
+        self._expire(now)
+        return key in self._seen
+
+    def forget(self, key: str) -> None:
+        """Forget a key we didn't end up accepting, so a redelivery isn't taken for a duplicate."""
+        self._seen.pop(key, None)
+        # only happens when something went wrong, so the linear scan doesn't matter
+        self._pending = [entry for entry in self._pending if entry[0] != key]
+
+    def _write(self, entries: List[Tuple[str, float]], cutoff: float) -> None:
+        self._connection.execute("BEGIN")
+        try:
+            self._connection.executemany("INSERT OR IGNORE INTO seen (key, seen_at) VALUES (?, ?)", entries)
+            self._connection.execute("DELETE FROM seen WHERE seen_at < ?", (cutoff,))
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    async def flush(self) -> None:
+        if self._connection is None or not self._pending:
+            return
+        entries, self._pending = self._pending, []
+        try:
+            await asyncio.to_thread(self._write, entries, time.time() - self._window)
+        except Exception:
+            # try them again with the next flush, unless they were forgotten (or expired) meanwhile
+            self._pending[:0] = [entry for entry in entries if entry[0] in self._seen]
+            raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(DEDUP_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning("Failed to spill dedup index to disk: %s", e)
+
+    async def start(self) -> None:
+        """Load the keys seen within the window from disk and start spilling new keys in the background."""
+        if not self._path:
+            return
+        self._connection = connect_sqlite(self._path)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS seen_at ON seen (seen_at)")
+        rows = self._connection.execute(
+            "SELECT key, seen_at FROM seen WHERE seen_at >= ? ORDER BY seen_at DESC LIMIT ?",
+            (time.time() - self._window, self._max_entries),
+        ).fetchall()
+        for key, seen_at in reversed(rows):
+            self._seen[key] = seen_at
+        logger.info("Loaded %s recently seen updates", len(rows))
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._connection is not None:
+            await self.flush()
+            self._connection.close()
+            self._connection = None
+
+# shared by both webhook routes
+dedup_index = DedupIndex()
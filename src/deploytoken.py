@@ -1,5 +1,6 @@
 import os
 import logging
+from typing import Optional
 
 from telegram import (
     Update, 
@@ -17,18 +18,25 @@ from telegram.ext import (
 from telegram.constants import ParseMode
 from telegram.helpers import mention_html
 
-logger = logging.getLogger(__name__)
+from uxly_1shot_client import WebhookPayload
 
-from oneshot import (
-    oneshot_client,
-    BUSINESS_ID
-)
+logger = logging.getLogger(__name__)
 
 from helpers import (
     is_nonnegative_integer, 
     canceler, 
-    convert_to_wei
+    convert_to_wei,
+    SEPOLIA_CHAIN_ID,
+    TOKEN_DEPLOYER_NAME
 )
+from registry import resource_registry
+from tokenregistry import token_registry
+from submitter import transaction_submitter
+from admission import admission_control, send_rejection, ActionClass
+from tracing import tracer, new_trace_id
+from sendscheduler import SendPriority
+from dispatcher import webhook_dispatcher, LogIndex
+from metrics import instrument_handler
 from objects import (
     TransactionMemo,
     TxType,
@@ -36,36 +44,43 @@ from objects import (
     ConversationState, 
 )
 
+@instrument_handler
 async def deploy_token_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Ask the user what name they want to give to their token."""
+    # the deployment is traced from here until its callback, if it's sampled (see tracing.py)
+    context.user_data.trace_id = new_trace_id()
 
     await update.callback_query.answer()  # Acknowledge the callback query
     await update.callback_query.edit_message_text(text="What do you want to name your token?")
     return ConversationState.TOKEN_NAMING
 
+@instrument_handler
 async def get_naming(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store token name and ask for the token ticker (symbol)."""
-    context.user_data["name"] = update.message.text
+    context.user_data.name = update.message.text
     await update.message.reply_text("Great! What do you want the token symbol to be (users will see this next to their balance)?")
     return ConversationState.TOKEN_TICKER
 
+@instrument_handler
 async def get_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the token ticker and ask for a description."""
-    context.user_data["ticker"] = update.message.text
+    context.user_data.ticker = update.message.text
     await update.message.reply_text("Please provide a description for your token:")
     return ConversationState.TOKEN_DESCRIPTION
 
+@instrument_handler
 async def get_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the description and ask the user to upload an image."""
-    context.user_data["description"] = update.message.text
+    context.user_data.description = update.message.text
     await update.message.reply_text("Great! Please upload an image for the token (e.g., logo).")
     return ConversationState.TOKEN_IMAGE
 
+@instrument_handler
 async def get_premint(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Store the image and ask for how many tokens to premint."""
     if update.message.photo:
         file_id = update.message.photo[-1].file_id
-        context.user_data["image"] = file_id
+        context.user_data.image = file_id
         await update.message.reply_text(
             "Awesome! How many tokens should be minted to the admin address (must be an integer)?"
         )
@@ -74,8 +89,9 @@ async def get_premint(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         await update.message.reply_text("❌ Please upload a valid image.")
         return ConversationState.TOKEN_IMAGE
 
+@instrument_handler
 async def finalize_token_deployment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Store the admin address, make the API call, and end the conversation."""
+    """Store the premint amount, submit the deployment, and end the conversation."""
     premint = update.message.text
     if not is_nonnegative_integer(premint):
         await update.message.reply_text(
@@ -83,22 +99,21 @@ async def finalize_token_deployment(update: Update, context: ContextTypes.DEFAUL
         )
         return ConversationState.TOKEN_PREMINT
 
-    # Gather all arguments
-    chain_id = '11155111' # example is hardcoded for the Sepolia testnet
-    name = context.user_data["name"]
-    ticker = context.user_data["ticker"]
-    description = context.user_data["description"]
-    image_file_id = context.user_data.get("image", None)  # Optional, in case no image was uploaded
-    
-    # Its better to store escrow wallet ids as enironment variables or in your apps database
-    # but we will look it up to demonstrate how to fetch wallets from 1Shot API
-    # Note for this demo to work, make sure there is only 1 wallet in your organization for the Sepolia network
-    wallet = await oneshot_client.wallets.list(BUSINESS_ID, {"chain_id": chain_id})
+    # every deployment spends escrow wallet gas, so users get a limited number of them
+    if not admission_control.admit(update.effective_user.id, ActionClass.TRANSACTION):
+        await send_rejection(update, ActionClass.TRANSACTION)
+        return ConversationState.TOKEN_PREMINT
 
-    contract_method = await oneshot_client.contract_methods.list(
-        business_id=BUSINESS_ID,
-        params={"page": 1, "page_size": 10, "chain_id": "11155111", "name": "1Shot Demo Sepolia Token Deployer"}
-    )
+    # from here on this update is part of the deployment's trace, the memo carries it to the callback
+    trace_id = context.user_data.trace_id
+    tracer.join(trace_id, update, "telegram", from_start=True)
+
+    # Gather all arguments
+    chain_id = SEPOLIA_CHAIN_ID # example is hardcoded for the Sepolia testnet
+    name = context.user_data.name
+    ticker = context.user_data.ticker
+    description = context.user_data.description
+    image_file_id = context.user_data.image  # Optional, in case no image was uploaded
 
     # This message will come back to the bot when the transaction is executed
     # We can use the info to figure out how to react
@@ -112,20 +127,39 @@ async def finalize_token_deployment(update: Update, context: ContextTypes.DEFAUL
     memo = TransactionMemo(
         tx_type=TxType.TOKEN_CREATION.value,
         associated_user_id=update.effective_user.id,
-        note_to_user=token_info.model_dump_json()
+        payload=token_info,
+        trace_id=trace_id,
     )
 
-    transaction = await oneshot_client.contract_methods.execute(
-        contract_method_id=contract_method.response[0].id,
-        params={
-            "name": name,
-            "ticker": ticker,
-            "admin": wallet.response[0].account_address,
-            "premint": convert_to_wei(premint),
-        },
-        memo=memo.model_dump_json()
-    )
-    logger.info(f"Token creation transaction executed: {transaction.id}")
+    # The escrow wallet was resolved on startup, so we read it from the resource registry instead of listing it from 1Shot API
+    # Note for this demo to work, make sure there is only 1 wallet in your organization for the Sepolia network
+    try:
+        wallet = resource_registry.escrow_wallet(chain_id)
+        if wallet is None:
+            wallet = (await resource_registry.load_wallets(chain_id))[0]
+
+        # we don't wait for 1Shot API here, the submitter executes the deployment in the background (retrying if 1Shot API
+        # is having a bad moment) and the webhook tells us when the token is live
+        with tracer.span("telegram.submit"):
+            submission_key = await transaction_submitter.submit(
+                chat_id=update.effective_chat.id,
+                chain_id=chain_id,
+                contract_method_name=TOKEN_DEPLOYER_NAME,
+                params={
+                    "name": name,
+                    "ticker": ticker,
+                    "admin": wallet.account_address,
+                    "premint": convert_to_wei(premint),
+                },
+                memo=memo,
+            )
+    except Exception:
+        # nothing was submitted, so the deployment doesn't count against the user's limit
+        admission_control.refund(update.effective_user.id, ActionClass.TRANSACTION)
+        raise
+    logger.info("Token creation submitted: %s", submission_key)
+    # the memo has everything the callback needs, the draft would only take up memory
+    context.user_data.clear_draft()
 
     buttons = [[InlineKeyboardButton(text="Back", callback_data="start")]]
     keyboard = InlineKeyboardMarkup(buttons)
@@ -133,28 +167,71 @@ async def finalize_token_deployment(update: Update, context: ContextTypes.DEFAUL
         "✅ Your token is being deployed! You will be notified once it's ready.", reply_markup=keyboard
     )
 
-    context.user_data[ConversationState.START_OVER] = True
+    context.user_data.start_over = True
 
     return ConversationState.START_ROUTES # End the conversation
 
-async def successful_token_deployment(token_address: str, memo: TransactionMemo, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def successful_token_deployment(token_address: Optional[str], memo: TransactionMemo, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Notify the user that their token has been created."""
-    token_info = TokenInfo.model_validate_json(memo.note_to_user)
+    token_info = memo.payload
 
     success_message = (
         f"<code>New Coin Created!</code>\n\n"
         f"<b>Name:</b> {token_info.name}\n"
         f"<b>Ticker:</b> {token_info.ticker}\n"
         f"<b>Description:</b> {token_info.description}\n"
-        f"Address: <a href='https://sepolia.etherscan.io/token/{token_address}'>{token_address}</a>\n"
     )
+    # the address comes from the TokenCreated log, which isn't available when the result was recovered by the reconciler
+    if token_address:
+        success_message += f"Address: <a href='https://sepolia.etherscan.io/token/{token_address}'>{token_address}</a>\n"
 
-    await context.bot.send_photo(
-        chat_id=memo.associated_user_id, 
-        photo=token_info.image_file_id, 
-        caption=success_message, 
-        parse_mode=ParseMode.HTML
+    # this is a notification rather than a reply, so it yields to interactive messages when we're close to Telegram's limits
+    with tracer.span("callback.send_photo"):
+        await context.bot.send_photo(
+            chat_id=memo.associated_user_id, 
+            photo=token_info.image_file_id, 
+            caption=success_message, 
+            parse_mode=ParseMode.HTML,
+            rate_limit_args={"priority": SendPriority.NOTIFICATION}
+        )
+
+async def token_address_found(token_address: str, memo: TransactionMemo, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Tell the user the address of a token we announced without one."""
+    with tracer.span("callback.send_message"):
+        await context.bot.send_message(
+            chat_id=memo.associated_user_id,
+            text=(
+                f"<b>{memo.payload.name}</b> ({memo.payload.ticker}) is at "
+                f"<a href='https://sepolia.etherscan.io/token/{token_address}'>{token_address}</a>"
+            ),
+            parse_mode=ParseMode.HTML,
+            rate_limit_args={"priority": SendPriority.NOTIFICATION}
+        )
+
+# 1Shot API calls this back once the deployment is mined, the token address is in the TokenCreated log. When the
+# reconciler found the result first, the real callback still comes here for the address
+@webhook_dispatcher.handler("TransactionExecutionSuccess", TxType.TOKEN_CREATION, logs=["TokenCreated"], after_reconciled=True)
+async def token_deployment_succeeded(update: WebhookPayload, memo: TransactionMemo, logs: LogIndex, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pick the token address out of the callback, record the token and notify the user."""
+    # callbacks recovered by the reconciler don't carry logs
+    token_created = logs["TokenCreated"]
+    token_address = token_created[-1].args[0] if token_created else None
+    # remember the token so the user can find it again with /mytokens
+    added = await token_registry.add(
+        owner_id=memo.associated_user_id,
+        chain_id=update.data.chain,
+        address=token_address,
+        token_info=memo.payload,
+        transaction_id=update.data.transaction_execution_id,
     )
+    if not added:
+        # the user already heard about this token, all that's new is the address (if this callback has it)
+        if token_address:
+            logger.info("Found the address of token %s from transaction %s", token_address, update.data.transaction_execution_id)
+            await token_address_found(token_address, memo, context)
+        return
+    await successful_token_deployment(token_address, memo, context)
+    tracer.finish(memo.trace_id, "deployment", outcome="success")
 
 def get_token_deployment_conversation_handler() -> ConversationHandler:
     """Create and return the conversation handler for token deployment."""
@@ -173,5 +250,7 @@ def get_token_deployment_conversation_handler() -> ConversationHandler:
         map_to_parent={
             ConversationState.START_ROUTES: ConversationState.START_ROUTES,
             ConversationHandler.END: ConversationHandler.END
-        }
+        },
+        name="deploytoken",
+        persistent=True,
     )
@@ -0,0 +1,84 @@
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from telegram.ext import ContextTypes
+
+from uxly_1shot_client import WebhookPayload
+from uxly_1shot_client.models.webhooks import ParsedLogEntry
+
+from logsetup import bind_log_context
+from memostore import decode_memo
+from tracing import tracer
+from metrics import oneshot_webhooks, oneshot_webhooks_unhandled
+from objects import TransactionMemo, TxType
+
+logger = logging.getLogger(__name__)
+
+# the logs a handler asked for, by event name, in the order they were emitted
+LogIndex = Dict[str, List[ParsedLogEntry]]
+WebhookHandler = Callable[[WebhookPayload, TransactionMemo, LogIndex, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+
+def index_logs(logs: Optional[Iterable[ParsedLogEntry]], names: Iterable[str]) -> LogIndex:
+    """Group the logs with the given names by name, in a single pass over the logs."""
+    wanted = {name: [] for name in names}
+    if wanted:
+        for log in logs or ():
+            entries = wanted.get(log.name)
+            if entries is not None:
+                entries.append(log)
+    return wanted
+
+# Routes 1Shot API callbacks to handlers by event name and the transaction type in the memo. Handlers register
+# with the log events they need, which are indexed for them in one pass. A handler registered with tx_type=None
+# handles that event for every transaction type that doesn't have a handler of its own.
+# When the reconciler looked up a result because its callback was late, the handler runs without logs; if the real
+# callback arrives after all, it only goes to handlers registered with after_reconciled=True, which must cope with
+# running a second time for the same transaction (e.g. to fill in what only the logs tell).
+#
+#   @webhook_dispatcher.handler("TransactionExecutionSuccess", TxType.TOKEN_CREATION, logs=["TokenCreated"])
+#   async def token_created(update, memo, logs, context): ...
+class WebhookDispatcher:
+    def __init__(self):
+        self._handlers: Dict[Tuple[str, Optional[TxType]], Tuple[WebhookHandler, Tuple[str, ...], bool]] = {}
+
+    def handler(self, event_name: str, tx_type: Optional[TxType], logs: Iterable[str] = (), after_reconciled: bool = False) -> Callable[[WebhookHandler], WebhookHandler]:
+        """Register the decorated function for an event and transaction type."""
+        def decorator(function: WebhookHandler) -> WebhookHandler:
+            key = (event_name, tx_type)
+            if key in self._handlers:
+                raise ValueError(f"A handler for {event_name} / {tx_type} is already registered")
+            self._handlers[key] = (function, tuple(logs), after_reconciled)
+            return function
+        return decorator
+
+    async def dispatch(self, update: WebhookPayload, context: ContextTypes.DEFAULT_TYPE, after_reconciled: bool = False) -> bool:
+        """Hand a callback to its handler, returns False if there is none. after_reconciled says the transaction was
+        already handled from a result the reconciler looked up."""
+        event_name = update.event_name
+        # check for the Transaction Memo, if its not set, we don't know what to do with it
+        if not update.data.transaction_execution_memo:
+            logger.error("TransactionMemo is null: %s", update.data.transaction_execution_id)
+            oneshot_webhooks_unhandled.inc(event_name, "none")
+            return False
+
+        memo = decode_memo(update.data.transaction_execution_memo)
+        bind_log_context(chat_id=memo.associated_user_id)
+        # a transaction started by a traced conversation carries the trace in its memo
+        tracer.join(memo.trace_id, update, "callback")
+        registered = self._handlers.get((event_name, memo.tx_type)) or self._handlers.get((event_name, None))
+        if registered is None:
+            logger.warning("No handler for %s of a %s transaction", event_name, memo.tx_type.name)
+            oneshot_webhooks_unhandled.inc(event_name, memo.tx_type.name)
+            return False
+
+        function, log_names, wants_late_callback = registered
+        if after_reconciled and not wants_late_callback:
+            logger.info("Transaction %s was already handled from its reconciled result", update.data.transaction_execution_id)
+            return True
+        oneshot_webhooks.inc(event_name, memo.tx_type.name)
+        with tracer.span(f"callback.{function.__name__}"):
+            await function(update, memo, index_logs(update.data.logs, log_names), context)
+        return True
+
+# handlers register themselves on import, webhook_update dispatches through it
+webhook_dispatcher = WebhookDispatcher()
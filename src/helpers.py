@@ -3,21 +3,42 @@ from telegram.ext import ContextTypes, ConversationHandler
 
 from fastapi import Request, HTTPException
 
-from oneshot import (
-    oneshot_client,
-)
+from keystore import public_key_store
+from logsetup import bind_log_context
+from metrics import instrument_handler
 
-from objects import ConversationState
-
-from uxly_1shot_client import verify_webhook
+from uxly_1shot_client import verify_webhook, WebhookPayload
+from cryptography.exceptions import InvalidSignature
 
 import re
 import os
+import json
+import time
+import asyncio
 import logging
 from typing import Dict
 
+# orjson is a lot faster at decoding webhook bodies, but we fall back to the standard library if it's not installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 logger = logging.getLogger(__name__)
 
+# local state (conversations, caches, journals) is kept in files under this directory
+DATA_DIR = os.getenv("BOT_DATA_DIR", "data")
+
+def data_path(filename: str) -> str:
+    """Return the path of a file inside DATA_DIR, creating the directory if needed."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return os.path.join(DATA_DIR, filename)
+
+# the demo deploys tokens on the Sepolia testnet through a contract method endpoint with this name
+SEPOLIA_CHAIN_ID = "11155111"
+TOKEN_DEPLOYER_NAME = "1Shot Demo Sepolia Token Deployer"
+
 # Python doesn't have a built-in BigInt type, so we use a string to represent large integers
 def convert_to_wei(amount: str) -> str:
     """Convert a string amount to string wei (1 ether = 10^18 wei)."""
@@ -43,10 +64,11 @@ def is_valid_ethereum_address(address: str) -> bool:
     return bool(re.fullmatch(r"0x[a-fA-F0-9]{40}", address))
 
 # Can be used as a general fallback function to end conversation flows
+@instrument_handler
 async def canceler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the conversation."""
     await update.message.reply_text("bye 👋")
-    context.user_data[ConversationState.START_OVER] = False
+    context.user_data.start_over = False
     return ConversationHandler.END
 
 
@@ -55,7 +77,7 @@ def get_token_deployer_endpoint_creation_payload(chain_id: str, contract_address
         "chain_id": chain_id,
         "contractAddress": contract_address,
         "walletId": escrow_wallet_id,
-        "name": "1Shot Demo Sepolia Token Deployer",
+        "name": TOKEN_DEPLOYER_NAME,
         "description": "This deploys ERC20 tokens on the Sepolia testnet.",
         "functionName": "deployToken",
         "callbackUrl": f"{callback}",
@@ -85,39 +107,107 @@ def get_token_deployer_endpoint_creation_payload(chain_id: str, contract_address
         "outputs": []
     }
 
+# airdrops transfer tokens out of the escrow wallet through one contract method per token
+def get_token_transfer_endpoint_creation_payload(chain_id: str, contract_address: str, escrow_wallet_id: str, callback: str, name: str) -> Dict[str, str]:
+     return {
+        "chain_id": chain_id,
+        "contractAddress": contract_address,
+        "walletId": escrow_wallet_id,
+        "name": name,
+        "description": "Transfers tokens from the escrow wallet, used for airdrops.",
+        "functionName": "transfer",
+        "callbackUrl": f"{callback}",
+        "stateMutability": "nonpayable",
+        "inputs": [
+            {
+                "name": "to",
+                "type": "address",
+                "index": 0,
+            },
+            {
+                "name": "value",
+                "type": "uint",
+                "index": 1
+            }
+        ],
+        "outputs": []
+    }
+
+# verify_webhook raises on a bad signature, so we turn that into a simple yes/no answer
+def is_valid_webhook_signature(body: dict, signature: str, public_key: str) -> bool:
+    """Check the signature of a 1Shot API webhook body against a public key."""
+    try:
+        return verify_webhook(body=body, signature=signature, public_key=public_key)
+    except (ValueError, InvalidSignature):
+        return False
+
+# signature checks on big payloads (lots of logs) are moved off the event loop so they don't stall other requests
+VERIFY_IN_THREAD_BYTES = int(os.getenv("VERIFY_IN_THREAD_BYTES", "16384"))
+# a bad signature makes us refetch the public key in case it was rotated, but at most this often (in seconds) per
+# contract method, so a flood of forged callbacks can't turn into a flood of requests to 1Shot API
+WEBHOOK_KEY_REFRESH_INTERVAL = float(os.getenv("WEBHOOK_KEY_REFRESH_INTERVAL", "60"))
+
 # example of a wrapper class to handle webhook verification with FastAPI
-# rather than looking up the public key from 1Shot API each time, you could store it in a database or cache
+# public keys are looked up through the public_key_store in keystore.py, which caches them in memory
+# the request body is read and parsed exactly once here, and the validated WebhookPayload is handed
+# to the route as the dependency's return value so it never has to decode the body again
 class webhookAuthenticator:
     # you could do something with the constructor like set up a database connection
-    def __init__(self):
+    def __init__(self, refresh_interval: float = WEBHOOK_KEY_REFRESH_INTERVAL):
+        self._refresh_interval = refresh_interval
+        # contract method id -> when we last refetched its public key
+        self._refreshed_at: Dict[str, float] = {}
         logger.info("Webhook Authenticator initialized.")
 
-    async def __call__(self, request: Request):
+    def _may_refresh(self, contract_method_id: str) -> bool:
+        now = time.monotonic()
+        last = self._refreshed_at.get(contract_method_id)
+        if last is not None and now - last < self._refresh_interval:
+            return False
+        # forget the contract methods whose interval is over, so this doesn't grow with every key we ever refreshed
+        self._refreshed_at = {id: at for id, at in self._refreshed_at.items() if now - at < self._refresh_interval}
+        self._refreshed_at[contract_method_id] = now
+        return True
+
+    async def _verify(self, body: dict, signature: str, public_key: str, size: int) -> bool:
+        if size > VERIFY_IN_THREAD_BYTES:
+            return await asyncio.to_thread(is_valid_webhook_signature, body, signature, public_key)
+        return is_valid_webhook_signature(body, signature, public_key)
+
+    async def __call__(self, request: Request) -> WebhookPayload:
         try:
-            # Extract the required fields from the request
-            body = await request.json()  # Raw request body
+            # Read the raw request body once and parse it once
+            raw_body = await request.body()
+            body = json_loads(raw_body)
+            # the request runs in its own task, everything logged for it from here on carries the transaction
+            bind_log_context(transaction_id=body.get("data", {}).get("transactionExecutionId"))
 
-            if not body["signature"]:
+            if not body.get("signature"):
                 raise HTTPException(status_code=400, detail="Signature field missing")
             
-            # look up the contract method endpoint that generated the callback and get the public key
-            # in a production application, store the public key in a database or cache for faster access
-            contract_method = await oneshot_client.contract_methods.get(
-                contract_method_id=body["data"]["transactionId"],
-            )
+            # look up the public key of the contract method endpoint that generated the callback
+            contract_method_id = body["data"]["transactionId"]
+            public_key = await public_key_store.get(contract_method_id)
 
-            if not contract_method.public_key:
+            if not public_key:
                 raise HTTPException(status_code=400, detail="Public key not found")
 
-            # Verify the signature with the public key you stored corresponding to the transaction ID
-            is_valid = verify_webhook(
-                body=body,
-                signature=body["signature"],
-                public_key=contract_method.public_key
-            )
+            # Verify the signature with the public key corresponding to the transaction ID
+            is_valid = await self._verify(body, body["signature"], public_key, len(raw_body))
+
+            # the key may have been rotated since we cached it, so refetch it once before giving up,
+            # unless we did so for this contract method only a moment ago
+            if not is_valid and self._may_refresh(contract_method_id):
+                fresh_public_key = await public_key_store.get(contract_method_id, refresh=True)
+                if fresh_public_key and fresh_public_key != public_key:
+                    is_valid = await self._verify(body, body["signature"], fresh_public_key, len(raw_body))
 
             if not is_valid:
                 raise HTTPException(status_code=403, detail="Invalid signature")
+
+            return WebhookPayload.model_validate(body)
+        except HTTPException:
+            raise
         except Exception as e:
-            logger.error(f"Error verifying webhook: {e}")
-            raise HTTPException(status_code=500, detail=f"Internal error: {e}")
\ No newline at end of file
+            logger.error("Error verifying webhook: %s", e)
+            raise HTTPException(status_code=500, detail=f"Internal error: {e}")
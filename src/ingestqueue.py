@@ -0,0 +1,110 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from enum import IntEnum
+from http import HTTPStatus
+from typing import Optional
+
+from telegram import Update
+
+from uxly_1shot_client import WebhookPayload
+
+logger = logging.getLogger(__name__)
+
+# above the high watermark we start shedding low value updates, and keep doing so until the queue drains below
+# the low watermark; above the limit we ask Telegram to back off and retry later
+INGEST_LOW_WATERMARK = int(os.getenv("INGEST_LOW_WATERMARK", "500"))
+INGEST_HIGH_WATERMARK = int(os.getenv("INGEST_HIGH_WATERMARK", "1000"))
+INGEST_LIMIT = int(os.getenv("INGEST_LIMIT", "2000"))
+
+# how valuable an update is when we have to choose what to drop
+class UpdatePriority(IntEnum):
+    LOW = 0
+    NORMAL = 1
+    CRITICAL = 2
+
+def update_priority(update: object) -> UpdatePriority:
+    """Classify an update for load shedding."""
+    # 1Shot API callbacks tell a user their transaction went through, we never drop those
+    if isinstance(update, WebhookPayload):
+        return UpdatePriority.CRITICAL
+    # membership changes are only logged today, so they are the first to go
+    if isinstance(update, Update) and (update.my_chat_member or update.chat_member):
+        return UpdatePriority.LOW
+    return UpdatePriority.NORMAL
+
+# The Application's update queue, with admission control in front of it. The queue itself is unbounded so a
+# critical update can always be put; admit() is what keeps it bounded for everything else.
+# With concurrent updates the Application takes every update off the queue straight away and handles it in a task
+# of its own, so the queue is nearly always empty; what piles up is updates in flight. Those are counted from put()
+# until the Application calls task_done() once the update has been handled, and admission is based on that count.
+# It also remembers when each update was queued so we can report how far behind the handlers are.
+class IngestQueue(asyncio.Queue):
+    def __init__(self, low_watermark: int = INGEST_LOW_WATERMARK, high_watermark: int = INGEST_HIGH_WATERMARK, limit: int = INGEST_LIMIT):
+        super().__init__()
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.limit = limit
+        self.shedding = False
+        self.shed = 0
+        self.rejected = 0
+        # updates queued or being handled
+        self.in_flight = 0
+        # how long the most recently dequeued update waited in the queue
+        self.last_wait = 0.0
+
+    def _init(self, maxsize: int) -> None:
+        super()._init(maxsize)
+        self._queued_at = deque()
+
+    def _put(self, item: object) -> None:
+        super()._put(item)
+        self._queued_at.append(time.monotonic())
+        self.in_flight += 1
+
+    def task_done(self) -> None:
+        super().task_done()
+        self.in_flight -= 1
+
+    def _get(self) -> object:
+        item = super()._get()
+        self.last_wait = time.monotonic() - self._queued_at.popleft()
+        return item
+
+    @property
+    def oldest_age(self) -> float:
+        """How long the update at the head of the queue has been waiting."""
+        return time.monotonic() - self._queued_at[0] if self._queued_at else 0.0
+
+    def clear(self) -> int:
+        """Drop the updates still waiting in the queue, returns how many there were."""
+        dropped = 0
+        while not self.empty():
+            self.get_nowait()
+            self.task_done()
+            dropped += 1
+        return dropped
+
+    def admit(self, priority: UpdatePriority) -> Optional[int]:
+        """Decide whether to queue an update, returns None to accept it or the HTTP status to answer with instead."""
+        depth = self.in_flight
+        if self.shedding and depth <= self.low_watermark:
+            logger.info("Updates in flight drained to %s, no longer shedding load", depth)
+            self.shedding = False
+        elif not self.shedding and depth >= self.high_watermark:
+            logger.warning("Updates in flight reached %s, shedding low priority updates", depth)
+            self.shedding = True
+
+        if priority == UpdatePriority.CRITICAL:
+            return None
+        if self.shedding and priority == UpdatePriority.LOW:
+            # acknowledge it so it isn't redelivered, it just won't be handled
+            self.shed += 1
+            return HTTPStatus.OK
+        if depth >= self.limit:
+            # Telegram retries updates we don't answer with a 2xx, backing off as it does
+            self.rejected += 1
+            return HTTPStatus.TOO_MANY_REQUESTS
+        return None
@@ -0,0 +1,273 @@
+import os
+import zlib
+import struct
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telegram import Update
+
+from helpers import data_path
+from sharding import UpdateKind
+
+logger = logging.getLogger(__name__)
+
+# where each worker keeps its journal (in a directory of its own), set JOURNAL_DIR to an empty string to turn it off
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", data_path("journal"))
+# a new segment file is started once the current one is this big, segments are deleted once all their updates are handled
+JOURNAL_SEGMENT_BYTES = int(os.getenv("JOURNAL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+# how often (in seconds) the checkpoint is brought up to date when no updates are coming in
+JOURNAL_CHECKPOINT_INTERVAL = float(os.getenv("JOURNAL_CHECKPOINT_INTERVAL", "1"))
+# how long (in seconds) shutting down waits for the updates we already acknowledged to be handled
+JOURNAL_DRAIN_TIMEOUT = float(os.getenv("JOURNAL_DRAIN_TIMEOUT", "10"))
+
+# records are: type (A for an acknowledged update, D once it has been handled), sequence number, update kind,
+# body length and the CRC32 of the body, followed by the body
+_RECORD_HEADER = struct.Struct("!cQBII")
+_APPENDED = b"A"
+_DONE = b"D"
+
+def _segment_name(first_seq: int) -> str:
+    return f"{first_seq:016d}.journal"
+
+def _read_segment(path: str) -> Tuple[List[Tuple[int, UpdateKind, bytes]], List[int], int]:
+    # returns the updates and the handled sequence numbers in a segment, and how many of its bytes hold whole records
+    with open(path, "rb") as f:
+        data = f.read()
+    appended, done = [], []
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        record_type, seq, kind, length, crc = _RECORD_HEADER.unpack_from(data, offset)
+        body = data[offset + _RECORD_HEADER.size:offset + _RECORD_HEADER.size + length]
+        if record_type == _DONE:
+            done.append(seq)
+        elif record_type == _APPENDED and len(body) == length and zlib.crc32(body) == crc:
+            appended.append((seq, UpdateKind(kind), body))
+        else:
+            # a crash in the middle of a write leaves a partial record at the end, nothing after it was acknowledged
+            break
+        offset += _RECORD_HEADER.size + length
+    return appended, done, offset
+
+# An append-only journal of the updates we acknowledged but haven't handled yet. The webhook routes append an update
+# and wait for it to be on disk before answering 200, and the update processor marks it as handled when its handlers
+# are done. Appends are group committed: while one batch is being written and fsynced, the next one collects every
+# update that comes in meanwhile, so under load a single fsync covers many requests. The checkpoint file holds the
+# sequence number below which every update has been handled; on startup whatever is past it and not marked as
+# handled is put back into the update queue.
+class UpdateJournal:
+    def __init__(self, directory: Optional[str] = JOURNAL_DIR):
+        self._directory = directory
+        self._path: Optional[str] = None
+        self._file = None
+        self._size = 0
+        # (first sequence number, path) of the segment files, oldest first, the last one is being written
+        self._segments: List[Tuple[int, str]] = []
+        self._next_seq = 0
+        self._checkpointed = 0
+        # records waiting for the next commit, and the future the appends in it wait on
+        self._buffer: List[bytes] = []
+        self._waiter: Optional[asyncio.Future] = None
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        # sequence numbers of the updates not handled yet, the lowest one is the checkpoint
+        self._pending: Dict[int, None] = {}
+        # id() of an update in the queue or being handled -> its sequence number
+        self._seqs: Dict[int, int] = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # updates found on startup that still need to be handled
+        self._unprocessed: List[Tuple[int, UpdateKind, bytes]] = []
+        self.appended = 0
+        self.commits = 0
+        self.replayed = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _open_segment(self, first_seq: int) -> None:
+        path = os.path.join(self._path, _segment_name(first_seq))
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+        # the last segment of the previous run is reused if nothing was appended to it
+        if not self._segments or self._segments[-1][1] != path:
+            self._segments.append((first_seq, path))
+
+    def _load(self) -> None:
+        os.makedirs(self._path, exist_ok=True)
+        checkpoint_path = os.path.join(self._path, "checkpoint")
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                self._checkpointed = int(f.read().strip() or 0)
+        self._next_seq = self._checkpointed
+
+        entries: Dict[int, Tuple[int, UpdateKind, bytes]] = {}
+        done = set()
+        for name in sorted(name for name in os.listdir(self._path) if name.endswith(".journal")):
+            path = os.path.join(self._path, name)
+            appended, handled, length = _read_segment(path)
+            if length < os.path.getsize(path):
+                logger.warning("Journal segment %s ends in a partial record, cutting it off", name)
+                os.truncate(path, length)
+            for entry in appended:
+                self._next_seq = max(self._next_seq, entry[0] + 1)
+                if entry[0] >= self._checkpointed:
+                    entries[entry[0]] = entry
+            done.update(handled)
+            self._segments.append((int(name.split(".")[0]), path))
+        self._unprocessed = [entries[seq] for seq in sorted(entries) if seq not in done]
+        # they count as not handled from now on, so the checkpoint can't move past them before they're replayed
+        for seq, _, _ in self._unprocessed:
+            self._pending[seq] = None
+        if self._pending:
+            self._idle.clear()
+        self._open_segment(self._next_seq)
+
+    def _write(self, batch: List[bytes], next_seq: int, checkpoint: int) -> None:
+        if batch:
+            data = b"".join(batch)
+            try:
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except BaseException:
+                # drop what made it to the file so the next batch doesn't follow a partial record
+                self._file.truncate(self._size)
+                raise
+            self._size += len(data)
+            if self._size >= JOURNAL_SEGMENT_BYTES:
+                self._file.close()
+                self._open_segment(next_seq)
+
+        if checkpoint != self._checkpointed:
+            # write to a temporary file first so a crash never leaves a half written checkpoint behind
+            temporary_path = os.path.join(self._path, "checkpoint.tmp")
+            with open(temporary_path, "w") as f:
+                f.write(str(checkpoint))
+            os.replace(temporary_path, os.path.join(self._path, "checkpoint"))
+            self._checkpointed = checkpoint
+            # a segment only holds updates from before the one after it starts
+            while len(self._segments) > 1 and self._segments[1][0] <= checkpoint:
+                os.remove(self._segments.pop(0)[1])
+
+    async def _commit_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), JOURNAL_CHECKPOINT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            batch, self._buffer = self._buffer, []
+            waiter, self._waiter = self._waiter, None
+            # forwarded updates can be appended before the ones found on startup are replayed, so this isn't always the first
+            checkpoint = min(self._pending, default=self._next_seq)
+            try:
+                if batch or checkpoint != self._checkpointed:
+                    await asyncio.to_thread(self._write, batch, self._next_seq, checkpoint)
+                    self.commits += 1
+            except Exception as e:
+                logger.error("Failed to write the update journal: %s", e)
+                if waiter is not None:
+                    waiter.set_exception(e)
+            else:
+                if waiter is not None:
+                    waiter.set_result(None)
+            if self._stopping and not self._buffer:
+                return
+
+    async def start(self, worker_index: int = 0) -> None:
+        """Open this worker's journal and find the updates that weren't handled before the last shutdown."""
+        if not self._directory:
+            return
+        self._path = os.path.join(self._directory, f"worker-{worker_index}")
+        await asyncio.to_thread(self._load)
+        if self._unprocessed:
+            logger.info("Found %s acknowledged updates that weren't handled before the restart", len(self._unprocessed))
+        self._task = asyncio.create_task(self._commit_loop())
+
+    def _track(self, update: object, seq: int) -> None:
+        self._pending[seq] = None
+        self._seqs[id(update)] = seq
+        self._idle.clear()
+
+    async def append(self, update: object, body: Optional[bytes] = None) -> None:
+        """Write an update to the journal and wait until it is on disk, body is its JSON if we have it already."""
+        if self._task is None:
+            return
+        if isinstance(update, Update):
+            kind = UpdateKind.TELEGRAM
+            body = body if body is not None else update.to_json().encode()
+        else:
+            kind = UpdateKind.ONESHOT
+            body = body if body is not None else update.model_dump_json(by_alias=True).encode()
+
+        seq = self._next_seq
+        self._next_seq += 1
+        self._buffer.append(_RECORD_HEADER.pack(_APPENDED, seq, kind.value, len(body), zlib.crc32(body)) + body)
+        if self._waiter is None:
+            self._waiter = asyncio.get_running_loop().create_future()
+        waiter = self._waiter
+        self._wake.set()
+        self._track(update, seq)
+        self.appended += 1
+        try:
+            # the commit is shared with other requests, so our caller giving up must not cancel it
+            await asyncio.shield(waiter)
+        except BaseException:
+            self.processed(update)
+            raise
+
+    def processed(self, update: object) -> None:
+        """Mark an update as handled, it won't be replayed after a restart."""
+        seq = self._seqs.pop(id(update), None)
+        if seq is None:
+            return
+        del self._pending[seq]
+        # no need to wait for these to be on disk, losing one only means an update is handled twice after a crash;
+        # they go out with the next commit
+        self._buffer.append(_RECORD_HEADER.pack(_DONE, seq, 0, 0, 0))
+        if not self._pending:
+            self._idle.set()
+
+    async def replay(self, decode: Callable[[UpdateKind, bytes], object], put: Callable[[object], Awaitable[None]]) -> int:
+        """Put the updates found on startup back into the update queue, oldest first. Returns how many there were."""
+        unprocessed, self._unprocessed = self._unprocessed, []
+        for seq, kind, body in unprocessed:
+            try:
+                update = decode(kind, body)
+            except Exception as e:
+                logger.error("Skipping journaled update %s that can't be decoded: %s", seq, e)
+                del self._pending[seq]
+                self._buffer.append(_RECORD_HEADER.pack(_DONE, seq, 0, 0, 0))
+                if not self._pending:
+                    self._idle.set()
+                continue
+            self._track(update, seq)
+            await put(update)
+            self.replayed += 1
+        if unprocessed:
+            logger.info("Replayed %s updates from the journal", self.replayed)
+        return self.replayed
+
+    async def drain(self, timeout: float = JOURNAL_DRAIN_TIMEOUT) -> bool:
+        """Wait until every acknowledged update has been handled, returns False if that took longer than timeout."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self) -> None:
+        """Write out the last records and the checkpoint, and close the journal."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        await self._task
+        self._task = None
+        self._file.close()
+
+# the webhook routes append to it, the update processor marks updates as handled
+update_journal = UpdateJournal()
@@ -0,0 +1,43 @@
+import os
+import logging
+from typing import Iterable, Optional
+
+from uxly_1shot_client.models.contract_method import ContractMethod
+
+from cache import AsyncTTLCache
+from transport import request_budget
+
+from oneshot import oneshot_client
+
+logger = logging.getLogger(__name__)
+
+# how long a public key is trusted before we look it up again, and how many contract methods we remember
+PUBLIC_KEY_TTL = float(os.getenv("PUBLIC_KEY_TTL", "3600"))
+PUBLIC_KEY_CACHE_SIZE = int(os.getenv("PUBLIC_KEY_CACHE_SIZE", "256"))
+# a callback waits for its public key, so the lookup (token refresh included) gets this many seconds in total
+PUBLIC_KEY_FETCH_BUDGET = float(os.getenv("PUBLIC_KEY_FETCH_BUDGET", "5"))
+
+# 1Shot API signs every webhook with a key that belongs to the contract method that was executed
+# instead of asking 1Shot API for the public key on every callback, we keep the keys we already know in memory
+class PublicKeyStore:
+    def __init__(self, ttl: float = PUBLIC_KEY_TTL, max_size: int = PUBLIC_KEY_CACHE_SIZE):
+        self._cache: AsyncTTLCache[str, str] = AsyncTTLCache(self._fetch, ttl=ttl, max_size=max_size)
+
+    async def _fetch(self, contract_method_id: str) -> Optional[str]:
+        logger.info("Fetching public key for contract method %s", contract_method_id)
+        with request_budget(PUBLIC_KEY_FETCH_BUDGET):
+            contract_method = await oneshot_client.contract_methods.get(contract_method_id=contract_method_id)
+        return contract_method.public_key
+
+    def warm(self, contract_methods: Iterable[ContractMethod]) -> None:
+        """Seed the store with contract methods we already fetched, e.g. during startup."""
+        for contract_method in contract_methods:
+            if contract_method.public_key:
+                self._cache.put(contract_method.id, contract_method.public_key)
+
+    async def get(self, contract_method_id: str, refresh: bool = False) -> Optional[str]:
+        """Get the public key for a contract method, pass refresh=True to bypass the cached key."""
+        return await self._cache.get(contract_method_id, refresh=refresh)
+
+# like the 1Shot client, we share a single store across the whole bot
+public_key_store = PublicKeyStore()
@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" writes one JSON object per line for log shippers, "text" the classic format for reading in a terminal
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# records waiting for the log thread, when stdout can't keep up the ones past this are dropped instead of blocking the event loop
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# how long (in seconds) shutting down waits for the log thread to write out what is queued
+LOG_FLUSH_TIMEOUT = float(os.getenv("LOG_FLUSH_TIMEOUT", "5"))
+# per logger sampling and rate limits, a rule applies to the named logger and its children, warnings and errors are always kept:
+#   LOG_SAMPLE="uvicorn.access=0.1,dedup=0.5" keeps one in ten access log records and half of the dedup ones
+#   LOG_RATE_LIMIT="chattracker=20" keeps at most 20 chattracker records a second (bursts of up to 20 included)
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+LOG_RATE_LIMIT = os.getenv("LOG_RATE_LIMIT", "")
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# the fields every record carries when they are known, set for the update being handled (see log_context)
+LOG_FIELDS = ("chat_id", "update_id", "transaction_id")
+_fields: Dict[str, ContextVar] = {field: ContextVar(f"log_{field}", default=None) for field in LOG_FIELDS}
+
+# records that never made it to stdout, by reason, exported as a metric
+log_drops: Dict[str, int] = {"queue_full": 0, "sampled": 0, "rate_limited": 0}
+
+def bind_log_context(**fields: Any) -> None:
+    """Attach fields to every record logged from the current task from now on."""
+    for field, value in fields.items():
+        _fields[field].set(value)
+
+@contextmanager
+def log_context(**fields: Any) -> Iterator[None]:
+    """Attach fields to every record logged inside the block, None values are left out."""
+    tokens = [(_fields[field], _fields[field].set(value)) for field, value in fields.items() if value is not None]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+# Copies the context fields onto the record, this runs in the thread that logs so it sees that task's context
+class LogContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field, var in _fields.items():
+            # a field passed with extra= wins over the context
+            if not hasattr(record, field):
+                setattr(record, field, var.get())
+        return True
+
+def _parse_rules(spec: str) -> Dict[str, float]:
+    rules = {}
+    for rule in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = rule.partition("=")
+        rules[name.strip()] = float(value)
+    return rules
+
+# A token bucket, refilled at rate tokens a second up to rate tokens
+class _RateLimit:
+    __slots__ = ("rate", "tokens", "updated")
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+# Drops part of the INFO and DEBUG records of the loggers that have a sampling rule or a rate limit. The rule for a
+# logger is looked up once (the most specific one of its name and its parents) and remembered.
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample: Dict[str, float], rate_limit: Dict[str, float]):
+        super().__init__()
+        self._sample = sample
+        self._limits = {name: _RateLimit(rate) for name, rate in rate_limit.items()}
+        # logger name -> (sample rate, rate limit), None when no rule applies
+        self._rules: Dict[str, Optional[Tuple[float, Optional[_RateLimit]]]] = {}
+
+    def _lookup(self, name: str) -> Optional[Tuple[float, Optional[_RateLimit]]]:
+        sample, limit = None, None
+        candidate = name
+        while candidate and (sample is None or limit is None):
+            if sample is None:
+                sample = self._sample.get(candidate)
+            if limit is None:
+                limit = self._limits.get(candidate)
+            candidate = candidate.rpartition(".")[0]
+        if sample is None and limit is None:
+            return None
+        return (1.0 if sample is None else sample), limit
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not (self._sample or self._limits):
+            return True
+        try:
+            rule = self._rules[record.name]
+        except KeyError:
+            rule = self._rules[record.name] = self._lookup(record.name)
+        if rule is None:
+            return True
+        sample, limit = rule
+        if sample < 1.0 and random.random() >= sample:
+            log_drops["sampled"] += 1
+            return False
+        if limit is not None and not limit.allow():
+            log_drops["rate_limited"] += 1
+            return False
+        return True
+
+# Formats a record as a single line JSON object, the context fields are only written when they are set
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+# Hands records to the log thread without formatting them and without ever waiting for room in the queue
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the stock QueueHandler renders the message here, on the event loop; we leave that to the log thread.
+        # the record keeps its args, so don't mutate objects you just logged
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_drops["queue_full"] += 1
+
+# Writes the queued records on a background thread, a stuck stdout only ever blocks this thread
+class LogListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        try:
+            self.queue.put(self._sentinel, timeout=LOG_FLUSH_TIMEOUT)
+        except queue.Full:
+            pass
+
+    def stop(self) -> None:
+        # unlike the stock listener, give up on a log thread that doesn't finish instead of hanging the shutdown
+        if self._thread is not None:
+            self.enqueue_sentinel()
+            self._thread.join(LOG_FLUSH_TIMEOUT)
+            self._thread = None
+
+_listener: Optional[LogListener] = None
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+
+def log_queue_depth() -> int:
+    return _queue_handler.queue.qsize() if _queue_handler is not None else 0
+
+def setup_logging() -> None:
+    """Send all logging through a queue to a background thread that writes it to stdout."""
+    global _listener, _queue_handler
+    if _listener is None:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+
+        _queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        # sampling first, records it drops don't need their context
+        _queue_handler.addFilter(SamplingFilter(_parse_rules(LOG_SAMPLE), _parse_rules(LOG_RATE_LIMIT)))
+        _queue_handler.addFilter(LogContextFilter())
+
+        root = logging.getLogger()
+        root.handlers[:] = [_queue_handler]
+        root.setLevel(LOG_LEVEL)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+        _listener = LogListener(_queue_handler.queue, handler)
+        _listener.start()
+        atexit.register(stop_logging)
+
+    # uvicorn configures its own loggers with handlers that write to stdout from the event loop, and may do so after
+    # we were imported (python main.py), so they are routed through the queue every time
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+
+def stop_logging() -> None:
+    """Write out what is still queued and stop the log thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
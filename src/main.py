@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 import os
+import time
+import asyncio
 import logging
 from http import HTTPStatus
+from typing import Optional
 from contextlib import asynccontextmanager
 
 # useful object patterns for a Telegram bot that interacts with the 1Shot API
 from objects import (
     TransactionMemo,
-    TxType,
     ConversationState
 )
 
@@ -15,17 +17,26 @@ from objects import (
 from helpers import (
     canceler,
     get_token_deployer_endpoint_creation_payload, 
-    webhookAuthenticator
+    webhookAuthenticator,
+    json_loads,
+    SEPOLIA_CHAIN_ID,
+    TOKEN_DEPLOYER_NAME
 )
 
 # this file shows how you can track what chats your bot has been added to
-from chattracker import track_chats
+from chattracker import track_chats, track_chat_admins
+
+# the chats the bot is in and their admins, kept across restarts
+from chatregistry import chat_registry
 
 # this file shows how you can implement a non-trivial conversation flow that deploys and ERC20 token
-from deploytoken import (
-    get_token_deployment_conversation_handler,
-    successful_token_deployment
-)
+# importing it also registers its 1Shot API callback handlers with the webhook dispatcher
+from deploytoken import get_token_deployment_conversation_handler
+
+# lists the tokens a user deployed, from the local token registry
+from mytokens import get_my_tokens_conversation_handler, my_tokens_command
+# airdrops are sent in the background and carry on after a restart
+from airdrop import resume_airdrops, stop_airdrops
 
 # Auth against 1Shot API is done in oneshot.py where we implement a singleton pattern
 from oneshot import (
@@ -33,11 +44,74 @@ from oneshot import (
     BUSINESS_ID # The organization id for your 1Shot API account
 )
 
+# conversation state is written behind to SQLite and loaded back lazily
+from persistence import SQLitePersistence, LazyUserDataApplication
+
+# processes different chats concurrently while keeping each chat's updates in order
+from updateprocessor import PerChatUpdateProcessor
+
+# with several workers, each chat is owned by one worker and updates are routed to it
+from sharding import (
+    shard_router,
+    telegram_routing_key,
+    oneshot_routing_key,
+    UpdateKind
+)
+
+# paces outbound messages to stay within Telegram's flood limits
+from sendscheduler import SendScheduler, SendPriority
+
+# a bounded front for the update queue that sheds load when handlers fall behind
+from ingestqueue import IngestQueue, update_priority
+
+# remembers recently accepted updates so redeliveries from Telegram and 1Shot API are only handled once
+from dedup import dedup_index, update_dedup_key, is_reconciled, callback_dedup_key, reconciled_dedup_key
+
+# latency histograms and counters, exposed on /metrics
+from metrics import (
+    registry as metrics_registry,
+    instrument_handler,
+    MetricsMiddleware
+)
+
+# routes 1Shot API callbacks to handlers by event and transaction type
+from dispatcher import webhook_dispatcher
+
+# submits contract method executions in the background with retries
+from submitter import transaction_submitter
+
+# keeps track of submitted transactions and recovers the results of lost callbacks
+from reconciler import inflight_tracker
+
+# pooled, instrumented HTTP for the Telegram Bot API (1Shot API's is set up in oneshot.py)
+from transport import telegram_request, requests_in_flight
+
+# escrow wallets and contract methods are resolved once on startup and read from memory afterwards
+from registry import resource_registry
+
+# startup phases run concurrently and are timed, a warm start reuses the last run's resources
+from startup import startup_phase, startup_phases, ensure_webhook, WARM_START
+
+# per user limits on updates and on transactions that spend escrow wallet gas
+from admission import admission_control, check_admission, limits_command, BOT_OPERATOR_IDS
+
+# user_data lives in a memory bounded session store
+from sessions import Session, session_store, touch_session, track_session
+
+# token deployments are traced from the conversation to the callback
+from tracing import tracer
+
+# acknowledged updates are journaled until they're handled, so a restart doesn't lose them
+from journal import update_journal
+
+# logging goes through a queue to a background thread, so a slow stdout never holds up the event loop
+from logsetup import setup_logging, log_drops, log_queue_depth
+
 # the 1Shot Python SDK implements a helpful Pydantic dataclass model for Webhook callback payloads
 from uxly_1shot_client import WebhookPayload
 
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import PlainTextResponse, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -48,23 +122,23 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes,
     TypeHandler,
+    filters,
 )
 from telegram.constants import ParseMode
 
 import uvicorn
 
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-logging.getLogger("httpx").setLevel(logging.WARNING)
+# Enable logging, records are written to stdout as JSON by a background thread (see logsetup.py)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 URL = os.getenv("TUNNEL_BASE_URL") # this is the base url where Telegram will send update callbacks to
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")  # Get this token from @BotFather
 PORT = 8000 # The port that uvicorn will attach to
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org") # override to use a local Bot API server or the benchmark stand-in
 
 # This is an entrypoint handler for the example bot, it gets triggered when a user types /start
+@instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Start the bot and show the main menu."""
 
@@ -73,57 +147,66 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = "1Shot API is the easiest way to build Telegram bots with onchain functionality!\n\n"
     text += "Use this simple bot as a starting point\n\n"
     buttons.append([InlineKeyboardButton("🚀 Deploy a Token", callback_data="deploytoken")])
+    buttons.append([InlineKeyboardButton("📜 My Tokens", callback_data="mytokens")])
 
     keyboard = InlineKeyboardMarkup(buttons)
 
     # If we're starting over we don't need to send a new message
-    if context.user_data.get(ConversationState.START_OVER):
+    if context.user_data.start_over:
         await update.callback_query.answer()
         await update.callback_query.edit_message_text(text=text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
     else:
         await update.message.reply_text(text=text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
 
-    context.user_data[ConversationState.START_OVER] = False
+    context.user_data.start_over = False
     return ConversationState.START_ROUTES
 
 # This handles webhooks coming from 1Shot API
+# the handlers for each event and transaction type register with the webhook dispatcher (see dispatcher.py),
+# the token deployment ones live in deploytoken.py
+@instrument_handler
 async def webhook_update(update: WebhookPayload, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming webhook updates."""
-    # Extract the payload from the update
-    event_type = update.event_name
-
-    if event_type == "TransactionExecutionSuccess":
-        # check for the Transaction Memo, if its not set, we don't know what to do with it
-        if not update.data.transaction_execution_memo:
-            logger.error(f"TransactionMemo is null: {update.data.transaction_execution_id}")
-            return
-        
-        tx_memo = TransactionMemo.model_validate_json(update.data.transaction_execution_memo)
-
-        # Check what kind of transaction was executed based on the memo and handle appropriately for you application
-        if tx_memo.tx_type == TxType.TOKEN_CREATION:
-            token_address = None
-            for log in update.data.logs:
-                if log.name == "TokenCreated":
-                    token_address = log.args[0]
-            await successful_token_deployment(token_address, tx_memo, context)
-        else:
-            # implement other transaction types as needed
-            logger.error(f"Unknown transaction type: {tx_memo.tx_type}")
-
-# lifespane is used by FastAPI on startup and shutdown: https://fastapi.tiangolo.com/advanced/events/
-# When the server is shutting down, the code after "yield" will be executed when shutting down
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Lifespan event to initialize and shutdown the Telegram bot."""
-    app.application = (
-        Application.builder().token(TOKEN).updater(None).build()
+    # the callback arrived (or the reconciler found the result), so we no longer wait on this transaction
+    # when we submitted it is where its time onchain starts, if the transaction is traced; the tracker doesn't know
+    # transactions the reconciler already resolved (or that aren't ours), and then there is no time onchain to show
+    submitted_at = inflight_tracker.resolve(update.data.transaction_execution_id)
+    if submitted_at is not None:
+        tracer.mark_update(update, "submitted", submitted_at)
+    # the real callback of a transaction we already handled from a reconciled result only goes to the handlers that
+    # want its logs (see dedup.py)
+    after_reconciled = not is_reconciled(update) and dedup_index.contains(reconciled_dedup_key(update))
+    await webhook_dispatcher.dispatch(update, context, after_reconciled=after_reconciled)
+
+# whatever kind of transaction failed, we let the user who started it know
+@webhook_dispatcher.handler("TransactionExecutionFailure", None)
+async def transaction_failed(update: WebhookPayload, memo: TransactionMemo, logs: dict, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Tell the user their transaction failed."""
+    logger.error("Transaction %s failed: %s", update.data.transaction_execution_id, memo.tx_type)
+    await context.bot.send_message(
+        chat_id=memo.associated_user_id,
+        text="❌ Sorry, your transaction failed onchain.",
+        rate_limit_args={"priority": SendPriority.NOTIFICATION}
     )
+    tracer.finish(memo.trace_id, "deployment", outcome="failed")
 
+async def resolve_resources():
+    """Resolve the escrow wallet and the token deployer contract method from 1Shot API."""
     # lets start by checking that we have a wallet provisioned for our 1Shot API account on the Sepolia network
     # if not we will exit since we must have one to continue
-    wallets = await oneshot_client.wallets.list(BUSINESS_ID, {"chain_id": "11155111"})
-    if not ((len(wallets.response) >= 1) and (float(wallets.response[0].account_balance_details.balance) > 0.0001)):
+    # to keep this demo self contained, we are also going to check our 1Shot API account for an existing contract method endpoint for the 
+    # contract at 0xA1BfEd6c6F1C3A516590edDAc7A8e359C2189A61 on the Sepolia network, if we don't have one, we'll create it automatically
+    # then we'll use that endpoint in the conversation flow to deploy tokens from a Telegram conversation
+    # for a more serious application you will probably create your required contract method endpoints ahead of time
+    # and input their contract method ids as environment variables
+    # the two lookups don't depend on each other, so they run concurrently
+    # the wallets and contract method we resolve here are kept in the resource registry so handlers don't have to look them up again
+    # the registry also seeds the public key store with the contract methods it finds
+    wallets, contract_method = await asyncio.gather(
+        resource_registry.load_wallets(SEPOLIA_CHAIN_ID),
+        resource_registry.load_contract_method(SEPOLIA_CHAIN_ID, TOKEN_DEPLOYER_NAME),
+    )
+    if not ((len(wallets) >= 1) and (float(wallets[0].account_balance_details.balance) > 0.0001)):
         raise RuntimeError(
             "Escrow wallet not provisioned or insufficient balance on the Sepolia network. "
             "Please ensure an escrow wallet exists and has sufficient funds by logging into https://app.1shotapi.dev/escrow-wallets."
@@ -131,38 +214,103 @@ async def lifespan(app: FastAPI):
     else:
         logger.info("Escrow wallet is provisioned and has sufficient funds.")
 
-    # to keep this demo self contained, we are going to check our 1Shot API account for an existing contract method endpoint for the 
-    # contract at 0xA1BfEd6c6F1C3A516590edDAc7A8e359C2189A61 on the Sepolia network, if we don't have one, we'll create it automatically
-    # then we'll use that endpoint in the conversation flow to deploy tokens from a Telegram conversation
-    # for a more serious application you will probably create your required contract method endpoints ahead of time
-    # and input their contract method ids as environment variables
-    contract_methods = await oneshot_client.contract_methods.list(
-        business_id=BUSINESS_ID,
-        params={"chain_id": "11155111", "name": "1Shot Demo Sepolia Token Deployer"}
-    )
-    if len(contract_methods.response) == 0:
+    if contract_method is None:
         logger.info("Creating new smart contract method for token deployer contract.")
         deployer_endpoint_payload = get_token_deployer_endpoint_creation_payload(
-            chain_id="11155111",
+            chain_id=SEPOLIA_CHAIN_ID,
             contract_address="0xA1BfEd6c6F1C3A516590edDAc7A8e359C2189A61",
-            escrow_wallet_id=wallets.response[0].id,
+            escrow_wallet_id=wallets[0].id,
             callback=f"{URL}/1shot"
         )
-        contract_method = await oneshot_client.contract_method.create(
+        contract_method = await oneshot_client.contract_methods.create(
             business_id=BUSINESS_ID,
             params=deployer_endpoint_payload
         )
+        resource_registry.set_contract_method(contract_method)
     else:
         logger.info(f"Transaction endpoint already exists, skipping creation.")
-        
+
+    # remember what we found for the next warm start
+    await resource_registry.save_snapshot()
+
+async def start_resources():
+    # on a warm start the registry is filled from the last run's snapshot and refreshed in the background
+    # we only fall back to resolving everything up front if there is no usable snapshot
+    with startup_phase("resources"):
+        warm = WARM_START and resource_registry.load_snapshot() and resource_registry.contract_method(SEPOLIA_CHAIN_ID, TOKEN_DEPLOYER_NAME) is not None
+        if warm:
+            logger.info("Warm start, using the resource snapshot and refreshing it in the background.")
+        else:
+            await resolve_resources()
+        # keep the registry up to date in the background, handlers also refresh it when they run into a stale id
+        resource_registry.start(refresh_now=warm)
+
+async def start_telegram():
+    # only the first worker needs to tell Telegram where to send updates, and only if the webhook isn't set up already
+    # TODO: use secret-token: https://docs.python-telegram-bot.org/en/stable/telegram.bot.html#telegram.Bot.set_webhook.params.secret_token
+    async def set_webhook():
+        with startup_phase("webhook"):
+            if shard_router.worker_index == 0:
+                await ensure_webhook(app.application.bot, f"{URL}/telegram", Update.ALL_TYPES)
+
+    async def initialize():
+        with startup_phase("initialize"):
+            await app.application.initialize()
+
+    await asyncio.gather(set_webhook(), initialize())
+
+async def start_local_state():
+    with startup_phase("local_state"):
+        # load the updates we accepted shortly before a restart, so redeliveries are still recognized
+        await dedup_index.start()
+        await chat_registry.start(app.application.bot)
+        # each worker has its own journal, it holds the updates for the chats it owns
+        await update_journal.start(shard_router.worker_index)
+
+# lifespane is used by FastAPI on startup and shutdown: https://fastapi.tiangolo.com/advanced/events/
+# When the server is shutting down, the code after "yield" will be executed when shutting down
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Lifespan event to initialize and shutdown the Telegram bot."""
+    startup_started = time.perf_counter()
+    # conversations and user_data are persisted to a local SQLite database so in-progress deployments survive restarts
+    # user_data is a compact Session record per user, idle ones expire and the oldest are evicted (see sessions.py)
+    # the update queue sheds load and pushes back on Telegram when handlers fall behind (see ingestqueue.py)
+    # updates are processed concurrently, but one chat's updates still run one at a time (see updateprocessor.py)
+    # outbound messages go through a scheduler that respects Telegram's flood limits (see sendscheduler.py)
+    app.application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .request(telegram_request())
+        .updater(None)
+        .update_queue(IngestQueue())
+        .concurrent_updates(PerChatUpdateProcessor())
+        .rate_limiter(SendScheduler())
+        .persistence(SQLitePersistence())
+        .application_class(LazyUserDataApplication)
+        .context_types(ContextTypes(user_data=Session))
+        .build()
+    )
+
+    # the user's session goes to the back of the line for eviction first, and is told when it expires once the
+    # conversations are done with the update (see sessions.py)
+    app.application.add_handler(TypeHandler(Update, touch_session), group=-2)
+    app.application.add_handler(TypeHandler(Update, track_session), group=1)
+
+    # before anything else, drop updates from users who are flooding us (see admission.py)
+    app.application.add_handler(TypeHandler(Update, check_admission), group=-1)
+
     # Here is where we register the functionality of our Telegram bot, starting with a ConversationHandler
     # You can nest conversation flows inside each other for more complex applications: https://docs.python-telegram-bot.org/en/stable/examples.nestedconversationbot.html
     entrypoint_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[CommandHandler("start", start), CommandHandler("mytokens", my_tokens_command)],
         states={
             ConversationState.START_ROUTES: [
                 CommandHandler("start", start),
                 get_token_deployment_conversation_handler(),
+                get_my_tokens_conversation_handler(start),
                 CallbackQueryHandler(start, pattern="^start$"),
             ],
         },
@@ -171,6 +319,8 @@ async def lifespan(app: FastAPI):
             CommandHandler("cancel", canceler)
         ],
         per_chat=True,
+        name="entrypoint",
+        persistent=True,
     )
 
     # handle when the user calls /start
@@ -179,45 +329,228 @@ async def lifespan(app: FastAPI):
     # handles updates from 1shot by selecting Telegram updates of type WebhookPayload
     app.application.add_handler(TypeHandler(type=WebhookPayload, callback=webhook_update))
 
+    # operators can look at and change the admission limits while the bot is running
+    if BOT_OPERATOR_IDS:
+        app.application.add_handler(CommandHandler("limits", limits_command, filters=filters.User(user_id=BOT_OPERATOR_IDS)))
+
     # track what chats the bot is in, can be useful for group-based features
     app.application.add_handler(ChatMemberHandler(track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
+    # and who administers them, so admin checks don't have to ask Telegram every time
+    app.application.add_handler(ChatMemberHandler(track_chat_admins, ChatMemberHandler.CHAT_MEMBER))
 
-    # TODO: use secret-token: https://docs.python-telegram-bot.org/en/stable/telegram.bot.html#telegram.Bot.set_webhook.params.secret_token
-    await app.application.bot.set_webhook(url=f"{URL}/telegram", allowed_updates=Update.ALL_TYPES)
-    await app.application.initialize()
+    # when running several workers, start accepting updates forwarded by the other workers
+    # this also decides which worker we are, so it goes before anything that depends on it
+    await shard_router.start(receive_forwarded_update)
+
+    # 1Shot API, Telegram and our local databases don't depend on each other, so they are set up concurrently
+    # and a restart only waits for the slowest of them; each phase logs how long it took
+    await asyncio.gather(start_resources(), start_telegram(), start_local_state())
     await app.application.start()
+    # updates we acknowledged before the last shutdown but never got to handle go first
+    await update_journal.replay(decode_update, app.application.update_queue.put)
+
+    # contract method executions queued by handlers are submitted to 1Shot API in the background (see submitter.py)
+    # and followed until their callback arrives; results of lost callbacks are put in the update queue (see reconciler.py)
+    await inflight_tracker.start(route_oneshot_update, shard_router.worker_index)
+    # each worker submits its own handlers' executions, the submissions database is shared
+    await transaction_submitter.start(app.application.bot, shard_router.worker_index)
+    await resume_airdrops(app.application, shard_router.worker_index)
+    await admission_control.start()
+    await tracer.start()
+    await session_store.start()
+    startup_phases["total"] = time.perf_counter() - startup_started
+    logger.info("Startup took %.0fms", startup_phases["total"] * 1000)
 
     yield
+    await shard_router.stop()
+    # uvicorn no longer takes requests, give the updates we acknowledged a moment to be handled
+    # whatever isn't by the deadline stays in the journal and is replayed on the next start
+    if not await update_journal.drain():
+        dropped = app.application.update_queue.clear()
+        logger.warning("Shutting down with %s updates unhandled (%s still queued), they will be replayed on restart", update_journal.pending, dropped)
+    await admission_control.stop()
+    await session_store.stop()
+    # before the submitter, what they haven't sent is sent after the restart
+    await stop_airdrops()
+    await transaction_submitter.stop()
+    await inflight_tracker.stop()
+    await dedup_index.stop()
+    await chat_registry.stop()
+    await resource_registry.stop()
     await app.application.stop()
+    await update_journal.stop()
+    await tracer.stop()
 
 # FastAPI app
 app = FastAPI(lifespan=lifespan)
+# time every request, see metrics.py
+app.add_middleware(MetricsMiddleware)
+
+# walk the registered handlers to find every ConversationHandler, including nested ones
+def iter_conversation_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield handler
+            yield from iter_conversation_handlers(
+                nested for state_handlers in handler.states.values() for nested in state_handlers
+            )
+
+def conversation_counts():
+    counts = {}
+    for handler in iter_conversation_handlers(handler for group in app.application.handlers.values() for handler in group):
+        for state in handler._conversations.values():
+            key = (handler.name, getattr(state, "name", str(state)))
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+# values that other parts of the bot already keep track of are read when /metrics is scraped
+metrics_registry.gauge_function("bot_update_queue_depth", "Updates queued or being handled, what admission to the update queue is based on.", lambda: app.application.update_queue.in_flight)
+metrics_registry.gauge_function("bot_update_queue_oldest_age_seconds", "How long the oldest queued update has been waiting.", lambda: app.application.update_queue.oldest_age)
+metrics_registry.counter_function("bot_updates_shed_total", "Low priority updates dropped because the update queue was backed up.", lambda: app.application.update_queue.shed)
+metrics_registry.counter_function("bot_updates_rejected_total", "Updates answered with 429 because the update queue was full.", lambda: app.application.update_queue.rejected)
+metrics_registry.counter_function("bot_updates_duplicate_total", "Redelivered updates that were dropped.", lambda: dedup_index.duplicates)
+metrics_registry.gauge_function("bot_dedup_index_size", "Update keys remembered for deduplication.", lambda: len(dedup_index))
+metrics_registry.counter_function("bot_telegram_sends_total", "Outbound Telegram requests that completed.", lambda: app.application.bot.rate_limiter.sends)
+metrics_registry.gauge_function("bot_telegram_send_queue_depth", "Outbound Telegram requests waiting for the global rate limit.", lambda: app.application.bot.rate_limiter.queue_depth)
+metrics_registry.counter_function("bot_telegram_send_retries_total", "Outbound Telegram requests retried after a flood limit.", lambda: app.application.bot.rate_limiter.retries)
+metrics_registry.counter_function("bot_telegram_send_backlogged_total", "Notifications that waited for room in the send backlog.", lambda: app.application.bot.rate_limiter.backlogged)
+metrics_registry.gauge_function("bot_submissions_pending", "Contract method executions waiting to be accepted by 1Shot API.", lambda: transaction_submitter.pending)
+metrics_registry.counter_function("bot_submissions_total", "Contract method executions accepted by 1Shot API.", lambda: transaction_submitter.submitted)
+metrics_registry.counter_function("bot_submission_retries_total", "Contract method executions retried after a transient failure.", lambda: transaction_submitter.retries)
+metrics_registry.counter_function("bot_submissions_failed_total", "Contract method executions that gave up.", lambda: transaction_submitter.failed)
+metrics_registry.gauge_function("bot_inflight_transactions", "Submitted transactions still waiting for their callback.", lambda: len(inflight_tracker))
+metrics_registry.gauge_function("bot_inflight_oldest_age_seconds", "How long the longest waiting transaction has been waiting for its callback.", lambda: inflight_tracker.oldest_age)
+metrics_registry.counter_function("bot_inflight_reconciled_total", "Transactions whose result was recovered by looking them up after the callback didn't come.", lambda: inflight_tracker.reconciled)
+metrics_registry.counter_function("bot_inflight_abandoned_total", "Transactions we stopped waiting for without learning their result.", lambda: inflight_tracker.abandoned)
+metrics_registry.gauge_function("bot_chats_tracked", "Chats the bot has been in.", lambda: len(chat_registry))
+metrics_registry.gauge_function("bot_groups", "Groups and channels the bot is currently in.", lambda: len(chat_registry.groups()))
+metrics_registry.gauge_function("bot_http_client_in_flight", "Outbound HTTP requests in flight, by client and host.", requests_in_flight, ["client", "host"])
+metrics_registry.gauge_function("bot_startup_phase_seconds", "How long each phase of the last startup took.", lambda: {(phase,): seconds for phase, seconds in startup_phases.items()}, ["phase"])
+metrics_registry.counter_function("bot_admission_rejected_total", "Updates and transactions turned away because the user was over their limit, by action class.", lambda: {(action.value,): count for action, count in admission_control.rejected.items()}, ["action"])
+metrics_registry.gauge_function("bot_admission_buckets", "Users with a token bucket that isn't full, by action class.", lambda: {(action.value,): admission_control.buckets(action) for action in admission_control.limits}, ["action"])
+metrics_registry.gauge_function("bot_admission_rate", "Tokens per second added to each user's bucket, by action class.", lambda: {(action.value,): limit.rate for action, limit in admission_control.limits.items()}, ["action"])
+metrics_registry.gauge_function("bot_admission_burst", "Size of each user's bucket, by action class.", lambda: {(action.value,): limit.burst for action, limit in admission_control.limits.items()}, ["action"])
+metrics_registry.gauge_function("bot_sessions", "Users whose session (user_data) is in memory.", lambda: len(session_store))
+metrics_registry.gauge_function("bot_session_bytes", "Estimated memory taken by the sessions in memory.", lambda: session_store.bytes)
+metrics_registry.counter_function("bot_sessions_expired_total", "Sessions forgotten because their user was idle for too long.", lambda: session_store.expired)
+metrics_registry.counter_function("bot_sessions_evicted_total", "Sessions forgotten to stay under the session memory limit.", lambda: session_store.evicted)
+metrics_registry.counter_function("bot_trace_spans_dropped_total", "Spans dropped because the export couldn't keep up.", lambda: tracer.dropped)
+metrics_registry.gauge_function("bot_journal_pending", "Acknowledged updates that haven't been handled yet.", lambda: update_journal.pending)
+metrics_registry.counter_function("bot_journal_appends_total", "Updates written to the journal.", lambda: update_journal.appended)
+metrics_registry.counter_function("bot_journal_commits_total", "Journal writes (each one fsync), appends per commit shows how well they are grouped.", lambda: update_journal.commits)
+metrics_registry.counter_function("bot_journal_replayed_total", "Updates replayed from the journal on startup.", lambda: update_journal.replayed)
+metrics_registry.gauge_function("bot_log_queue_depth", "Log records waiting to be written.", log_queue_depth)
+metrics_registry.counter_function("bot_log_records_dropped_total", "Log records that were not written, by reason.", lambda: {(reason,): count for reason, count in log_drops.items()}, ["reason"])
+metrics_registry.gauge_function("bot_conversations", "Conversations currently in each state.", conversation_counts, ["conversation", "state"])
+
+# Every update ends up here on the worker that owns its chat, either straight from a webhook route or
+# forwarded by another worker (see sharding.py)
+async def enqueue_update(update: object, body: Optional[bytes] = None) -> int:
+    """Put an update into the Application's update queue and return the HTTP status to answer with, body is its JSON if we have it."""
+    # when the queue is backed up, low value updates are shed and chat updates are pushed back to Telegram
+    rejection = app.application.update_queue.admit(update_priority(update))
+    if rejection is not None:
+        return rejection
+    # redelivered updates are acknowledged right away and never reach the handlers
+    dedup_key = update_dedup_key(update)
+    # a result the reconciler looked up is also a duplicate of the real callback, if that beat it here
+    if is_reconciled(update) and dedup_index.contains(callback_dedup_key(update)):
+        logger.info("Dropping reconciled update %s, its callback already arrived", dedup_key)
+        return HTTPStatus.OK
+    if dedup_key is not None and dedup_index.seen_before(dedup_key):
+        logger.info("Dropping duplicate update %s", dedup_key)
+        return HTTPStatus.OK
+    # once we answer 200 nobody will send the update again, so it has to be on disk first (see journal.py)
+    try:
+        await update_journal.append(update, body)
+    except Exception as e:
+        logger.error("Failed to journal update, asking for it to be sent again: %s", e)
+        if dedup_key is not None:
+            dedup_index.forget(dedup_key)
+        return HTTPStatus.SERVICE_UNAVAILABLE
+    tracer.attach(update)
+    await app.application.update_queue.put(update)
+    return HTTPStatus.OK
+
+# Updates forwarded from other workers arrive as the raw body bytes of the original webhook
+async def receive_forwarded_update(kind: UpdateKind, body: bytes) -> int:
+    return await enqueue_update(decode_update(kind, body), body)
+
+# forwarded and journaled updates are kept as the JSON they arrived as
+def decode_update(kind: UpdateKind, body: bytes) -> object:
+    if kind == UpdateKind.TELEGRAM:
+        return Update.de_json(json_loads(body), app.application.bot)
+    return WebhookPayload.model_validate_json(body)
 
 # This route is for Telegram to send Updates to the bot about message and interactions from users
 # Its more efficient that using long polling
 @app.post("/telegram")
 async def telegram(request: Request):
-    data = await request.json()
+    tracer.mark("received")
+    body = await request.body()
+    data = json_loads(body)
+    routing_key = telegram_routing_key(data)
+    if not shard_router.is_local(routing_key):
+        status = await shard_router.forward(routing_key, UpdateKind.TELEGRAM, body)
+        return Response(status_code=status)
     update = Update.de_json(data, app.application.bot)
-    await app.application.update_queue.put(update)
-    return Response(status_code=HTTPStatus.OK)
+    return Response(status_code=await enqueue_update(update, body))
 
 # This route is for 1shot to send updates to the bot about transactions that the bot initiated
 # check out the webhookAuthenticator class in helpers.py for how to verify the signature
-# https://fastapi.tiangolo.com/tutorial/dependencies/dependencies-in-path-operation-decorators/
-@app.api_route("/1shot", methods=["POST"], dependencies=[Depends(webhookAuthenticator())])
-async def oneshot_updates(request: Request):
+# the authenticator parses and verifies the body once and hands us the validated WebhookPayload
+# https://fastapi.tiangolo.com/tutorial/dependencies/
+oneshot_authenticator = webhookAuthenticator()
+
+# times the authenticator, so a traced transaction's callback shows how long reading and verifying it took
+async def traced_authenticator(request: Request) -> WebhookPayload:
+    tracer.mark("received")
+    webhook_payload = await oneshot_authenticator(request)
+    tracer.mark("verified")
+    return webhook_payload
+
+@app.api_route("/1shot", methods=["POST"])
+async def oneshot_updates(webhook_payload: WebhookPayload = Depends(traced_authenticator)):
+    return Response(status_code=await route_oneshot_update(webhook_payload))
+
+# 1Shot API callbacks, and the results the reconciler looked up itself, go to the worker that owns the user's chat,
+# so they pass its dedup index and a late real callback isn't handled twice
+async def route_oneshot_update(webhook_payload: WebhookPayload) -> int:
+    routing_key = oneshot_routing_key(webhook_payload)
+    if not shard_router.is_local(routing_key):
+        body = webhook_payload.model_dump_json(by_alias=True).encode()
+        return await shard_router.forward(routing_key, UpdateKind.ONESHOT, body)
     # we put objects of type WebhookPayload into the update queue
     # Updates will trigger the webhook_update handler via the TypeHandler registered on startup
-    body = await request.json()
-    webhook_payload = WebhookPayload(**body)
-    await app.application.update_queue.put(webhook_payload)
-    return Response(status_code=HTTPStatus.OK)
+    return await enqueue_update(webhook_payload)
 
-# This is a simple healthcheck endpoint to verify that the bot is running
+# Prometheus scrapes this endpoint for the bot's metrics
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+# Where the time of a traced token deployment goes, stage by stage (see tracing.py)
+@app.get("/traces/summary")
+async def traces_summary():
+    return JSONResponse(tracer.summary())
+
+# This is a readiness check: it fails while the bot is too far behind on updates to take more traffic
 @app.get("/healthcheck")
 async def health():
-    return PlainTextResponse("The bot is still running fine :)", status_code=HTTPStatus.OK)
+    update_queue = app.application.update_queue
+    ready = not update_queue.shedding and update_queue.in_flight < update_queue.limit
+    return JSONResponse(
+        {
+            "status": "ready" if ready else "overloaded",
+            "queue_depth": update_queue.qsize(),
+            "updates_in_flight": update_queue.in_flight,
+            "oldest_update_age_seconds": round(update_queue.oldest_age, 3),
+            "last_update_wait_seconds": round(update_queue.last_wait, 3),
+            "shed_updates": update_queue.shed,
+            "rejected_updates": update_queue.rejected,
+        },
+        status_code=HTTPStatus.OK if ready else HTTPStatus.SERVICE_UNAVAILABLE,
+    )
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=PORT, log_level="info")
@@ -0,0 +1,71 @@
+import os
+import time
+import uuid
+import logging
+from typing import Optional
+
+from helpers import data_path
+from persistence import connect_sqlite
+from objects import TransactionMemo, TokenInfo
+
+logger = logging.getLogger(__name__)
+
+# memos longer than this many characters keep their payload in the local store and only carry its key;
+# set it to 0 to always put the payload inline
+MEMO_INLINE_LIMIT = int(os.getenv("MEMO_INLINE_LIMIT", "512"))
+MEMO_STORE_PATH = os.getenv("MEMO_STORE_PATH", data_path("memos.sqlite3"))
+# how long (in seconds) a stored payload is kept, it's only needed until the transaction's callback is handled
+MEMO_STORE_RETENTION = float(os.getenv("MEMO_STORE_RETENTION", str(30 * 24 * 3600)))
+
+# Large memo payloads (long token descriptions, say) live here, keyed by a short id that goes into the memo.
+# Lookups are single-row reads by primary key, cheap enough to do on the event loop.
+class MemoPayloadStore:
+    def __init__(self, path: str = MEMO_STORE_PATH, retention: float = MEMO_STORE_RETENTION):
+        self._path = path
+        self._retention = retention
+        self._connection = None
+        self._last_prune = 0.0
+
+    def _db(self):
+        # opened on first use, most deployments never need it
+        if self._connection is None:
+            self._connection = connect_sqlite(self._path)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS payloads (key TEXT PRIMARY KEY, payload TEXT NOT NULL, created REAL NOT NULL)"
+            )
+        return self._connection
+
+    def put(self, payload: str) -> str:
+        """Store a serialized payload and return its key."""
+        key = uuid.uuid4().hex[:16]
+        now = time.time()
+        self._db().execute("INSERT INTO payloads (key, payload, created) VALUES (?, ?, ?)", (key, payload, now))
+        if now - self._last_prune > 3600:
+            self._last_prune = now
+            self._db().execute("DELETE FROM payloads WHERE created < ?", (now - self._retention,))
+        return key
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._db().execute("SELECT payload FROM payloads WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+memo_payload_store = MemoPayloadStore()
+
+def encode_memo(memo: TransactionMemo, inline_limit: int = MEMO_INLINE_LIMIT) -> str:
+    """Serialize a memo, moving its payload to the memo store if the memo would be too long."""
+    encoded = memo.encode()
+    if not inline_limit or len(encoded) <= inline_limit or memo.payload is None:
+        return encoded
+    key = memo_payload_store.put(memo.payload.model_dump_json(by_alias=True, exclude_none=True))
+    return memo.model_copy(update={"payload": None, "payload_ref": key}).encode()
+
+def decode_memo(raw: str) -> TransactionMemo:
+    """Parse a memo, loading its payload from the memo store if it was stored by reference."""
+    memo = TransactionMemo.decode(raw)
+    if memo.payload is None and memo.payload_ref is not None:
+        payload = memo_payload_store.get(memo.payload_ref)
+        if payload is None:
+            logger.error("Memo payload %s is missing from the memo store", memo.payload_ref)
+        else:
+            memo.payload = TokenInfo.model_validate_json(payload)
+    return memo
@@ -0,0 +1,254 @@
+import abc
+import time
+import functools
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# A tiny Prometheus-style metrics library, rendered in the text exposition format on /metrics:
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+# Everything runs on the event loop thread, so metrics are plain counters without locks. Each label combination
+# gets its bucket array allocated once, the first time it's used; after that an observation is a bisect and two adds.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class _Metric(abc.ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    @abc.abstractmethod
+    def render(self) -> List[str]:
+        """The lines of this metric in the exposition format, HELP and TYPE included."""
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: Any, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self._buckets = tuple(buckets)
+        # label values -> [count per bucket (the last one is +Inf), sum, count]
+        self._series: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, *labels: Any) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self._buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *labels: Any) -> Callable:
+        """Decorate an async function to observe how long each call takes."""
+        def decorator(function: Callable) -> Callable:
+            @functools.wraps(function)
+            async def wrapper(*args: Any, **kwargs: Any) -> Any:
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, *labels)
+            return wrapper
+        return decorator
+
+    def quantile(self, q: float, *labels: Any) -> Optional[float]:
+        """Estimate a quantile from the buckets, the way Prometheus' histogram_quantile does."""
+        series = self._series.get(labels)
+        if series is None or series[2] == 0:
+            return None
+        rank = q * series[2]
+        cumulative = 0
+        lower = 0.0
+        for index, count in enumerate(series[0]):
+            if index == len(self._buckets):
+                # the value is above the largest bucket, the best we can say is "at least the largest bound"
+                return lower
+            upper = self._buckets[index]
+            if count and cumulative + count >= rank:
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = upper
+        return lower
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _format_labels(self.label_names, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+        return lines
+
+# a metric whose value is read when /metrics is scraped, for things that are already counted somewhere else
+# the function returns either a single number or a dict of label values -> number
+class CallbackMetric(_Metric):
+    def __init__(self, name: str, documentation: str, function: Callable[[], Union[float, Dict[LabelValues, float]]], labels: Sequence[str] = (), type: str = "gauge"):
+        super().__init__(name, documentation, labels)
+        self.type = type
+        self._function = function
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        try:
+            value = self._function()
+        except Exception:
+            # the thing we read from may not exist yet, e.g. before the Application is built
+            return []
+        if isinstance(value, dict):
+            for labels, labelled_value in value.items():
+                lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(labelled_value)}")
+        else:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> Any:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge_function(self, name: str, documentation: str, function: Callable, labels: Sequence[str] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, function, labels, type="gauge"))
+
+    def counter_function(self, name: str, documentation: str, function: Callable, labels: Sequence[str] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, function, labels, type="counter"))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# the registry /metrics renders, and the metrics shared between modules
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram(
+    "bot_http_request_duration_seconds", "Time spent answering HTTP requests.", ["route", "status"]
+)
+handler_duration = registry.histogram(
+    "bot_handler_duration_seconds", "Time spent in each update handler.", ["handler"]
+)
+oneshot_request_duration = registry.histogram(
+    "bot_oneshot_api_request_duration_seconds", "Latency of 1Shot API calls.", ["method", "outcome"]
+)
+telegram_send_duration = registry.histogram(
+    "bot_telegram_send_duration_seconds", "Time from asking to send a Telegram Bot API request until it completes, including rate limiting.", ["endpoint"]
+)
+oneshot_webhooks = registry.counter(
+    "bot_oneshot_webhooks_total", "1Shot API callbacks handled, by event name and transaction type.", ["event_name", "tx_type"]
+)
+oneshot_webhooks_unhandled = registry.counter(
+    "bot_oneshot_webhooks_unhandled_total", "1Shot API callbacks no handler was registered for, by event name and transaction type.", ["event_name", "tx_type"]
+)
+
+# outbound HTTP, recorded by the transport in transport.py; waiting for a connection is usually well under a millisecond
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+http_client_request_duration = registry.histogram(
+    "bot_http_client_request_duration_seconds", "Latency of outbound HTTP requests, including waiting for a connection.", ["client", "host", "status"]
+)
+http_client_pool_wait = registry.histogram(
+    "bot_http_client_pool_wait_seconds", "Time outbound HTTP requests waited for a connection.", ["client", "host"], POOL_WAIT_BUCKETS
+)
+http_client_requests = registry.counter(
+    "bot_http_client_requests_total", "Outbound HTTP requests, by whether they reused a kept-alive connection or opened a new one.", ["client", "host", "connection"]
+)
+
+def instrument_handler(function: Callable) -> Callable:
+    """Decorate a python-telegram-bot handler callback to record its latency under its function name."""
+    return handler_duration.time(function.__name__)(function)
+
+def _timed_oneshot_method(method: Callable, label: str) -> Callable:
+    @functools.wraps(method)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await method(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            oneshot_request_duration.observe(time.perf_counter() - started, label, outcome)
+    return wrapper
+
+# wraps the methods of the 1Shot client's categories (wallets.list, contract_methods.execute, ...) with timing
+def instrument_oneshot_client(client: Any, methods: Dict[str, Sequence[str]]) -> None:
+    """Record the latency of the given 1Shot client methods, e.g. {"wallets": ["list"]}."""
+    for category_name, method_names in methods.items():
+        category = getattr(client, category_name)
+        for method_name in method_names:
+            method = getattr(category, method_name)
+            setattr(category, method_name, _timed_oneshot_method(method, f"{category_name}.{method_name}"))
+
+# A plain ASGI middleware (cheaper than FastAPI's @app.middleware) that times every request by route template
+class MetricsMiddleware:
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # routing fills in scope["route"], using its path keeps the label set small
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - started, getattr(route, "path", "unmatched"), status[0]
+            )
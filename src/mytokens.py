@@ -0,0 +1,137 @@
+import os
+import html
+import logging
+from typing import Callable
+
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup
+)
+from telegram.ext import (
+    ContextTypes,
+    ConversationHandler,
+    CommandHandler,
+    CallbackQueryHandler
+)
+from telegram.constants import ParseMode
+
+from helpers import canceler
+from metrics import instrument_handler
+from objects import ConversationState
+from tokenregistry import token_registry
+from airdrop import get_airdrop_conversation_handler
+
+logger = logging.getLogger(__name__)
+
+# how many tokens are shown per page of /mytokens
+MY_TOKENS_PAGE_SIZE = int(os.getenv("MY_TOKENS_PAGE_SIZE", "5"))
+
+# callback data: "mytokens" is the first page, "mytokens:<id>" the page after the token with that id, "token:<id>" one token
+MY_TOKENS_PATTERN = r"^mytokens(:\d+)?$"
+TOKEN_PATTERN = r"^token:\d+$"
+
+async def _reply(update: Update, text: str, keyboard: InlineKeyboardMarkup) -> None:
+    # buttons edit the message they're on, the /mytokens command gets a new one
+    if update.callback_query:
+        await update.callback_query.answer()
+        await update.callback_query.edit_message_text(text=text, reply_markup=keyboard, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    else:
+        await update.message.reply_text(text=text, reply_markup=keyboard, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+
+@instrument_handler
+async def list_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Show a page of the tokens the user deployed, newest first."""
+    data = update.callback_query.data if update.callback_query else ""
+    before = int(data.split(":")[1]) if ":" in data else None
+    # the page is read straight from the token registry's owner index, no 1Shot API call needed
+    tokens, next_cursor = token_registry.page(update.effective_user.id, before=before, limit=MY_TOKENS_PAGE_SIZE)
+
+    # the Back button goes to the main menu, which then edits this message
+    context.user_data.start_over = True
+
+    buttons = [[InlineKeyboardButton(f"{token.name} ({token.ticker})", callback_data=f"token:{token.id}")] for token in tokens]
+    navigation = []
+    if before is not None:
+        navigation.append(InlineKeyboardButton("⏮ Newest", callback_data="mytokens"))
+    if next_cursor is not None:
+        navigation.append(InlineKeyboardButton("Older ➡️", callback_data=f"mytokens:{next_cursor}"))
+    if navigation:
+        buttons.append(navigation)
+    buttons.append([InlineKeyboardButton("Back", callback_data="start")])
+
+    if tokens:
+        text = "<b>Your tokens</b>\n\nPick one to see its details."
+    elif before is None:
+        text = "You haven't deployed any tokens yet."
+    else:
+        text = "No older tokens."
+    await _reply(update, text, InlineKeyboardMarkup(buttons))
+    return ConversationState.GET_TOKENS
+
+@instrument_handler
+async def show_token(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Show the details of one of the user's tokens."""
+    token = token_registry.get(int(update.callback_query.data.split(":")[1]))
+    # callback data comes from the client, don't show other people's tokens
+    if token is None or token.owner_id != update.effective_user.id:
+        await update.callback_query.answer("Token not found.")
+        return ConversationState.GET_TOKENS
+
+    text = (
+        f"<b>Name:</b> {html.escape(token.name)}\n"
+        f"<b>Ticker:</b> {html.escape(token.ticker)}\n"
+        f"<b>Description:</b> {html.escape(token.description)}\n"
+    )
+    if token.address:
+        text += f"<b>Address:</b> <a href='https://sepolia.etherscan.io/token/{token.address}'>{token.address}</a>\n"
+    else:
+        text += "<b>Address:</b> not known yet\n"
+
+    buttons = [
+        [InlineKeyboardButton("Back to my tokens", callback_data="mytokens")],
+        [InlineKeyboardButton("Menu", callback_data="start")],
+    ]
+    # the tokens were preminted to the escrow wallet, they can be airdropped once we know where the token lives
+    if token.address:
+        buttons.insert(0, [InlineKeyboardButton("🪂 Airdrop", callback_data=f"airdrop:{token.id}")])
+    await _reply(update, text, InlineKeyboardMarkup(buttons))
+    return ConversationState.MANAGE_TOKEN
+
+@instrument_handler
+async def my_tokens_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handle /mytokens from a user who isn't in a conversation yet."""
+    # the buttons on the list are picked up by the entry points of the conversation below
+    await list_tokens(update, context)
+    return ConversationState.START_ROUTES
+
+def get_my_tokens_conversation_handler(menu: Callable) -> ConversationHandler:
+    """Create and return the conversation handler for browsing the user's tokens, menu shows the main menu."""
+    return ConversationHandler(
+        entry_points=[
+            CallbackQueryHandler(list_tokens, pattern=MY_TOKENS_PATTERN),
+            CallbackQueryHandler(show_token, pattern=TOKEN_PATTERN),
+            CommandHandler("mytokens", list_tokens),
+        ],
+        states={
+            ConversationState.GET_TOKENS: [
+                CallbackQueryHandler(show_token, pattern=TOKEN_PATTERN),
+                CallbackQueryHandler(list_tokens, pattern=MY_TOKENS_PATTERN),
+            ],
+            ConversationState.MANAGE_TOKEN: [
+                CallbackQueryHandler(list_tokens, pattern=MY_TOKENS_PATTERN),
+                get_airdrop_conversation_handler(),
+            ],
+        },
+        fallbacks=[
+            CallbackQueryHandler(menu, pattern="^start$"),
+            CommandHandler("mytokens", list_tokens),
+            CommandHandler("cancel", canceler),
+        ],
+        map_to_parent={
+            ConversationState.START_ROUTES: ConversationState.START_ROUTES,
+            ConversationHandler.END: ConversationHandler.END
+        },
+        name="mytokens",
+        persistent=True,
+    )
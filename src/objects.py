@@ -1,7 +1,7 @@
 import os
 
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field, ValidationInfo, field_validator, model_validator
+from typing import Any, Optional
 
 from enum import Enum
 
@@ -15,18 +15,61 @@ class TxType(Enum):
     TOKENS_MINTED = 2
     TOKENS_TRANSFERRED = 3
 
+# we'll use this to store token information so we can send the user a message when the token is created
+# the short aliases are what goes into the memo, the long names still work in code and in old memos
+class TokenInfo(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    name: str = Field(..., alias="n", description="The name of the token.")
+    ticker: str = Field(..., alias="s", description="The ticker symbol for the token.")
+    description: str = Field(..., alias="d", description="A description of the token.")
+    image_file_id: str = Field(..., alias="i", description="The file id of the token image.")
+
+# the memo format we write; memos without a version are from before the compact format
+MEMO_VERSION = 2
+
 # use the memo field when you execute a transaction to include context on the callback to your bot
+# memos are written with short keys and without empty fields to stay well inside the memo size limit, e.g.
+#   {"v":2,"t":0,"u":12345,"p":{"n":"My Token","s":"MTK","d":"...","i":"AgAC..."},"k":"9f1c..."}
+# and the nested payload is a typed model, so a memo is decoded in a single pass
 class TransactionMemo(BaseModel):
-    tx_type: TxType = Field(..., description="The kind of transaction that was executed.") 
-    associated_user_id: int = Field(..., description="The user id of the user that executed the transaction.")
-    note_to_user: Optional[str] = Field(None, description="Arbitrary info to relay to the associated_user")
+    model_config = ConfigDict(populate_by_name=True)
 
-# we'll use this to store token information so we can send the user a message when the token is created
-class TokenInfo(BaseModel):
-    name: str = Field(..., description="The name of the token.")
-    ticker: str = Field(..., description="The ticker symbol for the token.")
-    description: str = Field(..., description="A description of the token.")
-    image_file_id: str = Field(..., description="The file id of the token image.")
+    version: int = Field(MEMO_VERSION, alias="v", description="The memo format version.")
+    tx_type: TxType = Field(..., alias="t", description="The kind of transaction that was executed.")
+    associated_user_id: int = Field(..., alias="u", description="The user id of the user that executed the transaction.")
+    payload: Optional[TokenInfo] = Field(None, alias="p", description="Details of the transaction, depending on tx_type.")
+    payload_ref: Optional[str] = Field(None, alias="r", description="The key of a payload kept in the local memo store instead of inline.")
+    note_to_user: Optional[str] = Field(None, alias="m", description="Arbitrary info to relay to the associated_user")
+    idempotency_key: Optional[str] = Field(None, alias="k", description="Identifies the submission, so a retried execution isn't executed twice.")
+    trace_id: Optional[str] = Field(None, alias="x", description="The trace the transaction is part of, so its callback joins it.")
+
+    @field_validator("payload", mode="before")
+    @classmethod
+    def _parse_legacy_payload(cls, value: Any) -> Any:
+        # a version 1 payload is still a JSON string at this point
+        return TokenInfo.model_validate_json(value) if isinstance(value, str) else value
+
+    @model_validator(mode="before")
+    @classmethod
+    def _upgrade_legacy(cls, data: Any, info: ValidationInfo) -> Any:
+        # the original format had no version, spelled out every field name and carried the TokenInfo
+        # as a JSON string inside note_to_user; only memos being decoded can be in that format
+        if not (info.context or {}).get("decoding") or not isinstance(data, dict) or "v" in data:
+            return data
+        data = {**data, "version": 1}
+        if data.get("note_to_user") and data.get("tx_type") == TxType.TOKEN_CREATION.value and not data.get("payload"):
+            data["payload"] = data.pop("note_to_user")
+        return data
+
+    def encode(self) -> str:
+        """Serialize the memo in the compact format."""
+        return self.model_dump_json(by_alias=True, exclude_none=True)
+
+    @classmethod
+    def decode(cls, memo: str) -> "TransactionMemo":
+        """Parse a memo in either the compact or the original format."""
+        return cls.model_validate_json(memo, context={"decoding": True})
 
 # user enums to define the different states of your Telegram bot conversation flows
 class ConversationState(Enum):
@@ -2,12 +2,26 @@ import os
 
 from uxly_1shot_client import AsyncClient
 
+from metrics import instrument_oneshot_client
+from transport import oneshot_http_client
+
 # its handy to set your API key and secret with environment variables so you only have to change them in one place (i.e. docker-compose.env)
 API_KEY = os.getenv("ONESHOT_API_KEY")
 API_SECRET = os.getenv("ONESHOT_API_SECRET")
 BUSINESS_ID = os.getenv("ONESHOT_BUSINESS_ID") 
+# point this somewhere else to run the bot against a stand-in 1Shot API, e.g. for the benchmarks in /bench
+API_URL = os.getenv("ONESHOT_API_URL", "https://api.1shotapi.com/v0")
 
 # import the the 1Shot API async client with your API key and secret from your 1Shot Org (https://docs.1shotapi.com/org-creation.html)  
 # its handy to instantiate it in a single location and import the singleton where you need it  
 # be sure to use the AsyncClient with asynchronous frameworks like FastAPI and python-telegram-bot       
-oneshot_client = AsyncClient(api_key=API_KEY, api_secret=API_SECRET)
\ No newline at end of file
+oneshot_client = AsyncClient(api_key=API_KEY, api_secret=API_SECRET, base_url=API_URL)
+# the client creates a default httpx client on first use unless it already has one, we give it our tuned and instrumented one (see transport.py)
+oneshot_client._client = oneshot_http_client()
+
+# record how long each 1Shot API call we make takes, these show up on the bot's /metrics endpoint
+instrument_oneshot_client(oneshot_client, {
+    "wallets": ["list"],
+    "contract_methods": ["list", "get", "create", "execute"],
+    "transactions": ["list", "get"],
+})
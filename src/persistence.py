@@ -0,0 +1,191 @@
+import os
+import json
+import pickle
+import sqlite3
+import asyncio
+import logging
+import threading
+from types import MappingProxyType
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.ext import Application, BasePersistence, PersistenceInput
+
+from helpers import data_path
+from sessions import session_store
+
+logger = logging.getLogger(__name__)
+
+# where conversations are stored and how often (in seconds) changed conversations are written to disk
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", data_path("conversations.sqlite3"))
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "5"))
+
+# WAL mode lets the event loop read while a background thread writes, and synchronous=NORMAL
+# only syncs at checkpoints which is plenty for bot state
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """Open a SQLite database in WAL mode that can be shared with a writer thread."""
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    # several workers may share a database, wait for their writes instead of failing
+    connection.execute("PRAGMA busy_timeout=5000")
+    return connection
+
+# Persists user_data and ConversationHandler states in a local SQLite database so in-progress token
+# deployments survive restarts. python-telegram-bot already tracks which users and conversations changed
+# and hands them to us every update_interval seconds; we collect them and write the whole batch in a
+# single transaction on a background thread (write-behind) instead of writing once per update.
+# user_data is not loaded on startup; the session store (see sessions.py) pulls a user's row the first time it's used.
+class SQLitePersistence(BasePersistence):
+    def __init__(self, path: str = PERSISTENCE_PATH, update_interval: float = PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._reader = connect_sqlite(path)
+        self._writer = connect_sqlite(path)
+        self._writer.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key)
+            );
+            """
+        )
+        self._write_lock = threading.Lock()
+        # dirty entries waiting for the next write, None means delete
+        self._pending_users: Dict[int, Optional[Any]] = {}
+        self._pending_conversations: Dict[Tuple[str, str], Optional[object]] = {}
+        # the users being written right now, still read from here until their transaction commits
+        self._writing_users: Dict[int, Optional[Any]] = {}
+        self._write_task: Optional[asyncio.Task] = None
+
+    def load_user_data(self, user_id: int) -> Optional[Any]:
+        """Read a single user's data, None if we have nothing stored for them."""
+        if user_id in self._pending_users:
+            return self._pending_users[user_id]
+        if user_id in self._writing_users:
+            return self._writing_users[user_id]
+        row = self._reader.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _write(self, users: Dict[int, Optional[Any]], conversations: Dict[Tuple[str, str], Optional[object]]) -> None:
+        with self._write_lock:
+            self._writer.execute("BEGIN")
+            try:
+                for user_id, data in users.items():
+                    if data is None:
+                        self._writer.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+                    else:
+                        self._writer.execute(
+                            "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                            (user_id, pickle.dumps(data)),
+                        )
+                for (name, key), state in conversations.items():
+                    if state is None:
+                        self._writer.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+                    else:
+                        self._writer.execute(
+                            "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                            (name, key, pickle.dumps(state)),
+                        )
+                self._writer.execute("COMMIT")
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+
+    async def _write_pending(self) -> None:
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not users and not conversations:
+            return
+        self._writing_users = users
+        try:
+            await asyncio.to_thread(self._write, users, conversations)
+        except Exception:
+            # write them with the next batch, changes made since then are newer
+            self._pending_users = {**users, **self._pending_users}
+            self._pending_conversations = {**conversations, **self._pending_conversations}
+            raise
+        finally:
+            self._writing_users = {}
+        logger.debug("Persisted %s users and %s conversations", len(users), len(conversations))
+
+    async def _write_in_background(self) -> None:
+        # nobody awaits this task, so a failure is logged here; the entries are kept for the next write
+        try:
+            await self._write_pending()
+        except Exception as e:
+            logger.error("Failed to persist user data and conversations, will try again with the next change: %s", e)
+
+    def _schedule_write(self) -> None:
+        # the Application hands us all changed entries at once, so a task scheduled by the first
+        # one runs after the rest have been queued and writes them in one transaction
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_in_background())
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        # user_data is loaded lazily per user, see LazyUserDataApplication
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Any:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+        # finished conversations are deleted, so this only holds conversations that are still in progress
+        rows = self._reader.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        self._pending_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
+
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        self._pending_users[user_id] = data
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Write everything that is still pending, called by the Application on shutdown."""
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_pending()
+        self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+# an Application whose user_data is the session store, filled on demand so startup doesn't have to read every user
+# we've ever seen; pass it to Application.builder().application_class() together with a SQLitePersistence
+class LazyUserDataApplication(Application):
+    def __init__(self, *, persistence: Optional[BasePersistence], **kwargs: Any):
+        super().__init__(persistence=persistence, **kwargs)
+        session_store.attach(self, persistence.load_user_data if isinstance(persistence, SQLitePersistence) else None)
+        self._user_data = session_store
+        self.user_data = MappingProxyType(session_store)
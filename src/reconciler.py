@@ -0,0 +1,240 @@
+import os
+import time
+import asyncio
+import logging
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from uxly_1shot_client import WebhookPayload
+from uxly_1shot_client.models.transaction import Transaction
+
+from helpers import data_path
+from persistence import connect_sqlite
+
+from oneshot import (
+    oneshot_client,
+    BUSINESS_ID
+)
+
+logger = logging.getLogger(__name__)
+
+# how long (in seconds) we wait for a callback before asking 1Shot API ourselves, how often we check,
+# how many transactions we look up at once, and when we stop waiting altogether
+INFLIGHT_STALE_AFTER = float(os.getenv("INFLIGHT_STALE_AFTER", "300"))
+INFLIGHT_CHECK_INTERVAL = float(os.getenv("INFLIGHT_CHECK_INTERVAL", "60"))
+INFLIGHT_BATCH_SIZE = int(os.getenv("INFLIGHT_BATCH_SIZE", "25"))
+INFLIGHT_GIVE_UP_AFTER = float(os.getenv("INFLIGHT_GIVE_UP_AFTER", str(24 * 3600)))
+INFLIGHT_PATH = os.getenv("INFLIGHT_PATH", data_path("inflight.sqlite3"))
+INFLIGHT_FLUSH_INTERVAL = float(os.getenv("INFLIGHT_FLUSH_INTERVAL", "2"))
+
+# the webhook events 1Shot API sends when a transaction execution finishes, by the status of the transaction
+SUCCESS_EVENT = "TransactionExecutionSuccess"
+FAILURE_EVENT = "TransactionExecutionFailure"
+FINAL_STATUSES = {"Completed": SUCCESS_EVENT, "Failed": FAILURE_EVENT}
+
+def synthesize_webhook_payload(transaction: Transaction, memo: Optional[str]) -> WebhookPayload:
+    """Build the callback 1Shot API would have sent for a finished transaction we looked up ourselves."""
+    # the Transaction we get back has no receipt or logs, so handlers must cope without them; the empty signature is
+    # what tells it apart from a real callback
+    return WebhookPayload(
+        eventName=FINAL_STATUSES[transaction.status],
+        data={
+            "businessId": BUSINESS_ID,
+            "chain": transaction.chain_id,
+            "logs": None,
+            "transactionExecutionId": transaction.id,
+            "transactionExecutionMemo": memo if memo is not None else transaction.memo,
+            "transactionId": transaction.contract_method_id,
+        },
+        timestamp=int(time.time()),
+        apiVersion=0,
+        signature="",
+    )
+
+# Remembers every transaction execution we started until its callback arrives. If a callback doesn't come
+# (the tunnel was down, we were restarting, the signature check failed), the reconciler asks 1Shot API for the
+# status of the stale ones, a batch at a time, and feeds what it finds into the update queue as if the callback
+# had arrived, so webhook_update handles it the usual way (a late real callback only reaches the handlers that need
+# its logs, see dedup.py).
+# All workers share the database, each one only follows the transactions it started.
+class InflightTracker:
+    def __init__(
+        self,
+        stale_after: float = INFLIGHT_STALE_AFTER,
+        check_interval: float = INFLIGHT_CHECK_INTERVAL,
+        batch_size: int = INFLIGHT_BATCH_SIZE,
+        give_up_after: float = INFLIGHT_GIVE_UP_AFTER,
+        path: Optional[str] = INFLIGHT_PATH,
+    ):
+        self._stale_after = stale_after
+        self._check_interval = check_interval
+        self._batch_size = batch_size
+        self._give_up_after = give_up_after
+        self._path = path
+        # transaction execution id -> (memo, submitted at, last checked at)
+        self._entries: Dict[str, Tuple[Optional[str], float, float]] = {}
+        # changes waiting to be written to disk, None means delete
+        self._pending: Dict[str, Optional[Tuple[Optional[str], float]]] = {}
+        self._connection = None
+        self._deliver: Optional[Callable[[WebhookPayload], Awaitable[int]]] = None
+        # the worker we are
+        self._owner = 0
+        self._tasks: List[asyncio.Task] = []
+        # simple counters, exported as metrics
+        self.reconciled = 0
+        self.abandoned = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def oldest_age(self) -> float:
+        """How long the longest waiting transaction has been waiting for its callback."""
+        if not self._entries:
+            return 0.0
+        return time.time() - min(submitted_at for _, submitted_at, _ in self._entries.values())
+
+    def track(self, transaction_id: str, memo: Optional[str]) -> None:
+        """Start waiting for the callback of a transaction execution."""
+        now = time.time()
+        self._entries[transaction_id] = (memo, now, now)
+        if self._connection is not None:
+            self._pending[transaction_id] = (memo, now)
+
+    def resolve(self, transaction_id: str) -> Optional[float]:
+        """Stop waiting for a transaction execution, its callback has been handled. Returns when it was submitted, if we knew about it."""
+        entry = self._entries.pop(transaction_id, None)
+        if entry is None:
+            return None
+        if self._connection is not None:
+            self._pending[transaction_id] = None
+        return entry[1]
+
+    def _stale(self, now: float) -> List[str]:
+        return [
+            transaction_id
+            for transaction_id, (_, submitted_at, checked_at) in self._entries.items()
+            if now - submitted_at >= self._stale_after and now - checked_at >= self._check_interval
+        ]
+
+    async def _check(self, transaction_id: str) -> None:
+        memo, submitted_at, _ = self._entries[transaction_id]
+        now = time.time()
+        try:
+            transaction = await oneshot_client.transactions.get(transaction_id)
+        except Exception as e:
+            logger.warning("Could not look up transaction %s: %s", transaction_id, e)
+            transaction = None
+
+        if transaction is not None and transaction.status in FINAL_STATUSES:
+            logger.warning("No callback for transaction %s after %.0fs, it is %s", transaction_id, now - submitted_at, transaction.status)
+            status = await self._deliver(synthesize_webhook_payload(transaction, memo))
+            if status == HTTPStatus.OK:
+                self.resolve(transaction_id)
+                self.reconciled += 1
+            else:
+                # the update wasn't accepted (e.g. it couldn't be journaled), so keep waiting and deliver it again next time
+                logger.warning("Delivering the result of transaction %s failed with %s, will try again", transaction_id, status)
+                if transaction_id in self._entries:
+                    self._entries[transaction_id] = (memo, submitted_at, now)
+        elif now - submitted_at >= self._give_up_after:
+            logger.error("Giving up on transaction %s after %.0fs", transaction_id, now - submitted_at)
+            self.resolve(transaction_id)
+            self.abandoned += 1
+        elif transaction_id in self._entries:
+            self._entries[transaction_id] = (memo, submitted_at, now)
+
+    async def reconcile(self) -> None:
+        """Look up the status of every stale transaction execution, one batch at a time."""
+        stale = self._stale(time.time())
+        for start in range(0, len(stale), self._batch_size):
+            batch = [transaction_id for transaction_id in stale[start:start + self._batch_size] if transaction_id in self._entries]
+            results = await asyncio.gather(*(self._check(transaction_id) for transaction_id in batch), return_exceptions=True)
+            for transaction_id, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error("Failed to reconcile transaction %s: %s", transaction_id, result)
+
+    def _write(self, changes: Dict[str, Optional[Tuple[Optional[str], float]]]) -> None:
+        self._connection.execute("BEGIN")
+        try:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO inflight (transaction_id, memo, submitted_at, owner) VALUES (?, ?, ?, ?)",
+                [(transaction_id, *entry, self._owner) for transaction_id, entry in changes.items() if entry is not None],
+            )
+            self._connection.executemany(
+                "DELETE FROM inflight WHERE transaction_id = ?",
+                [(transaction_id,) for transaction_id, entry in changes.items() if entry is None],
+            )
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    async def flush(self) -> None:
+        if self._connection is None or not self._pending:
+            return
+        changes, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write, changes)
+        except Exception:
+            # write them with the next flush, changes made since then are newer
+            self._pending = {**changes, **self._pending}
+            raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(INFLIGHT_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning("Failed to write in-flight transactions to disk: %s", e)
+
+    async def _reconcile_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._check_interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error("Failed to reconcile in-flight transactions: %s", e)
+
+    async def start(self, deliver: Callable[[WebhookPayload], Awaitable[int]], worker_index: int = 0) -> None:
+        """Load the transactions this worker was waiting on before a restart and start reconciling in the background.
+        deliver hands a result we looked up to the worker that owns it, and returns the HTTP status it answered with."""
+        self._deliver = deliver
+        self._owner = worker_index
+        if self._path:
+            self._connection = connect_sqlite(self._path)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS inflight (transaction_id TEXT PRIMARY KEY, memo TEXT, submitted_at REAL NOT NULL, owner INTEGER)"
+            )
+            # databases from before transactions had an owner
+            if "owner" not in [column[1] for column in self._connection.execute("PRAGMA table_info(inflight)")]:
+                self._connection.execute("ALTER TABLE inflight ADD COLUMN owner INTEGER")
+            # otherwise every worker would look up (and deliver) every transaction; those without an owner yet are
+            # claimed by the first worker to start, in a single statement
+            self._connection.execute("UPDATE inflight SET owner = ? WHERE owner IS NULL", (self._owner,))
+            rows = self._connection.execute(
+                "SELECT transaction_id, memo, submitted_at FROM inflight WHERE owner = ?", (self._owner,)
+            ).fetchall()
+            for transaction_id, memo, submitted_at in rows:
+                # checked_at of 0 makes them due for a lookup as soon as they're stale
+                self._entries.setdefault(transaction_id, (memo, submitted_at, 0.0))
+            # anything tracked before start() still has to reach the disk
+            self._pending.update({transaction_id: (memo, submitted_at) for transaction_id, (memo, submitted_at, _) in self._entries.items()})
+            if rows:
+                logger.info("Waiting on %s transactions from before the restart", len(rows))
+            self._tasks.append(asyncio.create_task(self._flush_loop()))
+        self._tasks.append(asyncio.create_task(self._reconcile_loop()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._connection is not None:
+            await self.flush()
+            self._connection.close()
+            self._connection = None
+
+# the submitter tracks what it submits, webhook_update resolves what comes back
+inflight_tracker = InflightTracker()
@@ -0,0 +1,175 @@
+import os
+import json
+import asyncio
+import tempfile
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+import httpx
+
+from uxly_1shot_client.models.contract_method import ContractMethod
+from uxly_1shot_client.models.wallet import Wallet
+
+from helpers import data_path
+from keystore import public_key_store
+
+from oneshot import (
+    oneshot_client,
+    BUSINESS_ID
+)
+
+logger = logging.getLogger(__name__)
+
+# how often (in seconds) the registry re-lists wallets and contract methods from 1Shot API in the background
+RESOURCE_REFRESH_INTERVAL = float(os.getenv("RESOURCE_REFRESH_INTERVAL", "300"))
+# the last resolved wallets and contract methods are written here, so a warm start can skip listing them
+RESOURCE_SNAPSHOT_PATH = os.getenv("RESOURCE_SNAPSHOT_PATH", data_path("resources.json"))
+
+# 1Shot API answers with a 404 when a wallet or contract method id we hold on to no longer exists
+def is_not_found(error: Exception) -> bool:
+    """Check if an exception from the 1Shot client is a 404 response."""
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 404
+
+# The escrow wallets and contract methods the bot uses rarely change, so we resolve them once in lifespan
+# and keep them here; handlers read them from memory instead of listing them from 1Shot API on every request
+class ResourceRegistry:
+    def __init__(self, refresh_interval: float = RESOURCE_REFRESH_INTERVAL, snapshot_path: Optional[str] = RESOURCE_SNAPSHOT_PATH):
+        self._refresh_interval = refresh_interval
+        self._snapshot_path = snapshot_path
+        self._wallets: Dict[str, List[Wallet]] = {}
+        self._contract_methods: Dict[Tuple[str, str], ContractMethod] = {}
+        self._tracked_contract_methods: Set[Tuple[str, str]] = set()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def escrow_wallet(self, chain_id: str) -> Optional[Wallet]:
+        """The escrow wallet the bot uses on a chain, None if we don't know of one."""
+        wallets = self._wallets.get(str(chain_id))
+        return wallets[0] if wallets else None
+
+    def contract_method(self, chain_id: str, name: str) -> Optional[ContractMethod]:
+        """The contract method with the given name on a chain, None if we don't know of one."""
+        return self._contract_methods.get((str(chain_id), name))
+
+    def set_contract_method(self, contract_method: ContractMethod) -> None:
+        """Register a contract method we created ourselves."""
+        key = (str(contract_method.chain_id), contract_method.name)
+        self._tracked_contract_methods.add(key)
+        self._contract_methods[key] = contract_method
+        public_key_store.warm([contract_method])
+
+    async def load_wallets(self, chain_id: str) -> List[Wallet]:
+        """List the escrow wallets on a chain from 1Shot API and remember them."""
+        wallets = await oneshot_client.wallets.list(BUSINESS_ID, {"chain_id": str(chain_id)})
+        self._wallets[str(chain_id)] = wallets.response
+        return wallets.response
+
+    async def load_contract_method(self, chain_id: str, name: str) -> Optional[ContractMethod]:
+        """Look up a contract method by chain and name from 1Shot API and remember it."""
+        key = (str(chain_id), name)
+        self._tracked_contract_methods.add(key)
+        contract_methods = await oneshot_client.contract_methods.list(
+            business_id=BUSINESS_ID,
+            params={"chain_id": str(chain_id), "name": name}
+        )
+        if len(contract_methods.response) == 0:
+            self._contract_methods.pop(key, None)
+            return None
+        # the contract methods we list carry their webhook public keys, so keep the key store in sync too
+        public_key_store.warm(contract_methods.response)
+        self._contract_methods[key] = contract_methods.response[0]
+        return contract_methods.response[0]
+
+    async def _refresh(self) -> None:
+        await asyncio.gather(
+            *(self.load_wallets(chain_id) for chain_id in list(self._wallets)),
+            *(self.load_contract_method(chain_id, name) for chain_id, name in list(self._tracked_contract_methods)),
+        )
+        logger.info("Resource registry refreshed.")
+        await self.save_snapshot()
+
+    async def refresh(self) -> None:
+        """Re-resolve everything in the registry, concurrent callers share one refresh."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+        await asyncio.shield(self._refresh_task)
+
+    def _write_snapshot(self, snapshot: dict) -> None:
+        # write to a temporary file first so a crash never leaves a half written snapshot behind; every worker
+        # refreshes the snapshot, so each write gets a temporary file of its own next to it
+        directory, name = os.path.split(os.path.abspath(self._snapshot_path))
+        temporary = tempfile.NamedTemporaryFile("w", dir=directory, prefix=f"{name}.", suffix=".tmp", delete=False)
+        try:
+            with temporary:
+                json.dump(snapshot, temporary)
+            os.replace(temporary.name, self._snapshot_path)
+        except BaseException:
+            os.remove(temporary.name)
+            raise
+
+    async def save_snapshot(self) -> None:
+        """Write the resolved wallets and contract methods to the snapshot file."""
+        if not self._snapshot_path:
+            return
+        snapshot = {
+            "wallets": {
+                chain_id: [wallet.model_dump(mode="json", by_alias=True) for wallet in wallets]
+                for chain_id, wallets in self._wallets.items()
+            },
+            "contract_methods": [
+                contract_method.model_dump(mode="json", by_alias=True) for contract_method in self._contract_methods.values()
+            ],
+        }
+        try:
+            await asyncio.to_thread(self._write_snapshot, snapshot)
+        except OSError as e:
+            logger.warning("Could not write the resource snapshot: %s", e)
+
+    def load_snapshot(self) -> bool:
+        """Fill the registry from the snapshot file, returns False if there is no usable snapshot."""
+        if not self._snapshot_path or not os.path.exists(self._snapshot_path):
+            return False
+        try:
+            with open(self._snapshot_path) as f:
+                snapshot = json.load(f)
+            wallets = {
+                chain_id: [Wallet.model_validate(wallet) for wallet in chain_wallets]
+                for chain_id, chain_wallets in snapshot["wallets"].items()
+            }
+            contract_methods = [ContractMethod.model_validate(contract_method) for contract_method in snapshot["contract_methods"]]
+        except (OSError, ValueError, KeyError) as e:
+            # a snapshot from an older version of the bot, or a damaged file, we'll resolve everything from 1Shot API instead
+            logger.warning("Ignoring the resource snapshot: %s", e)
+            return False
+        self._wallets.update(wallets)
+        for contract_method in contract_methods:
+            self.set_contract_method(contract_method)
+        return True
+
+    async def _refresh_loop(self, refresh_now: bool) -> None:
+        while True:
+            if not refresh_now:
+                await asyncio.sleep(self._refresh_interval)
+            refresh_now = False
+            try:
+                await self.refresh()
+            except Exception as e:
+                # keep serving the last known ids, we'll try again on the next interval
+                logger.warning("Resource registry refresh failed: %s", e)
+
+    def start(self, refresh_now: bool = False) -> None:
+        """Start refreshing the registry in the background, right away if it was loaded from a snapshot."""
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._refresh_loop(refresh_now))
+
+    async def stop(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+
+# a single registry is shared by lifespan and the conversation handlers
+resource_registry = ResourceRegistry()
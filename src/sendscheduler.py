@@ -0,0 +1,195 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from datetime import timedelta
+from enum import IntEnum
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import telegram_send_duration
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall, about one per second in a private chat
+# and 20 per minute in a group: https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "30"))
+PRIVATE_CHAT_SEND_RATE = float(os.getenv("PRIVATE_CHAT_SEND_RATE", "1"))
+GROUP_CHAT_SEND_RATE = float(os.getenv("GROUP_CHAT_SEND_RATE", str(20 / 60)))
+# how many notifications may be waiting to be sent before the next ones wait for room, and how often we retry after a 429
+SEND_BACKLOG_LIMIT = int(os.getenv("SEND_BACKLOG_LIMIT", "1000"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# pass these with rate_limit_args={"priority": ...} on a bot call, replies to a user go first by default
+class SendPriority(IntEnum):
+    INTERACTIVE = 0
+    NOTIFICATION = 1
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """Take a token, going into debt if needed, and return how long the caller must wait for it."""
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def wait_time(self, now: float) -> float:
+        """How long until a token is available, without taking one."""
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float) -> None:
+        """Hold back the bucket for the given time, e.g. when Telegram tells us to retry after a while."""
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+# Schedules every outbound Telegram Bot API call. Each chat has its own token bucket, and all sends share
+# a global bucket; when the global bucket runs dry, waiting sends are let through by priority so replies
+# to users aren't stuck behind a burst of deployment notifications. Plug it in with Application.builder().rate_limiter()
+class SendScheduler(BaseRateLimiter[Dict[str, Any]]):
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_SEND_RATE,
+        private_chat_rate: float = PRIVATE_CHAT_SEND_RATE,
+        group_chat_rate: float = GROUP_CHAT_SEND_RATE,
+        backlog_limit: int = SEND_BACKLOG_LIMIT,
+        max_retries: int = SEND_MAX_RETRIES,
+    ):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._private_chat_rate = private_chat_rate
+        self._group_chat_rate = group_chat_rate
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._max_retries = max_retries
+        # sends waiting on the global bucket: (priority, sequence number, future)
+        self._waiting: List[Tuple[int, int, asyncio.Future]] = []
+        # interactive sends are awaited by a handler, so the update processor already bounds them; notifications
+        # are the ones that pile up in a burst, so only so many of them wait for the buckets at once
+        self._backlog = asyncio.Semaphore(backlog_limit)
+        self._sequence = itertools.count()
+        self._pump: Optional[asyncio.Task] = None
+        # simple counters, exported as metrics
+        self.sends = 0
+        self.retries = 0
+        self.backlogged = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of sends waiting for the global bucket."""
+        return len(self._waiting)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # forget chats that haven't sent anything for a while, their buckets are full again anyway
+                now = time.monotonic()
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_full(now)}
+            # group and channel ids are negative
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            rate = self._group_chat_rate if is_group else self._private_chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, 3 if not is_group else 1)
+        return bucket
+
+    async def _run_pump(self) -> None:
+        while self._waiting:
+            delay = self._global.wait_time(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                self._global.take()
+                future.set_result(None)
+        self._pump = None
+
+    async def _acquire(self, chat_id: Any, priority: int) -> None:
+        if priority == SendPriority.INTERACTIVE:
+            await self._acquire_tokens(chat_id, priority)
+            return
+        # a full backlog makes a notification wait (first come, first served) instead of refusing it: a callback's
+        # notification that was dropped would be lost for good, the callback is deduplicated. This happens before
+        # the chat's token is taken, so waiting for room doesn't use up the chat's budget
+        if self._backlog.locked():
+            self.backlogged += 1
+        async with self._backlog:
+            await self._acquire_tokens(chat_id, priority)
+
+    async def _acquire_tokens(self, chat_id: Any, priority: int) -> None:
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        if not self._waiting and self._global.wait_time(time.monotonic()) == 0:
+            self._global.take()
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), future))
+        if self._pump is None:
+            self._pump = asyncio.create_task(self._run_pump())
+        await future
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Any:
+        priority = (rate_limit_args or {}).get("priority", SendPriority.INTERACTIVE)
+        chat_id = data.get("chat_id")
+        started = time.monotonic()
+        for attempt in range(self._max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self._max_retries:
+                    raise
+                # Telegram tells us exactly how long to back off, hold back the chat (or everything, if we don't know the chat)
+                retry_after = _retry_after_seconds(e)
+                logger.warning("Flood limit hit on %s for chat %s, retrying in %ss", endpoint, chat_id, retry_after)
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+                bucket.pause(time.monotonic(), retry_after)
+                self.retries += 1
+                continue
+            self.sends += 1
+            telegram_send_duration.observe(time.monotonic() - started, endpoint)
+            return result
@@ -0,0 +1,316 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application, BaseHandler, ContextTypes, ConversationHandler
+
+from objects import ConversationState
+
+logger = logging.getLogger(__name__)
+
+# a user's session (their user_data and the conversations they're in) is forgotten after this long (in seconds)
+# without an update from them...
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", str(24 * 3600)))
+# ...or sooner while they're halfway through a flow, per conversation state. SESSION_STATE_TIMEOUTS overrides these:
+#   SESSION_STATE_TIMEOUTS="TOKEN_PREMINT=600,SENDER_LIST=900"
+DEFAULT_STATE_TIMEOUTS = {
+    ConversationState.TOKEN_NAMING: 3600,
+    ConversationState.TOKEN_TICKER: 3600,
+    ConversationState.TOKEN_DESCRIPTION: 3600,
+    ConversationState.TOKEN_IMAGE: 3600,
+    ConversationState.TOKEN_PREMINT: 3600,
+    ConversationState.SENDER_LIST: 1800,
+}
+SESSION_STATE_TIMEOUTS = os.getenv("SESSION_STATE_TIMEOUTS", "")
+# once all sessions together take about this much memory, the ones we heard from longest ago are evicted
+SESSION_MEMORY_BYTES = int(os.getenv("SESSION_MEMORY_BYTES", str(64 * 1024 * 1024)))
+# how often (in seconds) idle sessions are looked for
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "30"))
+
+def _parse_timeouts(spec: str) -> Dict[ConversationState, float]:
+    timeouts: Dict[ConversationState, float] = dict(DEFAULT_STATE_TIMEOUTS)
+    for rule in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = rule.partition("=")
+        timeouts[ConversationState[name.strip()]] = float(value)
+    return timeouts
+
+STATE_TIMEOUTS = _parse_timeouts(SESSION_STATE_TIMEOUTS)
+# no session expires sooner than this after the user's last update
+_SHORTEST_TIMEOUT = min([SESSION_IDLE_TIMEOUT, *STATE_TIMEOUTS.values()])
+
+# eviction frees memory down to this share of the limit, so it runs in batches instead of on every new user
+_EVICT_TO = 0.9
+# rough memory of a session's entry in the store and of each conversation key it has, on top of the record itself
+_ENTRY_BYTES = 100
+_CONVERSATION_BYTES = 250
+
+# What we remember about a user between their updates: the token they're drafting, the airdrop list they uploaded and
+# whether the menu should be edited or sent again. A record with a slot per field takes a fraction of the memory of a
+# dict keyed by strings, and a typo is an AttributeError instead of a KeyError three steps later.
+class Session:
+    __slots__ = (
+        "name", "ticker", "description", "image", "trace_id", "start_over",
+        "airdrop_token", "airdrop_path", "airdrop_total",
+        "chats", "last_seen", "expires_at", "size",
+    )
+
+    def __init__(self):
+        # the token deployment draft (see deploytoken.py)
+        self.name: Optional[str] = None
+        self.ticker: Optional[str] = None
+        self.description: Optional[str] = None
+        self.image: Optional[str] = None
+        self.trace_id: Optional[str] = None
+        # whether the main menu is sent as a new message instead of editing the last one
+        self.start_over = False
+        # the uploaded list of an airdrop that hasn't been confirmed yet (see airdrop.py)
+        self.airdrop_token: Optional[int] = None
+        self.airdrop_path: Optional[str] = None
+        self.airdrop_total = 0
+        # bookkeeping of the session store: the chats the user has conversations in, when we last heard from them
+        # (time.time(), so it survives restarts), when the session expires and its estimated size in bytes
+        self.chats: Tuple[int, ...] = ()
+        self.last_seen = time.time()
+        self.expires_at = self.last_seen + SESSION_IDLE_TIMEOUT
+        self.size = 0
+
+    def clear_draft(self) -> None:
+        self.name = self.ticker = self.description = self.image = self.trace_id = None
+
+    def clear_airdrop(self) -> None:
+        self.airdrop_token = self.airdrop_path = None
+        self.airdrop_total = 0
+
+    def measure(self) -> int:
+        """Estimate the memory the session takes, including its entry in the store and its conversation keys."""
+        size = sys.getsizeof(self) + _ENTRY_BYTES + len(self.chats) * _CONVERSATION_BYTES
+        for value in (self.name, self.ticker, self.description, self.image, self.trace_id, self.airdrop_path):
+            if value is not None:
+                size += sys.getsizeof(value)
+        return size
+
+    # pickled by field name (for the persistence), so sessions stored before a field was added still load
+    def __getstate__(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.__slots__ if field != "size"}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__()
+        for field, value in state.items():
+            if field in self.__slots__:
+                setattr(self, field, value)
+
+    @classmethod
+    def from_dict(cls, data: Dict[Any, Any]) -> "Session":
+        """Convert the user_data dict stored by earlier versions."""
+        session = cls()
+        for field in ("name", "ticker", "description", "image", "trace_id", "airdrop_token", "airdrop_path", "airdrop_total"):
+            if field in data:
+                setattr(session, field, data[field])
+        session.start_over = bool(data.get(ConversationState.START_OVER, False))
+        return session
+
+# The Application's user_data, one Session per user, kept in least recently used order: an update moves its user's
+# session to the end. A session expires once the user has been idle for the timeout of the conversation states they
+# are in, and when the sessions take more than SESSION_MEMORY_BYTES the oldest ones are evicted. Either way the user's
+# conversation keys are removed from every ConversationHandler along with their session, and both are deleted from the
+# persistence, so a user never comes back to a conversation whose data is gone. Sessions are loaded from the
+# persistence the first time a user shows up, so startup doesn't read every user we've ever seen.
+class SessionStore(dict):
+    def __init__(self):
+        super().__init__()
+        self._application: Optional[Application] = None
+        self._load: Optional[Callable[[int], Any]] = None
+        self._handlers: List[ConversationHandler] = []
+        # uploaded airdrop lists of forgotten sessions, deleted from disk in the background
+        self._leftover_files: List[str] = []
+        self._sweep_task: Optional[asyncio.Task] = None
+        self.bytes = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def attach(self, application: Application, load: Optional[Callable[[int], Any]] = None) -> None:
+        """Become the user_data of an application, load reads a user's stored data (None if there is none)."""
+        self._application = application
+        self._load = load
+
+    def _insert(self, user_id: int, data: Any) -> Session:
+        if data is None:
+            session = Session()
+        elif isinstance(data, dict):
+            session = Session.from_dict(data)
+        else:
+            session = data
+        session.size = session.measure()
+        self.bytes += session.size
+        self[user_id] = session
+        return session
+
+    def __missing__(self, user_id: int) -> Session:
+        return self._insert(user_id, self._load(user_id) if self._load is not None else None)
+
+    def _timeout(self, user_id: int, session: Session) -> float:
+        # the shortest timeout of the states the user is in, in any conversation and any chat
+        timeout = SESSION_IDLE_TIMEOUT
+        chats = []
+        for chat_id in session.chats:
+            key = (chat_id, user_id)
+            states = [handler._conversations[key] for handler in self._handlers if key in handler._conversations]
+            if states:
+                chats.append(chat_id)
+                timeout = min([timeout, *(STATE_TIMEOUTS.get(state, SESSION_IDLE_TIMEOUT) for state in states)])
+        # chats the user has no conversation in don't need remembering
+        session.chats = tuple(chats)
+        return timeout
+
+    def touch(self, user_id: int, chat_id: int) -> None:
+        """Make a user's session the most recently used one, an update of theirs is about to be handled."""
+        session = self.pop(user_id, None)
+        if session is None:
+            session = self[user_id]
+        else:
+            self[user_id] = session
+        session.last_seen = time.time()
+        # the update being handled can't have its session expire underneath it
+        session.expires_at = max(session.expires_at, session.last_seen + _SHORTEST_TIMEOUT)
+        if chat_id not in session.chats:
+            session.chats += (chat_id,)
+
+    def track(self, user_id: int) -> None:
+        """Work out when a user's session expires now that their update was handled, and make room if needed."""
+        session = self.get(user_id)
+        if session is None:
+            return
+        session.expires_at = time.time() + self._timeout(user_id, session)
+        size = session.measure()
+        self.bytes += size - session.size
+        session.size = size
+        if self.bytes > SESSION_MEMORY_BYTES:
+            self._evict()
+
+    def _forget(self, user_id: int) -> None:
+        session = self.pop(user_id)
+        self.bytes -= session.size
+        for chat_id in session.chats:
+            for handler in self._handlers:
+                # a removed key is deleted from the persistence too, see Application.update_persistence
+                handler._conversations.pop((chat_id, user_id), None)
+        # so is the user's data
+        self._application.drop_user_data(user_id)
+        if session.airdrop_path:
+            self._leftover_files.append(session.airdrop_path)
+
+    def _evict(self) -> None:
+        # oldest first, the most recent session (whose update was just handled) always stays
+        target = SESSION_MEMORY_BYTES * _EVICT_TO
+        victims = []
+        freed = 0
+        for user_id, session in self.items():
+            if self.bytes - freed <= target or len(victims) == len(self) - 1:
+                break
+            victims.append(user_id)
+            freed += session.size
+        for user_id in victims:
+            self._forget(user_id)
+        self.evicted += len(victims)
+        logger.warning("Evicted %s sessions, sessions take about %s bytes", len(victims), self.bytes)
+
+    def sweep(self) -> int:
+        """Forget the sessions that have been idle for longer than their timeout, returns how many there were."""
+        now = time.time()
+        expired = []
+        for user_id, session in self.items():
+            # sessions are in the order their users were last seen, the ones after this can't have expired yet
+            if session.last_seen + _SHORTEST_TIMEOUT > now:
+                break
+            if session.expires_at <= now:
+                expired.append(user_id)
+        for user_id in expired:
+            self._forget(user_id)
+        self.expired += len(expired)
+        if expired:
+            logger.info("Expired %s idle sessions", len(expired))
+        return len(expired)
+
+    async def remove_leftover_files(self) -> None:
+        files, self._leftover_files = self._leftover_files, []
+        for path in files:
+            try:
+                await asyncio.to_thread(os.remove, path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("Failed to remove %s: %s", path, e)
+
+    async def _adopt(self) -> None:
+        # conversations that were in progress before a restart are loaded on startup but their sessions aren't, so
+        # their users are loaded here to have those conversations expire too
+        users: Dict[int, List[int]] = {}
+        for handler in self._handlers:
+            for key in handler._conversations:
+                if len(key) == 2 and key[1] not in self:
+                    users.setdefault(key[1], []).append(key[0])
+        if not users:
+            return
+        load = self._load or (lambda user_id: None)
+        stored = await asyncio.to_thread(lambda: [(user_id, load(user_id)) for user_id in users])
+        for user_id, data in stored:
+            # the user may have come back while we were reading
+            if user_id in self:
+                continue
+            session = self._insert(user_id, data)
+            session.chats = tuple(set(session.chats).union(users[user_id]))
+            session.expires_at = session.last_seen + self._timeout(user_id, session)
+        # keep the store in the order users were last seen, sweep relies on it
+        ordered = sorted(self.items(), key=lambda item: item[1].last_seen)
+        self.clear()
+        self.update(ordered)
+        logger.info("Loaded %s sessions with conversations in progress", len(stored))
+
+    async def _sweep_loop(self) -> None:
+        try:
+            await self._adopt()
+        except Exception as e:
+            logger.error("Failed to load the sessions of conversations in progress: %s", e)
+        while True:
+            self.sweep()
+            await self.remove_leftover_files()
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+
+    async def start(self) -> None:
+        """Find the conversation handlers whose keys are forgotten with a session, and start expiring idle sessions."""
+        def conversation_handlers(handlers: List[BaseHandler]) -> List[ConversationHandler]:
+            found = []
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler):
+                    found.append(handler)
+                    # nested conversations live in the states of their parent
+                    found.extend(conversation_handlers([child for state in handler.states.values() for child in state]))
+            return found
+
+        self._handlers = conversation_handlers([handler for group in self._application.handlers.values() for handler in group])
+        self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self) -> None:
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+
+# the Application's user_data, see LazyUserDataApplication
+session_store = SessionStore()
+
+# Runs before every other handler (group -2), so the session is the most recently used one while its update is handled
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mark the session of the user who sent an update as used."""
+    if update.effective_user is not None and update.effective_chat is not None:
+        session_store.touch(update.effective_user.id, update.effective_chat.id)
+
+# Runs after the conversations (group 1), when the states the user is in are known
+async def track_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Set when the session of the user who sent an update expires."""
+    if update.effective_user is not None:
+        session_store.track(update.effective_user.id)
+        await session_store.remove_leftover_files()
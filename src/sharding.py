@@ -0,0 +1,213 @@
+import os
+import fcntl
+import struct
+import asyncio
+import hashlib
+import logging
+from bisect import bisect
+from enum import Enum
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from pydantic import ValidationError
+
+from uxly_1shot_client import WebhookPayload
+
+from objects import TransactionMemo
+
+logger = logging.getLogger(__name__)
+
+# Run uvicorn with --workers set to the same number as WORKER_COUNT to enable sharding
+# workers find each other through Unix sockets in SHARD_SOCKET_DIR (keep the path short, sockets are limited to ~100 chars)
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "/tmp/1shot-bot-shards")
+SHARD_VIRTUAL_NODES = 64
+# how many idle connections to each other worker are kept for reuse, a burst opens more but closes them afterwards
+SHARD_MAX_IDLE_CONNECTIONS = int(os.getenv("SHARD_MAX_IDLE_CONNECTIONS", "8"))
+
+# the kinds of updates that can be handed from one worker to another
+class UpdateKind(Enum):
+    TELEGRAM = 1
+    ONESHOT = 2
+
+# frames on the socket are: kind (1 byte), body length (4 bytes), body; the owner answers with an HTTP status (2 bytes)
+_REQUEST_HEADER = struct.Struct("!BI")
+_RESPONSE = struct.Struct("!H")
+
+# Telegram updates are routed by the id of the user who sent them (or the chat, when there is no user, e.g. a
+# channel post). Everything we keep about a user lives with their worker: their session, which is a single user_data
+# row every worker writes to the same database, their conversations in any chat and their airdrops. Routing by chat
+# would split a user who talks to the bot in a group and in private between two workers, each with its own copy of
+# the session, overwriting each other's row
+def telegram_routing_key(data: dict) -> Optional[int]:
+    """Find the user (or chat) id in a raw Telegram update dict."""
+    chat_id = None
+    for field, value in data.items():
+        if field == "update_id" or not isinstance(value, dict):
+            continue
+        for user_field in ("from", "user"):
+            if isinstance(value.get(user_field), dict):
+                return value[user_field]["id"]
+        if chat_id is None:
+            if isinstance(value.get("chat"), dict):
+                chat_id = value["chat"]["id"]
+            elif isinstance(value.get("message"), dict) and "chat" in value["message"]:
+                chat_id = value["message"]["chat"]["id"]
+    return chat_id
+
+# 1Shot API callbacks are routed to the worker that owns the user who started the transaction
+def oneshot_routing_key(webhook_payload: WebhookPayload) -> Optional[int]:
+    """Find the associated user id in the memo of a 1Shot API callback."""
+    if not webhook_payload.data.transaction_execution_memo:
+        return None
+    try:
+        # only the user id is needed, so a payload kept in the memo store isn't loaded here
+        return TransactionMemo.decode(webhook_payload.data.transaction_execution_memo).associated_user_id
+    except ValidationError:
+        return None
+
+# a consistent hash ring, so every worker agrees on which worker owns a user
+class HashRing:
+    def __init__(self, worker_count: int, virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        points = []
+        for worker in range(worker_count):
+            for node in range(virtual_nodes):
+                points.append((self._hash(f"{worker}:{node}"), worker))
+        points.sort()
+        self._hashes = [point for point, _ in points]
+        self._workers = [worker for _, worker in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def owner(self, key: int) -> int:
+        index = bisect(self._hashes, self._hash(str(key))) % len(self._hashes)
+        return self._workers[index]
+
+# Routes updates to the worker that owns their user. Every worker accepts webhooks, but the state of a user only ever
+# lives in the worker that owns them; updates for other users are passed over a Unix socket.
+class ShardRouter:
+    def __init__(self, worker_count: int = WORKER_COUNT, socket_dir: str = SHARD_SOCKET_DIR, max_idle_connections: int = SHARD_MAX_IDLE_CONNECTIONS):
+        self.worker_count = worker_count
+        self.worker_index = 0
+        self._socket_dir = socket_dir
+        self._max_idle_connections = max_idle_connections
+        self._ring = HashRing(worker_count)
+        self._lock_file = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._deliver: Optional[Callable[[UpdateKind, bytes], Awaitable[int]]] = None
+        # idle connections to other workers, reused across forwards
+        self._connections: Dict[int, List[tuple]] = {}
+        # connections other workers opened to us
+        self._peers: Set[asyncio.StreamWriter] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.worker_count > 1
+
+    def _socket_path(self, worker_index: int) -> str:
+        return os.path.join(self._socket_dir, f"worker-{worker_index}.sock")
+
+    def owner(self, key: Optional[int]) -> int:
+        """The index of the worker that owns a user (or chat), updates without a key stay on this worker."""
+        if not self.enabled or key is None:
+            return self.worker_index
+        return self._ring.owner(key)
+
+    def is_local(self, key: Optional[int]) -> bool:
+        return self.owner(key) == self.worker_index
+
+    def _claim_worker_index(self) -> int:
+        # uvicorn doesn't tell workers apart, so each one takes the first free lock file as its index
+        os.makedirs(self._socket_dir, exist_ok=True)
+        for index in range(self.worker_count):
+            lock_file = open(os.path.join(self._socket_dir, f"worker-{index}.lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            self._lock_file = lock_file
+            return index
+        raise RuntimeError(f"All {self.worker_count} worker slots are taken, is WORKER_COUNT lower than --workers?")
+
+    async def start(self, deliver: Callable[[UpdateKind, bytes], Awaitable[int]]) -> None:
+        """Claim a worker index and start accepting updates forwarded by other workers."""
+        if not self.enabled:
+            return
+        self._deliver = deliver
+        self.worker_index = self._claim_worker_index()
+        path = self._socket_path(self.worker_index)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = await asyncio.start_unix_server(self._serve, path=path)
+        logger.info("Worker %s of %s listening on %s", self.worker_index, self.worker_count, path)
+
+    async def stop(self) -> None:
+        for connections in self._connections.values():
+            for _, writer in connections:
+                writer.close()
+        self._connections.clear()
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._peers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._peers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(_REQUEST_HEADER.size)
+                kind, length = _REQUEST_HEADER.unpack(header)
+                body = await reader.readexactly(length)
+                try:
+                    status = await self._deliver(UpdateKind(kind), body)
+                except Exception as e:
+                    logger.error("Failed to deliver forwarded update: %s", e)
+                    status = 500
+                writer.write(_RESPONSE.pack(status))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+    async def _send(self, owner: int, connection: tuple, kind: UpdateKind, body: bytes) -> int:
+        reader, writer = connection
+        writer.write(_REQUEST_HEADER.pack(kind.value, len(body)) + body)
+        await writer.drain()
+        (status,) = _RESPONSE.unpack(await reader.readexactly(_RESPONSE.size))
+        idle = self._connections.setdefault(owner, [])
+        if len(idle) < self._max_idle_connections:
+            idle.append(connection)
+        else:
+            writer.close()
+        return status
+
+    async def forward(self, key: int, kind: UpdateKind, body: bytes) -> int:
+        """Send an update to the worker that owns it and return the HTTP status it answered with."""
+        owner = self.owner(key)
+        idle = self._connections.setdefault(owner, [])
+        if idle:
+            connection = idle.pop()
+            try:
+                return await self._send(owner, connection, kind, body)
+            except (OSError, asyncio.IncompleteReadError):
+                # the owner restarted since we last used this connection, fall through to a fresh one
+                connection[1].close()
+        try:
+            connection = await asyncio.open_unix_connection(self._socket_path(owner))
+            return await self._send(owner, connection, kind, body)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            # the owner is restarting or not up yet, a 503 makes Telegram and 1Shot API retry later
+            logger.warning("Could not forward update to worker %s: %s", owner, e)
+            return 503
+
+# every worker has a single router
+shard_router = ShardRouter()
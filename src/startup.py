@@ -0,0 +1,36 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Sequence
+
+from telegram import Bot
+
+logger = logging.getLogger(__name__)
+
+# start from the wallets and contract methods resolved on the last run (see registry.py) and refresh them in
+# the background, instead of waiting for 1Shot API before the bot can take updates; handy with uvicorn --reload
+WARM_START = os.getenv("WARM_START", "false").lower() in ("1", "true", "yes")
+
+# how long each startup phase took, in seconds, exported as a metric
+startup_phases: Dict[str, float] = {}
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    """Time a phase of the startup and log how long it took."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_phases[name] = time.perf_counter() - started
+        logger.info("Startup phase %s took %.0fms", name, startup_phases[name] * 1000)
+
+async def ensure_webhook(bot: Bot, url: str, allowed_updates: Optional[Sequence[str]] = None) -> bool:
+    """Point Telegram's webhook at url, unless it already is. Returns True if the webhook was changed."""
+    # getWebhookInfo is cheap, setWebhook makes Telegram re-establish its connections to us
+    info = await bot.get_webhook_info()
+    if info.url == url and set(info.allowed_updates or ()) == set(allowed_updates or ()):
+        logger.info("Webhook is already set, skipping setWebhook.")
+        return False
+    await bot.set_webhook(url=url, allowed_updates=allowed_updates)
+    return True
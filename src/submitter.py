@@ -0,0 +1,510 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import httpx
+
+from telegram import Bot
+from telegram.error import TelegramError
+
+from helpers import data_path
+from persistence import connect_sqlite
+from registry import resource_registry, is_not_found
+from sendscheduler import SendPriority
+from reconciler import inflight_tracker
+from objects import TransactionMemo
+from memostore import encode_memo
+from tracing import tracer
+
+from oneshot import (
+    oneshot_client,
+    BUSINESS_ID
+)
+
+logger = logging.getLogger(__name__)
+
+# how many executions are submitted to 1Shot API at the same time, how often each one is tried,
+# and the bounds (in seconds) of the exponential backoff between tries
+SUBMIT_WORKERS = int(os.getenv("SUBMIT_WORKERS", "4"))
+SUBMIT_MAX_ATTEMPTS = int(os.getenv("SUBMIT_MAX_ATTEMPTS", "5"))
+SUBMIT_BASE_DELAY = float(os.getenv("SUBMIT_BASE_DELAY", "1"))
+SUBMIT_MAX_DELAY = float(os.getenv("SUBMIT_MAX_DELAY", "60"))
+# submissions are kept on disk so they survive restarts and failures can be looked at later
+SUBMIT_PATH = os.getenv("SUBMIT_PATH", data_path("submissions.sqlite3"))
+# how often (in seconds) we look for submissions that were put back by hand, and how long submitted ones are kept
+SUBMIT_POLL_INTERVAL = float(os.getenv("SUBMIT_POLL_INTERVAL", "10"))
+SUBMIT_RETENTION = float(os.getenv("SUBMIT_RETENTION", str(7 * 24 * 3600)))
+# looking for a transaction an earlier attempt created pages through this many transactions at a time, back to when the
+# submission was made (give or take the difference between our clock and 1Shot API's)
+SUBMIT_LOOKUP_PAGE_SIZE = int(os.getenv("SUBMIT_LOOKUP_PAGE_SIZE", "50"))
+SUBMIT_LOOKUP_CLOCK_SKEW = float(os.getenv("SUBMIT_LOOKUP_CLOCK_SKEW", "300"))
+
+# the life of a submission: pending until 1Shot API accepts it, then submitted (and the webhook takes over), or failed
+PENDING = "pending"
+SUBMITTED = "submitted"
+FAILED = "failed"
+
+class PermanentSubmissionError(Exception):
+    """Raised for a submission that won't succeed no matter how often it's retried."""
+
+# errors worth another try: 1Shot API being briefly unavailable or overloaded, or the request not getting there at all
+def is_retryable(error: Exception) -> bool:
+    """Check if a failed execution may succeed when tried again."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.TransportError)
+
+def _timestamp(value: float) -> float:
+    # 1Shot API timestamps, in seconds or in milliseconds
+    return value / 1000 if value > 1e11 else value
+
+def backoff_delay(attempt: int, base: float = SUBMIT_BASE_DELAY, maximum: float = SUBMIT_MAX_DELAY) -> float:
+    """Exponential backoff with full jitter, so a burst of failures doesn't retry in lockstep."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+# one execution of a contract method, as asked for by a handler; owner is the index of the worker that submits it
+class Submission:
+    __slots__ = (
+        "key", "chat_id", "chain_id", "contract_method_name", "params", "memo",
+        "status", "attempts", "next_attempt_at", "transaction_id", "error", "created", "owner",
+    )
+
+    COLUMNS = __slots__
+
+    def __init__(self, **fields: Any):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "Submission":
+        submission = cls(**dict(zip(cls.COLUMNS, row)))
+        submission.params = json.loads(submission.params)
+        return submission
+
+    def to_row(self) -> tuple:
+        return tuple(json.dumps(self.params) if name == "params" else getattr(self, name) for name in self.COLUMNS)
+
+# Handlers hand contract method executions to the submitter and answer the user right away; a small pool of
+# workers submits them to 1Shot API in the background, retrying transient failures with backoff.
+# Every submission carries an idempotency key in its memo. Before trying again after an attempt whose outcome
+# we don't know (a timeout, a 5xx, a restart mid-request), we look for a transaction with that key so a
+# deployment is never executed twice. Once 1Shot API accepts a submission, the usual webhook flow takes over.
+class TransactionSubmitter:
+    def __init__(
+        self,
+        workers: int = SUBMIT_WORKERS,
+        max_attempts: int = SUBMIT_MAX_ATTEMPTS,
+        path: str = SUBMIT_PATH,
+    ):
+        self._worker_count = workers
+        self._max_attempts = max_attempts
+        self._path = path
+        self._connection = None
+        self._db_lock = asyncio.Lock()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # submissions that are queued, being worked on or waiting to be retried
+        self._active: Dict[str, Submission] = {}
+        self._retry_handles: Set[asyncio.TimerHandle] = set()
+        # key -> future resolved with SUBMITTED or FAILED, for callers that wait on a submission (see outcome)
+        self._outcomes: Dict[str, asyncio.Future] = {}
+        # key -> the trace and span the submission was made in, so its execution shows up in the same trace
+        self._trace_contexts: Dict[str, Tuple[str, str]] = {}
+        # database lookups for outcome()
+        self._lookups: Set[asyncio.Task] = set()
+        self._tasks: List[asyncio.Task] = []
+        self._bot: Optional[Bot] = None
+        # the worker we are, all workers share the database but each only works on its own submissions
+        self._owner = 0
+        # simple counters, exported as metrics
+        self.submitted = 0
+        self.retries = 0
+        self.failed = 0
+
+    @property
+    def pending(self) -> int:
+        """The number of submissions 1Shot API hasn't accepted yet."""
+        return len(self._active)
+
+    def _open(self) -> None:
+        self._connection = connect_sqlite(self._path)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS submissions (
+                key TEXT PRIMARY KEY, chat_id INTEGER, chain_id TEXT NOT NULL, contract_method_name TEXT NOT NULL,
+                params TEXT NOT NULL, memo TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL,
+                next_attempt_at REAL NOT NULL, transaction_id TEXT, error TEXT, created REAL NOT NULL, owner INTEGER
+            )
+            """
+        )
+        # databases from before submissions had an owner
+        if "owner" not in [column[1] for column in self._connection.execute("PRAGMA table_info(submissions)")]:
+            self._connection.execute("ALTER TABLE submissions ADD COLUMN owner INTEGER")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS submissions_status ON submissions (status, created)")
+
+    async def _execute(self, sql: str, parameters: tuple = ()) -> List[tuple]:
+        # a single connection is shared, so statements from different workers take turns on the writer thread
+        async with self._db_lock:
+            return await asyncio.to_thread(lambda: self._connection.execute(sql, parameters).fetchall())
+
+    async def _save(self, submission: Submission) -> None:
+        placeholders = ", ".join("?" for _ in Submission.COLUMNS)
+        await self._execute(f"INSERT OR REPLACE INTO submissions VALUES ({placeholders})", submission.to_row())
+
+    def _new_submission(
+        self,
+        chat_id: Optional[int],
+        chain_id: str,
+        contract_method_name: str,
+        params: Dict[str, Any],
+        memo: TransactionMemo,
+        key: Optional[str] = None,
+    ) -> Submission:
+        key = key or uuid.uuid4().hex
+        memo.idempotency_key = key
+        trace_context = tracer.context()
+        if trace_context is not None:
+            self._trace_contexts[key] = trace_context
+        return Submission(
+            key=key,
+            chat_id=chat_id,
+            chain_id=str(chain_id),
+            contract_method_name=contract_method_name,
+            params=params,
+            memo=encode_memo(memo),
+            status=PENDING,
+            attempts=0,
+            next_attempt_at=time.time(),
+            created=time.time(),
+            owner=self._owner,
+        )
+
+    def _enqueue(self, submission: Submission) -> None:
+        self._active[submission.key] = submission
+        self._queue.put_nowait(submission.key)
+
+    async def submit(
+        self,
+        chat_id: Optional[int],
+        chain_id: str,
+        contract_method_name: str,
+        params: Dict[str, Any],
+        memo: TransactionMemo,
+    ) -> str:
+        """Queue an execution of a contract method and return its idempotency key."""
+        submission = self._new_submission(chat_id, chain_id, contract_method_name, params, memo)
+        # written before it's queued, so a restart doesn't lose it
+        await self._save(submission)
+        self._enqueue(submission)
+        return submission.key
+
+    def _save_many(self, rows: List[tuple], skip_existing: bool = False) -> List[str]:
+        # returns the keys of the rows that were written
+        placeholders = ", ".join("?" for _ in Submission.COLUMNS)
+        self._connection.execute("BEGIN")
+        try:
+            if skip_existing:
+                existing = {key for key, in self._connection.execute(
+                    f"SELECT key FROM submissions WHERE key IN ({', '.join('?' for _ in rows)})", [row[0] for row in rows]
+                )}
+                rows = [row for row in rows if row[0] not in existing]
+            self._connection.executemany(f"INSERT OR REPLACE INTO submissions VALUES ({placeholders})", rows)
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+        return [row[0] for row in rows]
+
+    async def submit_many(
+        self,
+        chat_id: Optional[int],
+        chain_id: str,
+        contract_method_name: str,
+        executions: Iterable[Tuple[Dict[str, Any], TransactionMemo]],
+        keys: Optional[Sequence[str]] = None,
+    ) -> List[str]:
+        """Queue several executions of a contract method, given as (params, memo), with a single write. Returns their keys.
+        Executions given a key that was submitted before are skipped, so the same executions can be handed over again."""
+        executions = list(executions)
+        submissions = [
+            self._new_submission(chat_id, chain_id, contract_method_name, params, memo, key)
+            for (params, memo), key in zip(executions, keys or [None] * len(executions))
+        ]
+        async with self._db_lock:
+            written = set(await asyncio.to_thread(
+                self._save_many, [submission.to_row() for submission in submissions], keys is not None
+            ))
+        for submission in submissions:
+            if submission.key in written:
+                self._enqueue(submission)
+            else:
+                # already queued (or done), outcome() finds it
+                self._trace_contexts.pop(submission.key, None)
+        return [submission.key for submission in submissions]
+
+    def outcome(self, key: str) -> asyncio.Future:
+        """A future that resolves to SUBMITTED or FAILED once 1Shot API accepted a submission or we gave up on it,
+        None if there is no such submission."""
+        future = self._outcomes.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._outcomes[key] = future
+            if key not in self._active:
+                # it already left the queue (or is waiting for the poll to pick it up again), the database knows how it went
+                lookup = asyncio.create_task(self._stored_outcome(key))
+                self._lookups.add(lookup)
+                lookup.add_done_callback(self._lookups.discard)
+        return future
+
+    async def _stored_outcome(self, key: str) -> None:
+        try:
+            rows = await self._execute("SELECT status FROM submissions WHERE key = ?", (key,))
+            status = rows[0][0] if rows else None
+        except Exception as e:
+            logger.warning("Could not look up submission %s: %s", key, e)
+            status = None
+        # a pending submission settles the future itself once it's (picked up again and) done
+        if status == PENDING:
+            return
+        future = self._outcomes.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(status)
+
+    def _settle(self, key: str, status: str) -> None:
+        self._active.pop(key, None)
+        self._trace_contexts.pop(key, None)
+        future = self._outcomes.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(status)
+
+    async def _find_existing(self, contract_method_id: str, submission: Submission) -> Optional[str]:
+        """Look for a transaction an earlier attempt may have created, by the idempotency key in its memo."""
+        # transactions are listed newest first, so we page back until we're past the time the submission was made
+        page = 1
+        seen = 0
+        while True:
+            transactions = await oneshot_client.transactions.list(
+                BUSINESS_ID, {"contract_method_id": contract_method_id, "page_size": SUBMIT_LOOKUP_PAGE_SIZE, "page": page}
+            )
+            for transaction in transactions.response:
+                if transaction.memo and submission.key in transaction.memo:
+                    return transaction.id
+            seen += len(transactions.response)
+            if not transactions.response or seen >= transactions.total_results:
+                return None
+            if _timestamp(transactions.response[-1].created) < submission.created - SUBMIT_LOOKUP_CLOCK_SKEW:
+                return None
+            page += 1
+
+    async def _attempt(self, submission: Submission) -> str:
+        contract_method = resource_registry.contract_method(submission.chain_id, submission.contract_method_name)
+        if contract_method is None:
+            contract_method = await resource_registry.load_contract_method(submission.chain_id, submission.contract_method_name)
+        if contract_method is None:
+            raise PermanentSubmissionError(f"No contract method named {submission.contract_method_name} on chain {submission.chain_id}")
+
+        if submission.attempts > 0:
+            transaction_id = await self._find_existing(contract_method.id, submission)
+            if transaction_id is not None:
+                logger.info("Submission %s already went through as %s", submission.key, transaction_id)
+                return transaction_id
+
+        # count the attempt before making it, so after a crash we know to check for a transaction first
+        submission.attempts += 1
+        await self._save(submission)
+        with tracer.span("oneshot.execute", attempt=submission.attempts):
+            transaction = await oneshot_client.contract_methods.execute(
+                contract_method_id=contract_method.id,
+                params=submission.params,
+                memo=submission.memo,
+            )
+        return transaction.id
+
+    async def _process(self, submission: Submission) -> None:
+        # waiting for a worker, and for the backoff before a retry
+        tracer.record_since("submitter.queue", submission.next_attempt_at if submission.attempts else submission.created)
+        try:
+            transaction_id = await self._attempt(submission)
+        except Exception as e:
+            if is_not_found(e):
+                # the contract method was recreated since we looked it up, refresh the registry before the retry
+                logger.warning("Contract method not found while submitting, refreshing resource registry.")
+                await resource_registry.refresh()
+            elif not is_retryable(e):
+                await self._fail(submission, e)
+                return
+            if submission.attempts >= self._max_attempts:
+                await self._fail(submission, e)
+                return
+            delay = backoff_delay(submission.attempts)
+            logger.warning("Submission %s failed (%s), retrying in %.1fs", submission.key, e, delay)
+            self.retries += 1
+            submission.error = str(e)
+            submission.next_attempt_at = time.time() + delay
+            await self._save(submission)
+            self._schedule(submission.key, delay)
+            return
+
+        submission.status = SUBMITTED
+        submission.transaction_id = transaction_id
+        submission.error = None
+        await self._save(submission)
+        self._settle(submission.key, SUBMITTED)
+        # from here on we wait for the callback, and go looking for the result if it doesn't come. 1Shot API gives
+        # the memo back with the transaction, so submissions without a chat (an airdrop's transfers, which can be
+        # very many) are tracked without theirs to keep the tracker small
+        inflight_tracker.track(transaction_id, submission.memo if submission.chat_id is not None else None)
+        self.submitted += 1
+        logger.info("Submission %s executed as transaction %s", submission.key, transaction_id)
+
+    async def _fail(self, submission: Submission, error: Exception) -> None:
+        logger.error("Submission %s failed after %s attempts: %s", submission.key, submission.attempts, error)
+        submission.status = FAILED
+        submission.error = str(error)
+        await self._save(submission)
+        self._settle(submission.key, FAILED)
+        self.failed += 1
+        # the user was told their request is on its way, so let them know it isn't
+        if self._bot is not None and submission.chat_id is not None:
+            try:
+                await self._bot.send_message(
+                    chat_id=submission.chat_id,
+                    text="❌ Sorry, we couldn't submit your transaction. Please try again later.",
+                    rate_limit_args={"priority": SendPriority.NOTIFICATION},
+                )
+            except TelegramError as e:
+                logger.warning("Could not tell chat %s about a failed submission: %s", submission.chat_id, e)
+
+    def _schedule(self, key: str, delay: float) -> None:
+        # retries wait on a timer instead of in a worker, so a backing-off submission doesn't hold up the others
+        def requeue() -> None:
+            self._retry_handles.discard(handle)
+            self._queue.put_nowait(key)
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retry_handles.add(handle)
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._queue.get()
+            submission = self._active.get(key)
+            if submission is None:
+                continue
+            try:
+                # the submission's spans join the trace of the handler that made it
+                with tracer.resume(self._trace_contexts.get(key)):
+                    await self._process(submission)
+            except Exception as e:
+                # e.g. the database is locked; keep the worker alive and let go of the submission, so the poll loads
+                # it again from the database (which has the last state we managed to save) and retries it
+                logger.error("Unexpected error processing submission %s: %s", key, e)
+                self._active.pop(key, None)
+
+    async def _load_pending(self) -> None:
+        # with several workers, another worker's submission may be waiting in its queue or backing off, and picking it up
+        # as well would execute it twice; submissions without an owner (from before there were owners) are claimed by
+        # whichever worker gets to them first, in a single statement so no two workers claim the same one
+        await self._execute(
+            "UPDATE submissions SET owner = ? WHERE status = ? AND owner IS NULL", (self._owner, PENDING)
+        )
+        rows = await self._execute(
+            "SELECT * FROM submissions WHERE status = ? AND owner = ? ORDER BY created", (PENDING, self._owner)
+        )
+        now = time.time()
+        for row in rows:
+            submission = Submission.from_row(row)
+            if submission.key in self._active:
+                continue
+            self._active[submission.key] = submission
+            self._schedule(submission.key, max(0.0, submission.next_attempt_at - now))
+        if rows:
+            logger.info("Picked up %s pending submissions", len(rows))
+
+    async def _poll_loop(self) -> None:
+        while True:
+            await asyncio.sleep(SUBMIT_POLL_INTERVAL)
+            try:
+                await self._load_pending()
+                await self._execute(
+                    "DELETE FROM submissions WHERE status = ? AND created < ?", (SUBMITTED, time.time() - SUBMIT_RETENTION)
+                )
+            except Exception as e:
+                logger.warning("Failed to poll pending submissions: %s", e)
+
+    async def failures(self, limit: int = 50) -> List[Submission]:
+        """The most recent submissions that gave up."""
+        rows = await self._execute(
+            "SELECT * FROM submissions WHERE status = ? ORDER BY created DESC LIMIT ?", (FAILED, limit)
+        )
+        return [Submission.from_row(row) for row in rows]
+
+    async def retry(self, key: str) -> bool:
+        """Put a failed submission back in the queue, returns False if there is no such failed submission."""
+        rows = await self._execute("SELECT * FROM submissions WHERE key = ? AND status = ?", (key, FAILED))
+        if not rows:
+            return False
+        submission = Submission.from_row(rows[0])
+        submission.status = PENDING
+        submission.owner = self._owner
+        # a fresh set of tries, but still more than zero so we check whether an earlier one went through
+        submission.attempts = min(submission.attempts, 1)
+        submission.next_attempt_at = time.time()
+        await self._save(submission)
+        self._enqueue(submission)
+        return True
+
+    async def start(self, bot: Bot, worker_index: int = 0) -> None:
+        """Pick up this worker's submissions left over from before a restart and start the workers."""
+        self._bot = bot
+        self._owner = worker_index
+        await asyncio.to_thread(self._open)
+        await self._load_pending()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._worker_count)]
+        self._tasks.append(asyncio.create_task(self._poll_loop()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for handle in self._retry_handles:
+            handle.cancel()
+        self._retry_handles.clear()
+        # whatever is still pending stays in the database and is picked up on the next start
+        self._active.clear()
+        for future in self._outcomes.values():
+            future.cancel()
+        self._outcomes.clear()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+# handlers submit through this singleton
+transaction_submitter = TransactionSubmitter()
+
+# A small command line tool to look at failed submissions and put them back in the queue; a running bot
+# picks up submissions put back this way within SUBMIT_POLL_INTERVAL seconds.
+#   python submitter.py failed
+#   python submitter.py retry <key>
+def _cli() -> None:
+    connection = connect_sqlite(SUBMIT_PATH)
+    if len(sys.argv) >= 2 and sys.argv[1] == "failed":
+        for key, chat_id, attempts, error in connection.execute(
+            "SELECT key, chat_id, attempts, error FROM submissions WHERE status = ? ORDER BY created DESC", (FAILED,)
+        ):
+            print(f"{key}  chat={chat_id}  attempts={attempts}  {error}")
+    elif len(sys.argv) == 3 and sys.argv[1] == "retry":
+        updated = connection.execute(
+            "UPDATE submissions SET status = ?, attempts = MIN(attempts, 1), next_attempt_at = ? WHERE key = ? AND status = ?",
+            (PENDING, time.time(), sys.argv[2], FAILED),
+        ).rowcount
+        print("Queued for retry." if updated else "No failed submission with that key.")
+    else:
+        print("usage: python submitter.py failed | retry <key>")
+
+if __name__ == "__main__":
+    _cli()
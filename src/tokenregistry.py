@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from helpers import data_path
+from persistence import connect_sqlite
+from objects import TokenInfo
+
+logger = logging.getLogger(__name__)
+
+TOKEN_REGISTRY_PATH = os.getenv("TOKEN_REGISTRY_PATH", data_path("tokens.sqlite3"))
+
+# a token the bot deployed for a user
+class TokenRecord:
+    __slots__ = ("id", "owner_id", "chain_id", "address", "name", "ticker", "description", "image_file_id", "transaction_id", "created")
+
+    def __init__(self, id: int, owner_id: int, chain_id: str, address: Optional[str], name: str, ticker: str,
+                 description: str, image_file_id: str, transaction_id: str, created: float):
+        self.id = id
+        self.owner_id = owner_id
+        self.chain_id = chain_id
+        self.address = address
+        self.name = name
+        self.ticker = ticker
+        self.description = description
+        self.image_file_id = image_file_id
+        self.transaction_id = transaction_id
+        self.created = created
+
+COLUMNS = ", ".join(TokenRecord.__slots__)
+
+# Every token deployed through the bot, written when its deployment callback is handled. Tokens are indexed by owner
+# (newest first) and by contract address, so listing a user's tokens is an index range read, and pages are found by
+# keyset pagination: the next page starts below the id of the last token shown, whichever page that is, instead of
+# counting past an offset. Reads are single index lookups, cheap enough to do on the event loop.
+class TokenRegistry:
+    def __init__(self, path: str = TOKEN_REGISTRY_PATH):
+        self._path = path
+        self._connection = None
+
+    def _db(self):
+        # opened on first use
+        if self._connection is None:
+            self._connection = connect_sqlite(self._path)
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS tokens (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    owner_id INTEGER NOT NULL,
+                    chain_id TEXT NOT NULL,
+                    address TEXT,
+                    name TEXT NOT NULL,
+                    ticker TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    image_file_id TEXT NOT NULL,
+                    transaction_id TEXT NOT NULL UNIQUE,
+                    created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS tokens_by_owner ON tokens (owner_id, id);
+                CREATE INDEX IF NOT EXISTS tokens_by_address ON tokens (address);
+                """
+            )
+        return self._connection
+
+    def _write(self, owner_id: int, chain_id: str, address: Optional[str], token_info: TokenInfo, transaction_id: str) -> bool:
+        # a callback can arrive twice, and a reconciled one (without the address) can be followed by the real one
+        connection = self._db()
+        inserted = connection.execute(
+            """
+            INSERT INTO tokens (owner_id, chain_id, address, name, ticker, description, image_file_id, transaction_id, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (transaction_id) DO NOTHING
+            """,
+            (owner_id, str(chain_id), address.lower() if address else None, token_info.name, token_info.ticker,
+             token_info.description, token_info.image_file_id, transaction_id, time.time()),
+        ).rowcount == 1
+        if not inserted and address:
+            connection.execute(
+                "UPDATE tokens SET address = ? WHERE transaction_id = ? AND address IS NULL", (address.lower(), transaction_id)
+            )
+        return inserted
+
+    async def add(self, owner_id: int, chain_id: str, address: Optional[str], token_info: TokenInfo, transaction_id: str) -> bool:
+        """Record a deployed token, address is None if we don't know it (yet). Returns False if the token was already
+        recorded, then only a missing address is filled in."""
+        return await asyncio.to_thread(self._write, owner_id, chain_id, address, token_info, transaction_id)
+
+    def page(self, owner_id: int, before: Optional[int] = None, limit: int = 5) -> Tuple[List[TokenRecord], Optional[int]]:
+        """A user's tokens, newest first, starting below the id before. Also returns the cursor of the next page, if any."""
+        # one row more than we show tells us whether there is a next page
+        if before is None:
+            rows = self._db().execute(
+                f"SELECT {COLUMNS} FROM tokens WHERE owner_id = ? ORDER BY id DESC LIMIT ?", (owner_id, limit + 1)
+            ).fetchall()
+        else:
+            rows = self._db().execute(
+                f"SELECT {COLUMNS} FROM tokens WHERE owner_id = ? AND id < ? ORDER BY id DESC LIMIT ?", (owner_id, before, limit + 1)
+            ).fetchall()
+        tokens = [TokenRecord(*row) for row in rows[:limit]]
+        return tokens, (tokens[-1].id if len(rows) > limit else None)
+
+    def get(self, token_id: int) -> Optional[TokenRecord]:
+        row = self._db().execute(f"SELECT {COLUMNS} FROM tokens WHERE id = ?", (token_id,)).fetchone()
+        return TokenRecord(*row) if row else None
+
+    def by_address(self, address: str) -> Optional[TokenRecord]:
+        """The token deployed at a contract address, if the bot deployed it."""
+        row = self._db().execute(f"SELECT {COLUMNS} FROM tokens WHERE address = ?", (address.lower(),)).fetchone()
+        return TokenRecord(*row) if row else None
+
+# the deployment callback writes to it, /mytokens reads from it
+token_registry = TokenRegistry()
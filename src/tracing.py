@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import random
+import secrets
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+from helpers import data_path
+from transport import InstrumentedTransport, TransportSettings
+
+logger = logging.getLogger(__name__)
+
+# the share of token deployments that are traced, 0 turns tracing off
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+# finished spans are appended to this file as JSON lines, set it to an empty string to not write them
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", data_path("traces.jsonl"))
+# and/or sent to an OpenTelemetry collector over OTLP/HTTP, e.g. http://otel-collector:4318/v1/traces
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+# how often (in seconds) spans are exported, and how many may wait for it before new ones are dropped
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+TRACE_BUFFER_LIMIT = int(os.getenv("TRACE_BUFFER_LIMIT", "10000"))
+# the summary is computed over the last this many spans of each stage
+TRACE_SUMMARY_WINDOW = int(os.getenv("TRACE_SUMMARY_WINDOW", "1000"))
+
+TRACING = TRACE_SAMPLE_RATE > 0
+
+# (trace id, span id) of the span the current task is in
+_current: ContextVar[Optional[Tuple[str, str]]] = ContextVar("trace_span", default=None)
+# the times an incoming request reached each step before it became an update (see mark and attach)
+_request_marks: ContextVar[Optional[Dict[str, float]]] = ContextVar("trace_request_marks", default=None)
+
+def new_trace_id() -> Optional[str]:
+    """Start a trace, returns None if this one isn't sampled."""
+    if not TRACING or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    # the first 12 hex digits are the start time in milliseconds (like a UUIDv7), so whoever ends the trace,
+    # in whichever worker or after however many restarts, knows when it started
+    return f"{int(time.time() * 1000):012x}{secrets.token_hex(10)}"
+
+def trace_started_at(trace_id: str) -> float:
+    return int(trace_id[:12], 16) / 1000
+
+def _root_span_id(trace_id: str) -> str:
+    # every span of a trace hangs off the root span, which is only recorded when the trace ends
+    return trace_id[-16:]
+
+# one timed step of a trace
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start", "end", "attributes")
+
+    def __init__(self, trace_id: str, span_id: str, parent_id: Optional[str], name: str, start: float, end: float, attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attributes = attributes
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(self.start * 1e9)),
+            "endTimeUnixNano": str(int(self.end * 1e9)),
+            "attributes": [{"key": key, "value": {"stringValue": str(value)}} for key, value in self.attributes.items()],
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+# A token deployment is one trace: it starts when the user opens the conversation, the trace id is kept in their
+# user_data and then in the TransactionMemo, so the 1Shot API callback (possibly hours and a restart later) joins
+# the same trace. The steps an update goes through before a handler sees it (ingest, signature check, update queue)
+# happen before we know which trace it belongs to, so their times are noted for every update and turned into spans
+# when a handler joins the trace. Spans are buffered and exported in the background; the summary keeps the recent
+# durations of each stage.
+class Tracer:
+    def __init__(self):
+        self._buffer: List[Span] = []
+        # id() of an update in the queue or being handled -> the times it reached each step
+        self._marks: Dict[int, Dict[str, float]] = {}
+        self._durations: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, int] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._export_task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    def mark(self, step: str) -> None:
+        """Note when the request being handled reached a step, before it's turned into an update."""
+        if not TRACING:
+            return
+        marks = _request_marks.get()
+        if marks is None:
+            marks = {}
+            _request_marks.set(marks)
+        marks[step] = time.time()
+
+    def attach(self, update: object) -> None:
+        """Carry the request's marks over to the update that was queued for it."""
+        if not TRACING:
+            return
+        marks = _request_marks.get() or {}
+        # forwarded updates share a connection, and so a context, with the ones before them
+        _request_marks.set(None)
+        marks["queued"] = time.time()
+        self._marks[id(update)] = marks
+
+    def mark_update(self, update: object, step: str, at: Optional[float] = None) -> None:
+        """Note when a queued update reached a step, at defaults to now."""
+        marks = self._marks.get(id(update))
+        if marks is not None:
+            marks[step] = at if at is not None else time.time()
+
+    def release(self, update: object) -> None:
+        """Forget an update's marks once it has been handled."""
+        self._marks.pop(id(update), None)
+
+    def record(self, name: str, start: float, end: float, trace_id: str, parent_id: Optional[str] = None, span_id: Optional[str] = None, **attributes: Any) -> None:
+        """Record a finished span."""
+        durations = self._durations.get(name)
+        if durations is None:
+            durations = self._durations[name] = deque(maxlen=TRACE_SUMMARY_WINDOW)
+        durations.append(end - start)
+        self._counts[name] = self._counts.get(name, 0) + 1
+        if len(self._buffer) >= TRACE_BUFFER_LIMIT:
+            self.dropped += 1
+            return
+        self._buffer.append(Span(trace_id, span_id or secrets.token_hex(8), parent_id, name, start, end, attributes))
+
+    def join(self, trace_id: Optional[str], update: object, source: str, from_start: bool = False) -> None:
+        """Make the rest of the current task part of a trace, and record the steps the update went through to get here.
+        With from_start, also record the time from the start of the trace until the update arrived."""
+        if trace_id is None:
+            return
+        root = _root_span_id(trace_id)
+        _current.set((trace_id, root))
+        marks = self._marks.get(id(update), {})
+        if from_start and "received" in marks:
+            marks["started"] = trace_started_at(trace_id)
+        # (from, to, stage) between the marks an update can have, see mark and mark_update
+        for start_step, end_step, stage in (
+            ("started", "received", "conversation"),
+            ("submitted", "received", "onchain"),
+            ("received", "verified", "verify_signature"),
+            ("verified" if "verified" in marks else "received", "queued", "ingest"),
+            ("queued", "dequeued", "update_queue"),
+        ):
+            if start_step in marks and end_step in marks:
+                self.record(f"{source}.{stage}", marks[start_step], marks[end_step], trace_id, root)
+
+    def record_since(self, name: str, start: float, **attributes: Any) -> None:
+        """Record a span of the current trace, if there is one, that started at start and ends now."""
+        current = _current.get()
+        if current is not None:
+            self.record(name, start, time.time(), current[0], current[1], **attributes)
+
+    def finish(self, trace_id: Optional[str], name: str, **attributes: Any) -> None:
+        """Record the root span, from the start of the trace until now."""
+        if trace_id is None:
+            return
+        self.record(name, trace_started_at(trace_id), time.time(), trace_id, span_id=_root_span_id(trace_id), **attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[None]:
+        """Time the block as a span of the current trace, if there is one."""
+        current = _current.get()
+        if current is None:
+            yield
+            return
+        trace_id, parent_id = current
+        span_id = secrets.token_hex(8)
+        token = _current.set((trace_id, span_id))
+        start = time.time()
+        try:
+            yield
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            self.record(name, start, time.time(), trace_id, parent_id, span_id, **attributes)
+
+    def context(self) -> Optional[Tuple[str, str]]:
+        """The current trace and span, to continue the trace in another task."""
+        return _current.get()
+
+    @contextmanager
+    def resume(self, context: Optional[Tuple[str, str]]) -> Iterator[None]:
+        """Continue a trace from another task inside the block."""
+        token = _current.set(context)
+        try:
+            yield
+        finally:
+            _current.reset(token)
+
+    def summary(self) -> Dict[str, Any]:
+        """The recent durations of each stage, in milliseconds."""
+        stages = {}
+        for name, durations in self._durations.items():
+            ordered = sorted(durations)
+            stages[name] = {
+                "count": self._counts[name],
+                "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                "max_ms": round(ordered[-1] * 1000, 1),
+            }
+        return {"sample_rate": TRACE_SAMPLE_RATE, "window": TRACE_SUMMARY_WINDOW, "stages": stages}
+
+    def _write(self, lines: str) -> None:
+        with open(TRACE_EXPORT_PATH, "a") as f:
+            f.write(lines)
+
+    async def export(self) -> None:
+        """Write out the spans finished since the last export."""
+        if not self._buffer:
+            return
+        spans, self._buffer = self._buffer, []
+        if TRACE_EXPORT_PATH:
+            await asyncio.to_thread(self._write, "".join(json.dumps(span.to_dict(), default=str) + "\n" for span in spans))
+        if self._client is not None:
+            response = await self._client.post(TRACE_OTLP_ENDPOINT, json={
+                "resourceSpans": [{
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "1shot-telegram-bot"}}]},
+                    "scopeSpans": [{"scope": {"name": "bot"}, "spans": [span.to_otlp() for span in spans]}],
+                }]
+            })
+            response.raise_for_status()
+
+    async def _export_loop(self) -> None:
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            try:
+                await self.export()
+            except Exception as e:
+                logger.warning("Failed to export spans: %s", e)
+
+    async def start(self) -> None:
+        if not TRACING:
+            return
+        if TRACE_OTLP_ENDPOINT:
+            settings = TransportSettings("tracing")
+            self._client = httpx.AsyncClient(transport=InstrumentedTransport(settings), timeout=settings.timeout)
+        self._export_task = asyncio.create_task(self._export_loop())
+
+    async def stop(self) -> None:
+        if self._export_task is None:
+            return
+        self._export_task.cancel()
+        self._export_task = None
+        try:
+            await self.export()
+        except Exception as e:
+            logger.warning("Failed to export spans: %s", e)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+# the handlers of a token deployment and the webhook routes report to it
+tracer = Tracer()
@@ -0,0 +1,200 @@
+import os
+import time
+import asyncio
+import logging
+import importlib.util
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import httpx
+from telegram.request import HTTPXRequest
+
+from metrics import http_client_request_duration, http_client_pool_wait, http_client_requests
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 needs the h2 package (pip install httpx[http2]), without it we stay on HTTP/1.1
+H2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+def _setting(client: str, name: str, default: str) -> str:
+    # every setting can be given for one client (TELEGRAM_HTTP_MAX_CONNECTIONS) or for both (HTTP_MAX_CONNECTIONS)
+    return os.getenv(f"{client.upper()}_{name}", os.getenv(name, default))
+
+# Connection pool and timeout settings for one outbound client, read from the environment
+class TransportSettings:
+    def __init__(self, client: str):
+        self.client = client
+        # connections in the pool, how many of them are kept open when idle, and for how long (in seconds)
+        self.max_connections = int(_setting(client, "HTTP_MAX_CONNECTIONS", "100"))
+        self.max_keepalive_connections = int(_setting(client, "HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+        self.keepalive_expiry = float(_setting(client, "HTTP_KEEPALIVE_EXPIRY", "30"))
+        # requests in flight to a single host at once, the rest wait their turn before they take a connection
+        self.max_per_host = int(_setting(client, "HTTP_MAX_PER_HOST", "64"))
+        self.http2 = _setting(client, "HTTP2", "true").lower() in ("1", "true", "yes") and H2_AVAILABLE
+        # default timeouts (in seconds), a call can pass its own or run inside a request_budget
+        self.connect_timeout = float(_setting(client, "HTTP_CONNECT_TIMEOUT", "5"))
+        self.read_timeout = float(_setting(client, "HTTP_READ_TIMEOUT", "10"))
+        self.write_timeout = float(_setting(client, "HTTP_WRITE_TIMEOUT", "10"))
+        self.pool_timeout = float(_setting(client, "HTTP_POOL_TIMEOUT", "5"))
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(connect=self.connect_timeout, read=self.read_timeout, write=self.write_timeout, pool=self.pool_timeout)
+
+# the time.monotonic() by which every request made in the current context has to be done, see request_budget
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+@contextmanager
+def request_budget(seconds: float) -> Iterator[None]:
+    """Give all requests made inside the block, retries and token refreshes included, seconds to finish in total."""
+    deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    # a nested budget can only make the deadline earlier
+    token = _deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+# Hands the response body through and gives back the host slot once the body is read or the response is closed
+class _ReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, release: Any):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+# An httpx transport with a tuned connection pool that caps the requests in flight per host and records, per host,
+# how long each request waited for a connection (the host cap plus the pool), whether it got a kept-alive connection
+# or had to open one, and how long the whole request took. Waiting for a connection is where bursts show up first.
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, settings: TransportSettings):
+        self.settings = settings
+        self._transport = httpx.AsyncHTTPTransport(limits=settings.limits, http2=settings.http2)
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        # host -> requests currently holding a slot, exported as a metric
+        self.in_flight: Dict[str, int] = {}
+        transports.append(self)
+
+    def _slots(self, host: str) -> asyncio.Semaphore:
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = asyncio.Semaphore(self.settings.max_per_host)
+        return slots
+
+    def _apply_budget(self, request: httpx.Request) -> Optional[float]:
+        deadline = _deadline.get()
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise httpx.TimeoutException("Request budget exhausted", request=request)
+        # no single phase of the request may outlast the budget either
+        timeouts = dict(request.extensions.get("timeout", {}))
+        for phase in ("connect", "read", "write", "pool"):
+            value = timeouts.get(phase)
+            timeouts[phase] = remaining if value is None else min(value, remaining)
+        request.extensions["timeout"] = timeouts
+        return remaining
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        client = self.settings.client
+        host = request.url.host
+        started = time.perf_counter()
+        remaining = self._apply_budget(request)
+
+        slots = self._slots(host)
+        try:
+            await asyncio.wait_for(slots.acquire(), request.extensions.get("timeout", {}).get("pool"))
+        except asyncio.TimeoutError:
+            http_client_request_duration.observe(time.perf_counter() - started, client, host, "pool_timeout")
+            raise httpx.PoolTimeout(f"Timed out waiting for one of the {self.settings.max_per_host} slots for {host}", request=request)
+        self.in_flight[host] = self.in_flight.get(host, 0) + 1
+
+        released = False
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self.in_flight[host] -= 1
+                slots.release()
+
+        # httpcore reports what it does through the trace extension: the first event after the pool handed out a
+        # connection is either opening a new one or sending the headers on one that was kept alive
+        connection = []
+        outer_trace = request.extensions.get("trace")
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            if not connection and event_name.endswith(".started") and (
+                event_name.startswith("connection.connect_") or event_name.endswith("send_request_headers.started")
+            ):
+                connection.append("new" if event_name.startswith("connection.") else "reused")
+                http_client_pool_wait.observe(time.perf_counter() - started, client, host)
+                http_client_requests.inc(client, host, connection[0])
+            if outer_trace is not None:
+                await outer_trace(event_name, info)
+        request.extensions["trace"] = trace
+
+        try:
+            if remaining is None:
+                response = await self._transport.handle_async_request(request)
+            else:
+                try:
+                    async with asyncio.timeout(remaining):
+                        response = await self._transport.handle_async_request(request)
+                except TimeoutError:
+                    raise httpx.TimeoutException("Request budget exhausted", request=request)
+        except BaseException as e:
+            release()
+            http_client_request_duration.observe(time.perf_counter() - started, client, host, type(e).__name__)
+            raise
+
+        def finish() -> None:
+            if not released:
+                http_client_request_duration.observe(time.perf_counter() - started, client, host, response.status_code)
+            release()
+        response.stream = _ReleasingStream(response.stream, finish)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+# every transport we built, for the in-flight metric
+transports: List[InstrumentedTransport] = []
+
+def requests_in_flight() -> Dict[tuple, int]:
+    return {(transport.settings.client, host): count for transport in transports for host, count in transport.in_flight.items()}
+
+def telegram_request() -> HTTPXRequest:
+    """The request object python-telegram-bot sends Bot API requests with."""
+    settings = TransportSettings("telegram")
+    # the pool size and HTTP version python-telegram-bot would configure are taken care of by our transport
+    return HTTPXRequest(
+        connection_pool_size=settings.max_connections,
+        connect_timeout=settings.connect_timeout,
+        read_timeout=settings.read_timeout,
+        write_timeout=settings.write_timeout,
+        pool_timeout=settings.pool_timeout,
+        httpx_kwargs={"transport": InstrumentedTransport(settings)},
+    )
+
+def oneshot_http_client() -> httpx.AsyncClient:
+    """The httpx client the 1Shot API client sends its requests with."""
+    settings = TransportSettings("oneshot")
+    return httpx.AsyncClient(transport=InstrumentedTransport(settings), timeout=settings.timeout)
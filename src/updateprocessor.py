@@ -0,0 +1,93 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Hashable, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from uxly_1shot_client import WebhookPayload
+
+from logsetup import log_context
+from journal import update_journal
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# how many chat updates and how many 1Shot API callbacks may be handled at the same time
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+MAX_CONCURRENT_WEBHOOKS = int(os.getenv("MAX_CONCURRENT_WEBHOOKS", "16"))
+
+# updates from the same chat (or user, if there is no chat) must be handled one after the other,
+# otherwise ConversationHandler state transitions could race
+def update_ordering_key(update: object) -> Optional[Hashable]:
+    """Return the key updates are serialized on, None if the update can run in any order."""
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+    return None
+
+def update_log_fields(update: object) -> Dict[str, Any]:
+    """The ids every record logged while handling the update is tagged with."""
+    if isinstance(update, WebhookPayload):
+        # the chat is only known once the memo is decoded, the dispatcher adds it
+        return {"transaction_id": update.data.transaction_execution_id}
+    if isinstance(update, Update):
+        return {"update_id": update.update_id, "chat_id": update.effective_chat.id if update.effective_chat else None}
+    return {}
+
+# Processes updates concurrently while keeping updates of the same chat strictly in order.
+# Chat updates and 1Shot API WebhookPayload updates run in separate lanes with their own limits,
+# so callbacks from 1Shot never wait behind slow chat traffic.
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES, max_concurrent_webhooks: int = MAX_CONCURRENT_WEBHOOKS):
+        # the base class semaphore only bounds how many updates are in flight (running or waiting on their chat),
+        # the lane semaphores below decide how many actually run at once
+        super().__init__(max_concurrent_updates=4 * (max_concurrent_updates + max_concurrent_webhooks))
+        self._chat_lane = asyncio.Semaphore(max_concurrent_updates)
+        self._webhook_lane = asyncio.Semaphore(max_concurrent_webhooks)
+        # ordering key -> [lock, number of updates holding or waiting on it]
+        self._chat_locks: Dict[Hashable, List[Any]] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # every update is processed in its own task, so the log fields only show up on this update's records
+        tracer.mark_update(update, "dequeued")
+        try:
+            with log_context(**update_log_fields(update)):
+                await self._process(update, coroutine)
+        finally:
+            # handled, even if a handler raised; it won't be replayed after a restart
+            update_journal.processed(update)
+            tracer.release(update)
+
+    async def _process(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if isinstance(update, WebhookPayload):
+            async with self._webhook_lane:
+                await coroutine
+            return
+
+        key = update_ordering_key(update)
+        if key is None:
+            async with self._chat_lane:
+                await coroutine
+            return
+
+        # asyncio locks are FIFO, and updates reach us in the order they were queued, so a chat's updates keep their order
+        entry = self._chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._chat_lane:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
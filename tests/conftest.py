@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# the bot's modules live in src/ and import each other by name, and read their settings from the environment when
+# they're imported, so local state goes to a throwaway directory instead of ./data
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+os.environ.setdefault("BOT_DATA_DIR", tempfile.mkdtemp(prefix="bot-tests-"))
@@ -0,0 +1,103 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import admission
+import deploytoken
+from admission import ActionClass, AdmissionControl, ADMISSION_NOTICE_INTERVAL
+from sessions import Session
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(admission, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+def make_control(rate: float = 1, burst: float = 3) -> AdmissionControl:
+    control = AdmissionControl()
+    control.set_limit(ActionClass.MESSAGE, rate, burst)
+    return control
+
+def test_a_burst_is_admitted_and_then_the_rate(clock):
+    control = make_control()
+    assert [control.admit(1, ActionClass.MESSAGE) for _ in range(4)] == [True, True, True, False]
+    assert control.rejected[ActionClass.MESSAGE] == 1
+    # one token comes back every 1/rate seconds
+    clock.now += 1
+    assert [control.admit(1, ActionClass.MESSAGE) for _ in range(2)] == [True, False]
+    # other users and action classes have buckets of their own
+    assert control.admit(2, ActionClass.MESSAGE)
+    assert control.admit(1, ActionClass.TRANSACTION)
+
+def test_an_idle_user_gets_their_whole_burst_back_and_only_once(clock):
+    control = make_control()
+    for _ in range(3):
+        control.admit(1, ActionClass.MESSAGE)
+    clock.now += 100
+    assert [control.admit(1, ActionClass.MESSAGE) for _ in range(4)] == [True, True, True, False]
+
+def test_sweep_forgets_buckets_that_are_full_again(clock):
+    control = make_control()
+    control.admit(1, ActionClass.MESSAGE)
+    for _ in range(3):
+        control.admit(2, ActionClass.MESSAGE)
+    clock.now += 1
+    assert control.sweep() == 1
+    assert control.buckets(ActionClass.MESSAGE) == 1
+    clock.now += 2
+    assert control.sweep() == 1
+    assert control.buckets(ActionClass.MESSAGE) == 0
+
+def test_a_rejected_user_is_told_at_most_once_per_interval(clock):
+    control = make_control()
+    assert control.should_notify(1, ActionClass.MESSAGE)
+    assert not control.should_notify(1, ActionClass.MESSAGE)
+    clock.now += ADMISSION_NOTICE_INTERVAL
+    assert control.should_notify(1, ActionClass.MESSAGE)
+
+def test_limits_must_be_sensible():
+    control = AdmissionControl()
+    with pytest.raises(ValueError):
+        control.set_limit(ActionClass.MESSAGE, 0, 10)
+    with pytest.raises(ValueError):
+        control.set_limit(ActionClass.MESSAGE, 1, 0.5)
+
+def test_a_refund_gives_the_token_back(clock):
+    control = make_control()
+    control.set_limit(ActionClass.TRANSACTION, 1, 1)
+    assert control.admit(1, ActionClass.TRANSACTION)
+    assert not control.admit(1, ActionClass.TRANSACTION)
+    control.refund(1, ActionClass.TRANSACTION)
+    # the bucket is full again, so it isn't kept
+    assert control.buckets(ActionClass.TRANSACTION) == 0
+    assert control.admit(1, ActionClass.TRANSACTION)
+    # refunding a user we don't know is a no-op
+    control.refund(2, ActionClass.TRANSACTION)
+
+def test_a_deployment_that_cant_be_submitted_doesnt_count(clock, monkeypatch):
+    control = make_control()
+    control.set_limit(ActionClass.TRANSACTION, 1, 1)
+    monkeypatch.setattr(deploytoken, "admission_control", control)
+    monkeypatch.setattr(deploytoken.resource_registry, "escrow_wallet", lambda chain_id: SimpleNamespace(account_address="0x" + "11" * 20))
+
+    class FailingSubmitter:
+        async def submit(self, **kwargs):
+            raise OSError("disk full")
+    monkeypatch.setattr(deploytoken, "transaction_submitter", FailingSubmitter())
+
+    session = Session()
+    session.name, session.ticker, session.description, session.image = "Token", "TKN", "A token", "file"
+    update = SimpleNamespace(
+        message=SimpleNamespace(text="100"), effective_user=SimpleNamespace(id=1), effective_chat=SimpleNamespace(id=1),
+    )
+    with pytest.raises(OSError):
+        asyncio.run(deploytoken.finalize_token_deployment(update, SimpleNamespace(user_data=session)))
+    assert control.admit(1, ActionClass.TRANSACTION)
@@ -0,0 +1,139 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import airdrop
+from airdrop import Airdrop, AirdropStore, parse_row, read_batches, validate_batch
+from submitter import SUBMITTED
+
+ADDRESS = "0x" + "ab" * 20
+
+def test_rows_are_an_address_and_a_whole_amount():
+    assert parse_row(f"{ADDRESS},5") == ((ADDRESS, "5" + "0" * 18), None)
+    assert parse_row(f"﻿{ADDRESS} ; 5\n") == ((ADDRESS, "5" + "0" * 18), None)
+    assert parse_row("   \n") == (None, None)
+    assert parse_row(f"{ADDRESS}")[1] == "expected an address and an amount"
+    assert "not a valid address" in parse_row("0x1234,5")[1]
+    assert "not a positive whole number" in parse_row(f"{ADDRESS},0")[1]
+    assert "not a positive whole number" in parse_row(f"{ADDRESS},1.5")[1]
+
+def test_a_header_line_is_not_an_error():
+    batch = validate_batch([(1, "address,amount"), (2, f"{ADDRESS},1"), (3, "address,amount"), (4, "")])
+    assert [row[0] for row in batch.rows] == [2]
+    assert batch.invalid == 1
+    assert batch.errors == ["line 3: address is not a valid address"]
+
+def test_lists_are_read_a_batch_at_a_time(tmp_path):
+    path = tmp_path / "list.txt"
+    path.write_text("address,amount\n" + "".join(f"{ADDRESS},{n}\n" for n in range(1, 6)) + "oops\n")
+
+    async def scenario():
+        return [batch async for batch in read_batches(str(path), batch_size=2)]
+
+    batches = asyncio.run(scenario())
+    assert [len(batch.rows) for batch in batches] == [1, 2, 2, 0]
+    assert [row[0] for batch in batches for row in batch.rows] == [2, 3, 4, 5, 6]
+    assert sum(batch.invalid for batch in batches) == 1
+
+class FakeSubmitter:
+    # every submission stays unsettled until the test settles it
+    def __init__(self):
+        self.chunks = []
+        self.outcomes = {}
+
+    async def submit_many(self, chat_id, chain_id, contract_method_name, executions, keys):
+        self.chunks.append(list(keys))
+        for key in keys:
+            self.outcomes.setdefault(key, asyncio.get_running_loop().create_future())
+        return list(keys)
+
+    def outcome(self, key):
+        return self.outcomes[key]
+
+    def settle(self, chunk: int) -> None:
+        for key in self.chunks[chunk]:
+            self.outcomes[key].set_result(SUBMITTED)
+
+class FakeBot:
+    def __init__(self):
+        self.texts = []
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.texts.append(text)
+
+@pytest.fixture
+def sending(tmp_path, monkeypatch):
+    submitter = FakeSubmitter()
+    store = AirdropStore(path=str(tmp_path / "airdrops.sqlite3"))
+    monkeypatch.setattr(airdrop, "transaction_submitter", submitter)
+    monkeypatch.setattr(airdrop, "airdrop_store", store)
+    monkeypatch.setattr(airdrop, "AIRDROP_CHUNK_SIZE", 2)
+    monkeypatch.setattr(airdrop, "AIRDROP_CHUNKS_IN_FLIGHT", 1)
+    monkeypatch.setattr(airdrop, "AIRDROP_PROGRESS_INTERVAL", 0)
+
+    async def get_transfer_method(chain_id, token_address):
+        return SimpleNamespace(name="Transfer")
+    monkeypatch.setattr(airdrop, "get_transfer_method", get_transfer_method)
+    return submitter, store
+
+def make_airdrop(tmp_path, rows: int, **fields) -> Airdrop:
+    path = tmp_path / "list.txt"
+    path.write_text("".join(f"{ADDRESS},{n}\n" for n in range(1, rows + 1)))
+    token = SimpleNamespace(id=1, chain_id="11155111", address=ADDRESS, ticker="TKN")
+    return Airdrop(FakeBot(), user_id=7, chat_id=7, message_id=1, token=token, path=str(path), total=rows, **fields)
+
+def test_a_chunk_is_only_read_once_there_is_room_for_it(tmp_path, sending):
+    submitter, store = sending
+
+    async def scenario():
+        drop = make_airdrop(tmp_path, 5)
+        await store.save(drop)
+        task = asyncio.create_task(drop.run())
+        await asyncio.sleep(0.05)
+        assert len(submitter.chunks) == 1
+        submitter.settle(0)
+        await asyncio.sleep(0.05)
+        assert len(submitter.chunks) == 2
+        assert drop.next_line == 3
+        assert await store.load() == [(drop.id, 7, 7, 1, 1, drop.path, 5, 3, 2, 0)]
+        submitter.settle(1)
+        await asyncio.sleep(0.05)
+        submitter.settle(2)
+        await task
+        assert drop.bot.texts[-1].startswith("✅ Airdrop finished\n\nSent: 5 of 5")
+        # it's done, so it's forgotten with its list
+        assert await store.load() == []
+        assert not (tmp_path / "list.txt").exists()
+    asyncio.run(scenario())
+
+def test_a_resumed_airdrop_carries_on_from_where_it_got_to(tmp_path, sending):
+    submitter, store = sending
+
+    async def scenario():
+        drop = make_airdrop(tmp_path, 5, id="a" * 22, next_line=3, submitted=2)
+        task = asyncio.create_task(drop.run())
+        await asyncio.sleep(0.05)
+        # the same keys as the first time around, so the submitter skips what it already has
+        assert submitter.chunks == [["a" * 22 + "0000000003", "a" * 22 + "0000000004"]]
+        submitter.settle(0)
+        await asyncio.sleep(0.05)
+        submitter.settle(1)
+        await task
+        assert drop.submitted == 5
+    asyncio.run(scenario())
+
+def test_stopping_keeps_the_airdrop_for_the_next_start(tmp_path, sending):
+    submitter, store = sending
+
+    async def scenario():
+        drop = make_airdrop(tmp_path, 5)
+        await store.save(drop)
+        airdrop.running[drop.user_id] = drop
+        drop.task = asyncio.create_task(drop.run())
+        await asyncio.sleep(0.05)
+        await airdrop.stop_airdrops()
+        assert drop.user_id not in airdrop.running
+        assert len(await store.load()) == 1
+        assert (tmp_path / "list.txt").exists()
+    asyncio.run(scenario())
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from cache import AsyncTTLCache
+
+class Loader:
+    def __init__(self):
+        self.calls = []
+        self.release = asyncio.Event()
+
+    async def __call__(self, key):
+        self.calls.append(key)
+        await self.release.wait()
+        return f"value-{key}"
+
+def test_concurrent_misses_share_one_fetch():
+    async def scenario():
+        loader = Loader()
+        cache = AsyncTTLCache(loader, ttl=60, max_size=10)
+        waiting = [asyncio.create_task(cache.get("a")) for _ in range(10)]
+        await asyncio.sleep(0)
+        loader.release.set()
+        assert await asyncio.gather(*waiting) == ["value-a"] * 10
+        assert loader.calls == ["a"]
+        # and the value is cached from then on
+        assert await cache.get("a") == "value-a"
+        assert loader.calls == ["a"]
+    asyncio.run(scenario())
+
+def test_a_cancelled_caller_does_not_cancel_the_shared_fetch():
+    async def scenario():
+        loader = Loader()
+        cache = AsyncTTLCache(loader, ttl=60, max_size=10)
+        cancelled, waiting = asyncio.create_task(cache.get("a")), asyncio.create_task(cache.get("a"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        loader.release.set()
+        assert await waiting == "value-a"
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert loader.calls == ["a"]
+    asyncio.run(scenario())
+
+def test_refresh_bypasses_the_cached_value_and_expired_entries_are_fetched_again():
+    async def scenario():
+        loader = Loader()
+        loader.release.set()
+        cache = AsyncTTLCache(loader, ttl=60, max_size=10)
+        cache.put("a", "stale")
+        assert await cache.get("a") == "stale"
+        assert await cache.get("a", refresh=True) == "value-a"
+        cache.put("b", "expired", ttl=-1)
+        assert await cache.get("b") == "value-b"
+        assert loader.calls == ["a", "b"]
+    asyncio.run(scenario())
+
+def test_least_recently_used_entry_is_evicted():
+    cache = AsyncTTLCache(None, ttl=60, max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.peek("a")
+    cache.put("c", 3)
+    assert (cache.peek("a"), cache.peek("b"), cache.peek("c")) == (1, None, 3)
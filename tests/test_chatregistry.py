@@ -0,0 +1,101 @@
+import asyncio
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram import Chat, ChatMember
+
+import chattracker
+from chatregistry import ChatRegistry
+from chattracker import track_chat_admins
+
+class FakeBot:
+    def __init__(self, admins):
+        self.admins = admins
+        self.fetches = 0
+
+    async def get_chat_administrators(self, chat_id):
+        self.fetches += 1
+        await asyncio.sleep(0.01)
+        return [SimpleNamespace(user=SimpleNamespace(id=user_id)) for user_id in self.admins]
+
+def group(chat_id: int = -100) -> SimpleNamespace:
+    return SimpleNamespace(id=chat_id, type=Chat.SUPERGROUP, title="Group")
+
+def test_concurrent_admin_lookups_share_one_fetch():
+    async def scenario():
+        registry = ChatRegistry(path=None)
+        bot = FakeBot([1, 2])
+        await registry.start(bot)
+        results = await asyncio.gather(*(registry.is_admin(-100, 1) for _ in range(5)))
+        assert results == [True] * 5
+        assert bot.fetches == 1
+    asyncio.run(scenario())
+
+def test_chats_and_admins_are_reloaded_for_what_is_left_of_their_ttl(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "chats.sqlite3")
+        registry = ChatRegistry(admin_ttl=600, path=path)
+        await registry.start(FakeBot([1]))
+        registry.set_membership(group(), True)
+        registry.set_membership(group(-200), False)
+        assert await registry.admins(-100) == {1}
+        await registry.stop()
+        # fetched 500 of its 600 seconds ago
+        connection = sqlite3.connect(path)
+        connection.execute("UPDATE chat_admins SET fetched = ?", (time.time() - 500,))
+        connection.commit()
+        connection.close()
+
+        bot = FakeBot([2])
+        registry = ChatRegistry(admin_ttl=600, path=path)
+        await registry.start(bot)
+        assert registry.groups() == [-100]
+        assert registry.is_member(-100) and not registry.is_member(-200)
+        assert await registry.admins(-100) == {1}
+        assert bot.fetches == 0
+        assert 90 < registry._admins._entries[-100][1] - time.monotonic() <= 100
+        await registry.stop()
+    asyncio.run(scenario())
+
+def test_a_failed_write_is_rolled_back_and_tried_again(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "chats.sqlite3")
+        registry = ChatRegistry(path=path)
+        await registry.start(FakeBot([]))
+        registry.set_membership(group(), True)
+        # another worker holds the write lock
+        blocker = sqlite3.connect(path, isolation_level=None)
+        blocker.execute("BEGIN IMMEDIATE")
+        registry._connection.execute("PRAGMA busy_timeout=0")
+        with pytest.raises(sqlite3.OperationalError):
+            await registry.flush()
+        blocker.execute("ROLLBACK")
+        blocker.close()
+        assert not registry._connection.in_transaction
+        await registry.flush()
+        assert registry._connection.execute("SELECT chat_id FROM chats").fetchall() == [(-100,)]
+        await registry.stop()
+    asyncio.run(scenario())
+
+def member_update(old_status: str, new_status: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        effective_chat=group(),
+        chat_member=SimpleNamespace(
+            old_chat_member=SimpleNamespace(status=old_status), new_chat_member=SimpleNamespace(status=new_status),
+        ),
+    )
+
+@pytest.mark.parametrize("old_status, new_status, invalidated", [
+    (ChatMember.MEMBER, ChatMember.ADMINISTRATOR, True),
+    (ChatMember.ADMINISTRATOR, ChatMember.LEFT, True),
+    (ChatMember.ADMINISTRATOR, ChatMember.ADMINISTRATOR, False),
+    (ChatMember.MEMBER, ChatMember.LEFT, False),
+])
+def test_admin_lists_are_dropped_when_someone_is_promoted_or_demoted(monkeypatch, old_status, new_status, invalidated):
+    registry = ChatRegistry(path=None)
+    registry._admins.put(-100, frozenset([1]))
+    monkeypatch.setattr(chattracker, "chat_registry", registry)
+    asyncio.run(track_chat_admins(member_update(old_status, new_status), None))
+    assert (registry._admins.peek(-100) is None) == invalidated
@@ -0,0 +1,82 @@
+import asyncio
+import sqlite3
+
+import pytest
+from uxly_1shot_client import WebhookPayload
+
+import dedup
+from dedup import DedupIndex, callback_dedup_key, is_reconciled, update_dedup_key
+
+def test_keys_are_duplicates_within_the_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, "time", lambda: now[0])
+    index = DedupIndex(window=60, path=None)
+    assert not index.seen_before("a")
+    assert index.seen_before("a")
+    now[0] += 61
+    assert not index.seen_before("a")
+    assert index.duplicates == 1
+
+def test_only_the_newest_keys_are_kept():
+    index = DedupIndex(window=60, max_entries=2, path=None)
+    for key in ("a", "b", "c"):
+        index.seen_before(key)
+    assert len(index) == 2
+    assert not index.seen_before("a")
+    assert index.seen_before("c")
+
+def test_keys_are_reloaded_from_disk(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "dedup.sqlite3")
+        index = DedupIndex(window=60, path=path)
+        await index.start()
+        index.seen_before("a")
+        index.seen_before("forgotten")
+        index.forget("forgotten")
+        await index.stop()
+
+        index = DedupIndex(window=60, path=path)
+        await index.start()
+        assert index.seen_before("a")
+        assert not index.seen_before("forgotten")
+        await index.stop()
+    asyncio.run(scenario())
+
+def test_a_failed_write_is_rolled_back_and_tried_again(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "dedup.sqlite3")
+        index = DedupIndex(window=60, path=path)
+        await index.start()
+        index.seen_before("a")
+        # another worker holds the write lock
+        blocker = sqlite3.connect(path, isolation_level=None)
+        blocker.execute("BEGIN IMMEDIATE")
+        index._connection.execute("PRAGMA busy_timeout=0")
+        with pytest.raises(sqlite3.OperationalError):
+            await index.flush()
+        blocker.execute("ROLLBACK")
+        blocker.close()
+        assert not index._connection.in_transaction
+        await index.flush()
+        assert index._connection.execute("SELECT key FROM seen").fetchall() == [("a",)]
+        await index.stop()
+    asyncio.run(scenario())
+
+def test_a_reconciled_result_has_a_key_of_its_own():
+    def payload(signature: str) -> WebhookPayload:
+        return WebhookPayload(
+            eventName="TransactionExecutionSuccess",
+            data={"businessId": "business", "chain": 11155111, "logs": None, "transactionExecutionId": "tx", "transactionExecutionMemo": None, "transactionId": "method"},
+            timestamp=0,
+            apiVersion=0,
+            signature=signature,
+        )
+    reconciled, real = payload(""), payload("signed")
+    assert is_reconciled(reconciled) and not is_reconciled(real)
+    assert update_dedup_key(real) == callback_dedup_key(reconciled)
+    assert update_dedup_key(reconciled) != update_dedup_key(real)
+
+    index = DedupIndex(window=60, path=None)
+    assert not index.contains("a")
+    assert not index.seen_before("a")
+    assert index.contains("a")
@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from uxly_1shot_client import WebhookPayload
+
+from dispatcher import WebhookDispatcher, index_logs
+from objects import TransactionMemo, TxType
+
+SUCCESS = "TransactionExecutionSuccess"
+
+def callback(memo, event_name: str = SUCCESS) -> WebhookPayload:
+    return WebhookPayload(
+        eventName=event_name,
+        data={
+            "businessId": "business",
+            "chain": 11155111,
+            "logs": None,
+            "transactionExecutionId": "tx",
+            "transactionExecutionMemo": memo.encode() if memo is not None else None,
+            "transactionId": "method",
+        },
+        timestamp=0,
+        apiVersion=0,
+        signature="",
+    )
+
+def memo(tx_type: TxType) -> TransactionMemo:
+    return TransactionMemo(tx_type=tx_type, associated_user_id=1)
+
+def make_dispatcher(handled: list) -> WebhookDispatcher:
+    dispatcher = WebhookDispatcher()
+
+    @dispatcher.handler(SUCCESS, TxType.TOKEN_CREATION)
+    async def token_created(update, memo, logs, context):
+        handled.append(("token_created", memo.tx_type))
+
+    @dispatcher.handler(SUCCESS, None)
+    async def any_success(update, memo, logs, context):
+        handled.append(("any_success", memo.tx_type))
+
+    return dispatcher
+
+def test_specific_handler_wins_over_the_fallback():
+    handled = []
+    dispatcher = make_dispatcher(handled)
+    assert asyncio.run(dispatcher.dispatch(callback(memo(TxType.TOKEN_CREATION)), None))
+    assert handled == [("token_created", TxType.TOKEN_CREATION)]
+
+def test_fallback_handles_types_without_a_handler_of_their_own():
+    handled = []
+    dispatcher = make_dispatcher(handled)
+    assert asyncio.run(dispatcher.dispatch(callback(memo(TxType.TOKENS_MINTED)), None))
+    assert handled == [("any_success", TxType.TOKENS_MINTED)]
+
+def test_unhandled_events_and_missing_memos_are_reported():
+    handled = []
+    dispatcher = make_dispatcher(handled)
+    assert not asyncio.run(dispatcher.dispatch(callback(memo(TxType.TOKEN_CREATION), "TransactionExecutionFailure"), None))
+    assert not asyncio.run(dispatcher.dispatch(callback(None), None))
+    assert handled == []
+
+def test_a_handler_can_only_be_registered_once():
+    dispatcher = make_dispatcher([])
+    with pytest.raises(ValueError):
+        dispatcher.handler(SUCCESS, None)(lambda *args: None)
+
+def test_logs_are_indexed_by_the_names_asked_for():
+    logs = [SimpleNamespace(name=name) for name in ("Transfer", "TokenCreated", "Transfer")]
+    index = index_logs(logs, ["Transfer", "Approval"])
+    assert [len(index["Transfer"]), len(index["Approval"])] == [2, 0]
+    assert "TokenCreated" not in index
+    assert index_logs(None, ["Transfer"]) == {"Transfer": []}
+
+def test_a_callback_after_a_reconciled_result_only_reaches_handlers_that_want_it():
+    handled = []
+    dispatcher = WebhookDispatcher()
+
+    @dispatcher.handler(SUCCESS, TxType.TOKEN_CREATION, after_reconciled=True)
+    async def token_created(update, memo, logs, context):
+        handled.append("token_created")
+
+    @dispatcher.handler(SUCCESS, None)
+    async def any_success(update, memo, logs, context):
+        handled.append("any_success")
+
+    assert asyncio.run(dispatcher.dispatch(callback(memo(TxType.TOKEN_CREATION)), None, after_reconciled=True))
+    # handled already, so it isn't reported as unhandled
+    assert asyncio.run(dispatcher.dispatch(callback(memo(TxType.TOKENS_MINTED)), None, after_reconciled=True))
+    assert handled == ["token_created"]
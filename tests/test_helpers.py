@@ -0,0 +1,114 @@
+import asyncio
+import json
+import threading
+
+import pytest
+from fastapi import HTTPException
+from uxly_1shot_client import WebhookPayload
+
+import helpers
+from helpers import webhookAuthenticator
+
+class FakeKeyStore:
+    def __init__(self):
+        self.refreshes = 0
+
+    async def get(self, contract_method_id, refresh=False):
+        self.refreshes += refresh
+        return f"key-{self.refreshes}"
+
+class FakeRequest:
+    def __init__(self, body: dict):
+        self._body = json.dumps(body).encode()
+        self.reads = 0
+
+    async def body(self) -> bytes:
+        self.reads += 1
+        return self._body
+
+def forged(contract_method_id: str) -> FakeRequest:
+    return FakeRequest({"signature": "forged", "data": {"transactionId": contract_method_id, "transactionExecutionId": "t"}})
+
+def test_bad_signatures_refetch_the_key_at_most_once_per_interval(monkeypatch):
+    async def scenario():
+        keys = FakeKeyStore()
+        monkeypatch.setattr(helpers, "public_key_store", keys)
+        monkeypatch.setattr(helpers, "is_valid_webhook_signature", lambda body, signature, public_key: False)
+        authenticator = webhookAuthenticator(refresh_interval=60)
+        for contract_method_id in ("a", "a", "a", "b"):
+            with pytest.raises(HTTPException) as rejected:
+                await authenticator(forged(contract_method_id))
+            assert rejected.value.status_code == 403
+        # once for a, once for b
+        assert keys.refreshes == 2
+
+        authenticator._refreshed_at["a"] -= 60
+        with pytest.raises(HTTPException):
+            await authenticator(forged("a"))
+        assert keys.refreshes == 3
+    asyncio.run(scenario())
+
+def callback(logs: int = 0) -> dict:
+    return {
+        "eventName": "TransactionExecutionSuccess",
+        "data": {
+            "businessId": "business",
+            "chain": 11155111,
+            "logs": [
+                {
+                    "args": [str(n)],
+                    "fragment": {"anonymous": False, "inputs": [], "name": "Transfer", "type": "event"},
+                    "name": "Transfer",
+                    "signature": "Transfer(uint256)",
+                    "topic": "0x" + "ab" * 32,
+                }
+                for n in range(logs)
+            ],
+            "transactionExecutionId": "t",
+            "transactionExecutionMemo": None,
+            "transactionId": "method",
+        },
+        "timestamp": 0,
+        "apiVersion": 0,
+        "signature": "signed",
+    }
+
+@pytest.fixture
+def verified(monkeypatch):
+    # the threads signatures were checked on
+    threads = []
+
+    def is_valid_webhook_signature(body, signature, public_key):
+        threads.append(threading.current_thread())
+        return True
+
+    monkeypatch.setattr(helpers, "public_key_store", FakeKeyStore())
+    monkeypatch.setattr(helpers, "is_valid_webhook_signature", is_valid_webhook_signature)
+    return threads
+
+def test_the_validated_payload_is_returned_from_a_single_read_and_parse(monkeypatch, verified):
+    parses = []
+
+    def json_loads(data):
+        parses.append(data)
+        return json.loads(data)
+    monkeypatch.setattr(helpers, "json_loads", json_loads)
+
+    request = FakeRequest(callback(logs=1))
+    payload = asyncio.run(webhookAuthenticator()(request))
+    assert isinstance(payload, WebhookPayload)
+    assert payload.data.transaction_execution_id == "t"
+    assert payload.data.logs[0].name == "Transfer"
+    assert request.reads == 1
+    assert len(parses) == 1
+
+def test_big_payloads_are_verified_off_the_event_loop(monkeypatch, verified):
+    monkeypatch.setattr(helpers, "VERIFY_IN_THREAD_BYTES", len(json.dumps(callback(logs=1))))
+
+    async def scenario():
+        authenticator = webhookAuthenticator()
+        await authenticator(FakeRequest(callback(logs=1)))
+        await authenticator(FakeRequest(callback(logs=50)))
+    asyncio.run(scenario())
+    assert verified[0] is threading.main_thread()
+    assert verified[1] is not threading.main_thread()
@@ -0,0 +1,49 @@
+import asyncio
+from http import HTTPStatus
+
+from ingestqueue import IngestQueue, UpdatePriority
+
+def test_admission_counts_updates_taken_off_the_queue():
+    async def scenario():
+        queue = IngestQueue(low_watermark=5, high_watermark=10, limit=20)
+        for _ in range(20):
+            assert queue.admit(UpdatePriority.NORMAL) is None
+            await queue.put(object())
+        # the Application takes updates off the queue straight away when it handles them concurrently
+        while not queue.empty():
+            await queue.get()
+        assert queue.qsize() == 0
+        assert queue.in_flight == 20
+        assert queue.admit(UpdatePriority.LOW) == HTTPStatus.OK
+        assert queue.shedding
+        assert queue.admit(UpdatePriority.NORMAL) == HTTPStatus.TOO_MANY_REQUESTS
+        assert queue.admit(UpdatePriority.CRITICAL) is None
+        assert (queue.shed, queue.rejected) == (1, 1)
+    asyncio.run(scenario())
+
+def test_shedding_stops_below_the_low_watermark():
+    async def scenario():
+        queue = IngestQueue(low_watermark=5, high_watermark=10, limit=20)
+        for _ in range(10):
+            await queue.put(object())
+            await queue.get()
+        queue.admit(UpdatePriority.NORMAL)
+        assert queue.shedding
+        # handled updates are marked done with task_done()
+        for _ in range(4):
+            queue.task_done()
+        queue.admit(UpdatePriority.NORMAL)
+        assert queue.shedding
+        queue.task_done()
+        assert queue.admit(UpdatePriority.LOW) is None
+        assert not queue.shedding
+    asyncio.run(scenario())
+
+def test_clear_drops_waiting_updates():
+    async def scenario():
+        queue = IngestQueue()
+        for _ in range(3):
+            await queue.put(object())
+        assert queue.clear() == 3
+        assert queue.in_flight == 0
+    asyncio.run(scenario())
@@ -0,0 +1,106 @@
+import asyncio
+import os
+
+import journal as journal_module
+from journal import UpdateJournal, _read_segment
+from sharding import UpdateKind
+
+class Update:
+    # anything that isn't a telegram Update is journaled as a 1Shot API callback
+    def __init__(self, body: bytes):
+        self.body = body
+
+async def write(directory: str, bodies, handled=()) -> None:
+    journal = UpdateJournal(str(directory))
+    await journal.start()
+    updates = [Update(body) for body in bodies]
+    for update in updates:
+        await journal.append(update, update.body)
+    for index in handled:
+        journal.processed(updates[index])
+    await journal.stop()
+
+async def replay(directory: str, decode=lambda kind, body: body):
+    journal = UpdateJournal(str(directory))
+    await journal.start()
+    replayed = []
+
+    async def put(update):
+        replayed.append(update)
+    await journal.replay(decode, put)
+    await journal.stop()
+    return replayed
+
+def segment(directory) -> str:
+    worker = os.path.join(directory, "worker-0")
+    return os.path.join(worker, sorted(name for name in os.listdir(worker) if name.endswith(".journal"))[-1])
+
+def test_updates_not_handled_are_replayed_in_order(tmp_path):
+    async def scenario():
+        await write(tmp_path, [b"one", b"two", b"three"], handled=[1])
+        assert await replay(tmp_path) == [b"one", b"three"]
+    asyncio.run(scenario())
+
+def test_a_torn_record_at_the_end_is_cut_off(tmp_path):
+    async def scenario():
+        await write(tmp_path, [b"one", b"two"])
+        path = segment(tmp_path)
+        whole = os.path.getsize(path)
+        with open(path, "ab") as f:
+            f.write(b"A\x00\x00")
+        assert await replay(tmp_path) == [b"one", b"two"]
+        assert os.path.getsize(path) == whole
+    asyncio.run(scenario())
+
+def test_a_record_with_a_bad_crc_ends_the_segment(tmp_path):
+    async def scenario():
+        await write(tmp_path, [b"one", b"two"])
+        path = segment(tmp_path)
+        with open(path, "r+b") as f:
+            data = f.read()
+            f.seek(data.rindex(b"two"))
+            f.write(b"TWO")
+        appended, _, _ = _read_segment(path)
+        assert [(kind, body) for _, kind, body in appended] == [(UpdateKind.ONESHOT, b"one")]
+    asyncio.run(scenario())
+
+def test_updates_that_cant_be_decoded_are_skipped_for_good(tmp_path):
+    def decode(kind, body):
+        if body == b"bad":
+            raise ValueError("not an update")
+        return body
+
+    async def scenario():
+        await write(tmp_path, [b"bad", b"good"])
+        assert await replay(tmp_path, decode) == [b"good"]
+        # nothing was handled, but the undecodable one isn't tried again
+        assert await replay(tmp_path, decode) == [b"good"]
+    asyncio.run(scenario())
+
+async def crash(journal: UpdateJournal) -> None:
+    # the process dies: the commit loop stops where it is, nothing else is written
+    journal._task.cancel()
+    try:
+        await journal._task
+    except asyncio.CancelledError:
+        pass
+    journal._file.close()
+
+def test_updates_survive_a_restart_that_fails_before_replaying_them(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal_module, "JOURNAL_CHECKPOINT_INTERVAL", 0.01)
+
+    async def scenario():
+        journal = UpdateJournal(str(tmp_path))
+        await journal.start()
+        await journal.append(Update(b"one"), b"one")
+        await crash(journal)
+
+        # startup fails after a few checkpoint intervals, before the update is replayed
+        journal = UpdateJournal(str(tmp_path))
+        await journal.start()
+        assert journal.pending == 1
+        await asyncio.sleep(0.1)
+        await crash(journal)
+
+        assert await replay(tmp_path) == [b"one"]
+    asyncio.run(scenario())
@@ -0,0 +1,36 @@
+import json
+
+import memostore
+from memostore import MemoPayloadStore, decode_memo, encode_memo
+from objects import MEMO_VERSION, TokenInfo, TransactionMemo, TxType
+
+TOKEN = {"name": "My Token", "ticker": "MTK", "description": "A token", "image_file_id": "AgAC"}
+
+def test_original_token_creation_memo_carries_its_token_in_note_to_user():
+    legacy = json.dumps({"tx_type": TxType.TOKEN_CREATION.value, "associated_user_id": 12345, "note_to_user": json.dumps(TOKEN)})
+    memo = TransactionMemo.decode(legacy)
+    assert memo.version == 1
+    assert memo.tx_type == TxType.TOKEN_CREATION
+    assert memo.associated_user_id == 12345
+    assert memo.payload == TokenInfo(**TOKEN)
+    assert memo.note_to_user is None
+
+def test_original_memo_of_other_transactions_keeps_its_note():
+    legacy = json.dumps({"tx_type": TxType.TOKENS_MINTED.value, "associated_user_id": 1, "note_to_user": "minted"})
+    memo = TransactionMemo.decode(legacy)
+    assert (memo.version, memo.tx_type, memo.note_to_user, memo.payload) == (1, TxType.TOKENS_MINTED, "minted", None)
+
+def test_compact_memo_round_trips():
+    memo = TransactionMemo(tx_type=TxType.TOKEN_CREATION, associated_user_id=7, payload=TokenInfo(**TOKEN), idempotency_key="abc")
+    encoded = memo.encode()
+    assert json.loads(encoded)["v"] == MEMO_VERSION
+    assert "note_to_user" not in encoded
+    assert TransactionMemo.decode(encoded) == memo
+
+def test_long_payloads_are_stored_by_reference(tmp_path, monkeypatch):
+    monkeypatch.setattr(memostore, "memo_payload_store", MemoPayloadStore(path=str(tmp_path / "memos.sqlite3")))
+    memo = TransactionMemo(tx_type=TxType.TOKEN_CREATION, associated_user_id=7, payload=TokenInfo(**{**TOKEN, "description": "x" * 1000}))
+    encoded = encode_memo(memo, inline_limit=512)
+    assert len(encoded) < 512
+    assert json.loads(encoded)["r"]
+    assert decode_memo(encoded).payload == memo.payload
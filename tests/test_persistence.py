@@ -0,0 +1,114 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+from telegram.ext import Application
+
+import persistence
+from persistence import LazyUserDataApplication, SQLitePersistence
+from sessions import Session, SessionStore
+
+def session(name: str) -> Session:
+    data = Session()
+    data.name = name
+    return data
+
+def test_user_data_and_conversations_survive_a_restart(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+
+    async def scenario():
+        store = SQLitePersistence(path=path)
+        await store.update_user_data(1, session("one"))
+        await store.update_user_data(2, session("two"))
+        await store.update_conversation("deploy", (1, 1), 3)
+        await store.flush()
+        await store.drop_user_data(2)
+        await store.update_conversation("deploy", (1, 1), None)
+        await store.update_conversation("deploy", (2, 2), 4)
+        await store.flush()
+
+        store = SQLitePersistence(path=path)
+        assert store.load_user_data(1).name == "one"
+        assert store.load_user_data(2) is None
+        assert await store.get_conversations("deploy") == {(2, 2): 4}
+    asyncio.run(scenario())
+
+def test_users_being_written_are_still_read_from_memory(tmp_path):
+    store = SQLitePersistence(path=str(tmp_path / "conversations.sqlite3"))
+    writing, release = threading.Event(), threading.Event()
+    write = store._write
+
+    def slow_write(users, conversations):
+        writing.set()
+        release.wait(5)
+        write(users, conversations)
+    store._write = slow_write
+
+    async def scenario():
+        await store.update_user_data(1, session("one"))
+        await asyncio.to_thread(writing.wait, 5)
+        assert store._pending_users == {}
+        assert store.load_user_data(1).name == "one"
+        release.set()
+        await store._write_task
+        assert store._writing_users == {}
+        assert store.load_user_data(1).name == "one"
+    asyncio.run(scenario())
+
+def test_a_failed_write_is_rolled_back_and_kept_for_the_next_one(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+
+    async def scenario():
+        store = SQLitePersistence(path=path)
+        # another worker holds the write lock
+        blocker = sqlite3.connect(path, isolation_level=None)
+        blocker.execute("BEGIN IMMEDIATE")
+        store._writer.execute("PRAGMA busy_timeout=0")
+        await store.update_user_data(1, session("old"))
+        await store.update_conversation("deploy", (1, 1), 3)
+        # the background write logs the failure instead of leaving it in the task
+        await store._write_task
+        assert not store._writer.in_transaction
+        await store.update_user_data(1, session("new"))
+        assert store.load_user_data(1).name == "new"
+        blocker.execute("ROLLBACK")
+        blocker.close()
+        await store.flush()
+
+        store = SQLitePersistence(path=path)
+        assert store.load_user_data(1).name == "new"
+        assert await store.get_conversations("deploy") == {(1, 1): 3}
+    asyncio.run(scenario())
+
+def test_flush_raises_when_the_last_write_fails(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+
+    async def scenario():
+        store = SQLitePersistence(path=path)
+        blocker = sqlite3.connect(path, isolation_level=None)
+        blocker.execute("BEGIN IMMEDIATE")
+        store._writer.execute("PRAGMA busy_timeout=0")
+        store._pending_users[1] = session("one")
+        with pytest.raises(sqlite3.OperationalError):
+            await store.flush()
+        blocker.execute("ROLLBACK")
+        blocker.close()
+        assert store.load_user_data(1).name == "one"
+    asyncio.run(scenario())
+
+def test_user_data_is_loaded_the_first_time_a_user_shows_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(persistence, "session_store", SessionStore())
+    store = SQLitePersistence(path=str(tmp_path / "conversations.sqlite3"))
+
+    async def scenario():
+        await store.update_user_data(1, session("one"))
+        await store.flush()
+    asyncio.run(scenario())
+
+    application = Application.builder().token("123:test").application_class(LazyUserDataApplication).persistence(store).build()
+    assert application.user_data == {}
+    assert application.user_data[1].name == "one"
+    # a user we know nothing about gets a new session
+    assert application.user_data[2].name is None
+    assert list(persistence.session_store) == [1, 2]
@@ -0,0 +1,84 @@
+import asyncio
+import sqlite3
+from http import HTTPStatus
+from types import SimpleNamespace
+
+import pytest
+
+import reconciler
+from reconciler import InflightTracker
+
+class FakeTransactions:
+    async def get(self, transaction_id):
+        return SimpleNamespace(
+            id=transaction_id, status="Completed", chain_id=11155111, memo=None, contract_method_id="method",
+        )
+
+def test_result_is_only_resolved_once_delivered(monkeypatch):
+    monkeypatch.setattr(reconciler, "oneshot_client", SimpleNamespace(transactions=FakeTransactions()))
+    monkeypatch.setattr(reconciler, "BUSINESS_ID", "business")
+    statuses = [HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.OK]
+    delivered = []
+
+    async def deliver(payload):
+        delivered.append(payload.data.transaction_execution_id)
+        return statuses.pop(0)
+
+    async def scenario():
+        tracker = InflightTracker(stale_after=0, check_interval=0, path=None)
+        tracker._deliver = deliver
+        tracker.track("tx", "{}")
+        await tracker.reconcile()
+        assert len(tracker) == 1
+        await tracker.reconcile()
+        assert len(tracker) == 0
+        assert delivered == ["tx", "tx"]
+        assert tracker.reconciled == 1
+    asyncio.run(scenario())
+
+def test_workers_only_load_their_own_transactions(tmp_path):
+    path = str(tmp_path / "inflight.sqlite3")
+
+    async def deliver(payload):
+        return HTTPStatus.OK
+
+    async def scenario():
+        first = InflightTracker(path=path)
+        await first.start(deliver, worker_index=0)
+        first.track("first", None)
+        await first.stop()
+
+        second = InflightTracker(path=path)
+        await second.start(deliver, worker_index=1)
+        assert len(second) == 0
+        await second.stop()
+
+        restarted = InflightTracker(path=path)
+        await restarted.start(deliver, worker_index=0)
+        assert len(restarted) == 1
+        await restarted.stop()
+    asyncio.run(scenario())
+
+def test_a_failed_write_is_rolled_back_and_tried_again(tmp_path):
+    path = str(tmp_path / "inflight.sqlite3")
+
+    async def deliver(payload):
+        return HTTPStatus.OK
+
+    async def scenario():
+        tracker = InflightTracker(path=path)
+        await tracker.start(deliver)
+        tracker.track("tx", None)
+        # another worker holds the write lock
+        blocker = sqlite3.connect(path, isolation_level=None)
+        blocker.execute("BEGIN IMMEDIATE")
+        tracker._connection.execute("PRAGMA busy_timeout=0")
+        with pytest.raises(sqlite3.OperationalError):
+            await tracker.flush()
+        blocker.execute("ROLLBACK")
+        blocker.close()
+        assert not tracker._connection.in_transaction
+        await tracker.flush()
+        assert tracker._connection.execute("SELECT transaction_id FROM inflight").fetchall() == [("tx",)]
+        await tracker.stop()
+    asyncio.run(scenario())
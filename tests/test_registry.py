@@ -0,0 +1,68 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+from uxly_1shot_client.models.contract_method import ContractMethod
+from uxly_1shot_client.models.wallet import Wallet
+
+from registry import ResourceRegistry
+from startup import ensure_webhook
+
+WALLET = Wallet(id="wallet", accountAddress="0x" + "11" * 20, chainId=11155111, name="Escrow", isAdmin=False, updated=0, created=0)
+CONTRACT_METHOD = ContractMethod(
+    id="method", businessId="business", chainId=11155111, contractAddress="0x" + "22" * 20, walletId="wallet",
+    name="Deployer", description="Deploys tokens", functionName="deployToken", stateMutability="nonpayable",
+    inputs=[], outputs=[], publicKey="key", updated=0, created=0, deleted=False,
+)
+
+def test_a_snapshot_restores_the_wallets_and_contract_methods(tmp_path):
+    path = str(tmp_path / "resources.json")
+    registry = ResourceRegistry(snapshot_path=path)
+    registry._wallets["11155111"] = [WALLET]
+    registry.set_contract_method(CONTRACT_METHOD)
+    asyncio.run(registry.save_snapshot())
+    # the temporary file was renamed over the snapshot
+    assert os.listdir(tmp_path) == ["resources.json"]
+
+    restored = ResourceRegistry(snapshot_path=path)
+    assert restored.load_snapshot()
+    assert restored.escrow_wallet(11155111) == WALLET
+    assert restored.contract_method(11155111, "Deployer") == CONTRACT_METHOD
+
+def test_a_missing_or_damaged_snapshot_is_ignored(tmp_path):
+    path = tmp_path / "resources.json"
+    assert not ResourceRegistry(snapshot_path=str(path)).load_snapshot()
+    path.write_text(json.dumps({"wallets": {}}))
+    assert not ResourceRegistry(snapshot_path=str(path)).load_snapshot()
+
+def test_a_failed_snapshot_write_leaves_the_old_one_alone(tmp_path):
+    path = tmp_path / "resources.json"
+    path.write_text("old")
+    registry = ResourceRegistry(snapshot_path=str(path))
+    # something json can't write
+    with pytest.raises(TypeError):
+        registry._write_snapshot({"wallets": object()})
+    assert path.read_text() == "old"
+    assert os.listdir(tmp_path) == ["resources.json"]
+
+class FakeBot:
+    def __init__(self, url: str, allowed_updates):
+        self.info = SimpleNamespace(url=url, allowed_updates=allowed_updates)
+        self.set_webhook_calls = []
+
+    async def get_webhook_info(self):
+        return self.info
+
+    async def set_webhook(self, url, allowed_updates):
+        self.set_webhook_calls.append((url, allowed_updates))
+
+def test_the_webhook_is_only_set_when_it_changed():
+    bot = FakeBot("https://bot.example/telegram", ["message", "callback_query"])
+    assert not asyncio.run(ensure_webhook(bot, "https://bot.example/telegram", ["callback_query", "message"]))
+    assert bot.set_webhook_calls == []
+
+    assert asyncio.run(ensure_webhook(bot, "https://bot.example/telegram", ["message"]))
+    assert asyncio.run(ensure_webhook(bot, "https://new.example/telegram", ["message", "callback_query"]))
+    assert len(bot.set_webhook_calls) == 2
@@ -0,0 +1,55 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from sendscheduler import SendPriority, SendScheduler
+
+def send(scheduler: SendScheduler, sent: list, name: str, priority: SendPriority, chat_id=None):
+    async def callback():
+        sent.append(name)
+        return name
+    return scheduler.process_request(callback, (), {}, "sendMessage", {"chat_id": chat_id}, {"priority": priority})
+
+def test_replies_to_users_go_before_waiting_notifications():
+    async def scenario():
+        scheduler = SendScheduler(global_rate=50)
+        scheduler._global.tokens = 0
+        sent = []
+        sends = [asyncio.create_task(send(scheduler, sent, f"notification-{i}", SendPriority.NOTIFICATION)) for i in range(3)]
+        await asyncio.sleep(0)
+        sends.append(asyncio.create_task(send(scheduler, sent, "reply", SendPriority.INTERACTIVE)))
+        await asyncio.gather(*sends)
+        assert sent == ["reply", "notification-0", "notification-1", "notification-2"]
+    asyncio.run(scenario())
+
+def test_a_flood_limit_holds_back_the_chat_and_retries():
+    async def scenario():
+        scheduler = SendScheduler()
+        attempts = []
+
+        async def callback():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise RetryAfter(timedelta(seconds=0.2))
+            return "sent"
+
+        assert await scheduler.process_request(callback, (), {}, "sendMessage", {"chat_id": 1}, None) == "sent"
+        assert scheduler.retries == 1
+        assert attempts[1] - attempts[0] >= 0.19
+    asyncio.run(scenario())
+
+def test_notifications_wait_for_room_in_a_full_backlog():
+    async def scenario():
+        scheduler = SendScheduler(global_rate=50, backlog_limit=1)
+        scheduler._global.tokens = 0
+        sent = []
+        sends = [asyncio.create_task(send(scheduler, sent, f"notification-{i}", SendPriority.NOTIFICATION, chat_id=i)) for i in range(3)]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1
+        # the waiting ones haven't taken a token from their chat yet
+        assert set(scheduler._chats) == {0}
+        assert await asyncio.gather(*sends) == ["notification-0", "notification-1", "notification-2"]
+        assert scheduler.backlogged == 2
+    asyncio.run(scenario())
@@ -0,0 +1,87 @@
+import asyncio
+import pickle
+import time
+
+import sessions
+from sessions import SessionStore, STATE_TIMEOUTS, SESSION_IDLE_TIMEOUT
+from objects import ConversationState
+
+class ConversationHandler:
+    # only the conversation keys matter to the store
+    def __init__(self):
+        self._conversations = {}
+
+class Application:
+    def __init__(self):
+        self.dropped = []
+
+    def drop_user_data(self, user_id):
+        self.dropped.append(user_id)
+
+def make_store(stored=None):
+    store, application = SessionStore(), Application()
+    store.attach(application, (stored or {}).get)
+    handler = ConversationHandler()
+    store._handlers = [handler]
+    return store, application, handler
+
+def test_sessions_expire_after_the_timeout_of_their_state():
+    store, application, handler = make_store()
+    store.touch(1, 1)
+    handler._conversations[(1, 1)] = ConversationState.TOKEN_PREMINT
+    store.track(1)
+    assert abs(store[1].expires_at - time.time() - STATE_TIMEOUTS[ConversationState.TOKEN_PREMINT]) < 1
+    # and after the idle timeout once the flow is over
+    del handler._conversations[(1, 1)]
+    store.track(1)
+    assert abs(store[1].expires_at - time.time() - SESSION_IDLE_TIMEOUT) < 1
+
+def test_sweep_forgets_idle_sessions_with_their_conversations():
+    store, application, handler = make_store()
+    for user_id in (1, 2):
+        store.touch(user_id, user_id)
+        handler._conversations[(user_id, user_id)] = ConversationState.TOKEN_NAMING
+        store.track(user_id)
+    store[1].last_seen -= 4000
+    store[1].expires_at -= 4000
+    store[1].airdrop_path = "/tmp/list.txt"
+    assert store.sweep() == 1
+    assert 1 not in store and 2 in store
+    assert (1, 1) not in handler._conversations and (2, 2) in handler._conversations
+    assert application.dropped == [1]
+    assert store._leftover_files == ["/tmp/list.txt"]
+    assert store.bytes == store[2].size
+
+def test_least_recently_seen_sessions_are_evicted_first(monkeypatch):
+    monkeypatch.setattr(sessions, "SESSION_MEMORY_BYTES", 20000)
+    store, application, handler = make_store()
+    for user_id in range(100, 200):
+        store.touch(user_id, user_id)
+        store[user_id].description = "x" * 200
+        store.track(user_id)
+        # touched again, so it outlives the users that came after it
+        if user_id > 100:
+            store.touch(100, 100)
+            store.track(100)
+    assert store.evicted > 0
+    assert store.bytes <= 20000
+    assert 100 in store and 199 in store and 101 not in store
+    assert application.dropped[0] == 101
+
+def test_stored_sessions_are_loaded_on_first_use():
+    store, application, handler = make_store({7: {"name": "My Token", ConversationState.START_OVER: True}})
+    store.touch(7, 7)
+    assert store[7].name == "My Token" and store[7].start_over
+    assert pickle.loads(pickle.dumps(store[7])).name == "My Token"
+
+def test_conversations_from_before_a_restart_get_their_sessions():
+    async def scenario():
+        store, application, handler = make_store()
+        store.touch(1, 1)
+        handler._conversations[(5, 2)] = ConversationState.SENDER_LIST
+        await store._adopt()
+        assert store[2].chats == (5,)
+        assert abs(store[2].expires_at - time.time() - STATE_TIMEOUTS[ConversationState.SENDER_LIST]) < 1
+        last_seen = [session.last_seen for session in store.values()]
+        assert last_seen == sorted(last_seen)
+    asyncio.run(scenario())
@@ -0,0 +1,64 @@
+import asyncio
+import shutil
+import tempfile
+
+import pytest
+
+from sharding import HashRing, ShardRouter, UpdateKind, telegram_routing_key
+
+def test_updates_are_routed_by_user_whatever_the_chat():
+    group = {"update_id": 1, "message": {"from": {"id": 7}, "chat": {"id": -100}}}
+    private = {"update_id": 2, "message": {"from": {"id": 7}, "chat": {"id": 7}}}
+    button = {"update_id": 3, "callback_query": {"from": {"id": 7}, "message": {"chat": {"id": -100}}}}
+    assert telegram_routing_key(group) == telegram_routing_key(private) == telegram_routing_key(button) == 7
+    assert telegram_routing_key({"update_id": 4, "poll_answer": {"user": {"id": 8}}}) == 8
+    # channel posts have no user
+    assert telegram_routing_key({"update_id": 5, "channel_post": {"chat": {"id": -200}}}) == -200
+    assert telegram_routing_key({"update_id": 6, "poll": {"id": "poll"}}) is None
+
+def test_every_worker_agrees_on_the_owner_and_users_are_spread_out():
+    ring = HashRing(4)
+    owners = [ring.owner(key) for key in range(1000)]
+    assert owners == [HashRing(4).owner(key) for key in range(1000)]
+    assert all(150 < owners.count(worker) < 350 for worker in range(4))
+    # a worker more only moves the users it takes over
+    moved = sum(HashRing(5).owner(key) != owner for key, owner in enumerate(owners))
+    assert moved < 350
+
+@pytest.fixture
+def socket_dir():
+    # socket paths are limited to about 100 characters, pytest's tmp_path is too long
+    path = tempfile.mkdtemp(prefix="shards-", dir="/tmp")
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+def test_updates_are_forwarded_to_their_owner_over_a_pool_of_connections(socket_dir):
+    async def scenario():
+        delivered = []
+
+        async def deliver(kind, body):
+            delivered.append((kind, body))
+            await asyncio.sleep(0.01)
+            return 200
+
+        first = ShardRouter(worker_count=2, socket_dir=socket_dir, max_idle_connections=1)
+        second = ShardRouter(worker_count=2, socket_dir=socket_dir, max_idle_connections=1)
+        await first.start(deliver)
+        await second.start(deliver)
+        assert (first.worker_index, second.worker_index) == (0, 1)
+        key = next(key for key in range(100) if not first.is_local(key))
+        assert second.is_local(key)
+
+        statuses = await asyncio.gather(*(first.forward(key, UpdateKind.TELEGRAM, b"%d" % n) for n in range(3)))
+        assert statuses == [200, 200, 200]
+        assert sorted(body for _, body in delivered) == [b"0", b"1", b"2"]
+        # a burst opens a connection per forward, only one is kept afterwards
+        assert len(first._connections[1]) == 1
+        assert await first.forward(key, UpdateKind.ONESHOT, b"again") == 200
+        assert delivered[-1] == (UpdateKind.ONESHOT, b"again")
+
+        # the owner is gone, so Telegram and 1Shot API are asked to send it again later
+        await second.stop()
+        assert await first.forward(key, UpdateKind.TELEGRAM, b"lost") == 503
+        await first.stop()
+    asyncio.run(scenario())
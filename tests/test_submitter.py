@@ -0,0 +1,154 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import submitter
+from objects import TransactionMemo, TxType
+from submitter import TransactionSubmitter, Submission, PENDING
+
+def make_submitter(tmp_path) -> TransactionSubmitter:
+    transaction_submitter = TransactionSubmitter(workers=1, path=str(tmp_path / "submissions.sqlite3"))
+    transaction_submitter._open()
+    return transaction_submitter
+
+def pending_submission(key: str, **fields) -> Submission:
+    values = dict(
+        key=key, chat_id=None, chain_id="1", contract_method_name="method", params={}, memo="{}",
+        status=PENDING, attempts=0, next_attempt_at=0.0, created=0.0,
+    )
+    values.update(fields)
+    return Submission(**values)
+
+def test_unexpected_error_lets_the_poll_retry(tmp_path):
+    async def scenario():
+        transaction_submitter = make_submitter(tmp_path)
+        submission = pending_submission("a")
+        await transaction_submitter._save(submission)
+        transaction_submitter._enqueue(submission)
+
+        async def broken(submission):
+            raise RuntimeError("database is locked")
+        transaction_submitter._process = broken
+        worker = asyncio.create_task(transaction_submitter._worker())
+        await asyncio.sleep(0.01)
+        worker.cancel()
+        assert "a" not in transaction_submitter._active
+
+        await transaction_submitter._load_pending()
+        assert "a" in transaction_submitter._active
+        for handle in transaction_submitter._retry_handles:
+            handle.cancel()
+    asyncio.run(scenario())
+
+def test_workers_only_load_their_own_submissions(tmp_path):
+    async def scenario():
+        first, second = make_submitter(tmp_path), make_submitter(tmp_path)
+        second._owner = 1
+        await first._save(pending_submission("first", owner=0))
+        await second._save(pending_submission("second", owner=1))
+        # from before submissions had an owner
+        await first._save(pending_submission("legacy", owner=None))
+
+        await second._load_pending()
+        await first._load_pending()
+        assert set(first._active) == {"first"}
+        assert set(second._active) == {"second", "legacy"}
+        for transaction_submitter in (first, second):
+            for handle in transaction_submitter._retry_handles:
+                handle.cancel()
+    asyncio.run(scenario())
+
+class FakeTransactions:
+    # newest first, pages of page_size like 1Shot API
+    def __init__(self, transactions):
+        self.transactions = transactions
+        self.pages = []
+
+    async def list(self, business_id, params):
+        from types import SimpleNamespace
+        self.pages.append(params["page"])
+        start = (params["page"] - 1) * params["page_size"]
+        return SimpleNamespace(response=self.transactions[start:start + params["page_size"]], total_results=len(self.transactions))
+
+def transaction(id: str, memo: str, created: float):
+    from types import SimpleNamespace
+    return SimpleNamespace(id=id, memo=memo, created=created)
+
+def test_find_existing_pages_back_to_the_submission(tmp_path, monkeypatch):
+    # 120 newer transactions were made after our earlier attempt
+    transactions = [transaction(f"t{i}", "{}", 2000 - i) for i in range(120)]
+    transactions.append(transaction("ours", '{"k":"mine"}', 1000))
+    fake = FakeTransactions(transactions)
+    monkeypatch.setattr(submitter, "oneshot_client", type("Client", (), {"transactions": fake}))
+    transaction_submitter = make_submitter(tmp_path)
+
+    found = asyncio.run(transaction_submitter._find_existing("method", pending_submission("mine", created=999)))
+    assert found == "ours"
+    assert fake.pages == [1, 2, 3]
+
+def test_find_existing_stops_at_older_transactions(tmp_path, monkeypatch):
+    transactions = [transaction(f"t{i}", "{}", 100000 - i * 100) for i in range(500)]
+    fake = FakeTransactions(transactions)
+    monkeypatch.setattr(submitter, "oneshot_client", type("Client", (), {"transactions": fake}))
+    transaction_submitter = make_submitter(tmp_path)
+
+    # made at 95000, everything past page 2 is older than that (and the clock skew we allow for)
+    found = asyncio.run(transaction_submitter._find_existing("method", pending_submission("mine", created=95000)))
+    assert found is None
+    assert len(fake.pages) < 10
+
+def test_outcome_of_a_settled_submission_comes_from_the_database(tmp_path):
+    async def scenario():
+        transaction_submitter = make_submitter(tmp_path)
+        await transaction_submitter._save(pending_submission("done", status=submitter.SUBMITTED))
+        await transaction_submitter._save(pending_submission("gave-up", status=submitter.FAILED))
+        assert await transaction_submitter.outcome("done") == submitter.SUBMITTED
+        assert await transaction_submitter.outcome("gave-up") == submitter.FAILED
+        assert await transaction_submitter.outcome("unknown") is None
+
+        # one that's active settles through _settle
+        submission = pending_submission("queued")
+        transaction_submitter._enqueue(submission)
+        future = transaction_submitter.outcome("queued")
+        transaction_submitter._settle("queued", submitter.SUBMITTED)
+        assert await future == submitter.SUBMITTED
+    asyncio.run(scenario())
+
+def test_transfers_without_a_chat_are_tracked_without_their_memo(tmp_path, monkeypatch):
+    async def scenario():
+        tracked = {}
+        monkeypatch.setattr(submitter, "inflight_tracker", type("Tracker", (), {"track": lambda self, id, memo: tracked.update({id: memo})})())
+        transaction_submitter = make_submitter(tmp_path)
+        for key, chat_id in (("transfer", None), ("user", 42)):
+            async def attempt(submission, key=key):
+                return f"tx-{key}"
+            transaction_submitter._attempt = attempt
+            await transaction_submitter._process(pending_submission(key, chat_id=chat_id, memo='{"k":"%s"}' % key))
+        assert tracked == {"tx-transfer": None, "tx-user": '{"k":"user"}'}
+    asyncio.run(scenario())
+
+def test_executions_with_known_keys_are_not_queued_again(tmp_path):
+    async def scenario():
+        transaction_submitter = make_submitter(tmp_path)
+        await transaction_submitter._save(pending_submission("done", status=submitter.SUBMITTED))
+
+        def executions():
+            return [({"to": "0x0"}, TransactionMemo(tx_type=TxType.TOKENS_TRANSFERRED, associated_user_id=1)) for _ in range(2)]
+        keys = await transaction_submitter.submit_many(None, "1", "method", executions(), keys=["done", "new"])
+        assert keys == ["done", "new"]
+        assert set(transaction_submitter._active) == {"new"}
+        assert transaction_submitter._queue.qsize() == 1
+        assert await transaction_submitter._execute("SELECT status FROM submissions WHERE key = 'done'") == [(submitter.SUBMITTED,)]
+    asyncio.run(scenario())
+
+def test_a_failed_batch_write_is_rolled_back(tmp_path):
+    async def scenario():
+        transaction_submitter = make_submitter(tmp_path)
+        rows = [pending_submission("a").to_row(), ("too", "short")]
+        with pytest.raises(sqlite3.ProgrammingError):
+            transaction_submitter._save_many(rows)
+        assert not transaction_submitter._connection.in_transaction
+        await transaction_submitter._save(pending_submission("b"))
+        assert await transaction_submitter._execute("SELECT key FROM submissions") == [("b",)]
+    asyncio.run(scenario())
@@ -0,0 +1,128 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from uxly_1shot_client import WebhookPayload
+
+import deploytoken
+import mytokens
+from objects import ConversationState, TokenInfo, TransactionMemo, TxType
+from tokenregistry import TokenRegistry
+
+ADDRESS = "0x" + "AB" * 20
+TOKEN = TokenInfo(name="Token", ticker="TKN", description="A token", image_file_id="file")
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    registry = TokenRegistry(path=str(tmp_path / "tokens.sqlite3"))
+    monkeypatch.setattr(deploytoken, "token_registry", registry)
+    monkeypatch.setattr(mytokens, "token_registry", registry)
+    return registry
+
+def add(registry: TokenRegistry, owner_id: int, transaction_id: str, address=None) -> bool:
+    return asyncio.run(registry.add(owner_id=owner_id, chain_id="11155111", address=address, token_info=TOKEN, transaction_id=transaction_id))
+
+def test_pages_continue_below_the_last_token_shown(registry):
+    for n in range(7):
+        add(registry, 1, f"tx{n}")
+    add(registry, 2, "someone else's")
+
+    first, cursor = registry.page(1, limit=3)
+    assert [token.transaction_id for token in first] == ["tx6", "tx5", "tx4"]
+    second, cursor = registry.page(1, before=cursor, limit=3)
+    assert [token.transaction_id for token in second] == ["tx3", "tx2", "tx1"]
+    # a token added meanwhile doesn't shift the pages after the first
+    add(registry, 1, "tx7")
+    last, cursor = registry.page(1, before=cursor, limit=3)
+    assert [token.transaction_id for token in last] == ["tx0"]
+    assert cursor is None
+
+def test_a_token_is_recorded_once_and_its_address_filled_in_later(registry):
+    assert add(registry, 1, "tx")
+    assert not add(registry, 1, "tx", ADDRESS)
+    assert not add(registry, 1, "tx")
+    token = registry.by_address(ADDRESS)
+    assert token.transaction_id == "tx"
+    assert token.address == ADDRESS.lower()
+    assert len(registry.page(1)[0]) == 1
+
+class FakeBot:
+    def __init__(self):
+        self.photos = []
+        self.messages = []
+
+    async def send_photo(self, chat_id, photo, caption, **kwargs):
+        self.photos.append(caption)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append(text)
+
+def deployment_callback(signature: str) -> WebhookPayload:
+    return WebhookPayload(
+        eventName="TransactionExecutionSuccess",
+        data={"businessId": "business", "chain": 11155111, "logs": None, "transactionExecutionId": "tx", "transactionExecutionMemo": None, "transactionId": "method"},
+        timestamp=0,
+        apiVersion=0,
+        signature=signature,
+    )
+
+def test_the_real_callback_after_a_reconciled_one_only_adds_the_address(registry):
+    memo = TransactionMemo(tx_type=TxType.TOKEN_CREATION, associated_user_id=1, payload=TOKEN)
+    context = SimpleNamespace(bot=FakeBot())
+
+    async def scenario():
+        # the reconciler's result has no logs
+        await deploytoken.token_deployment_succeeded(deployment_callback(""), memo, {"TokenCreated": []}, context)
+        logs = {"TokenCreated": [SimpleNamespace(args=[ADDRESS])]}
+        await deploytoken.token_deployment_succeeded(deployment_callback("signed"), memo, logs, context)
+
+    asyncio.run(scenario())
+    assert len(context.bot.photos) == 1
+    assert "Address" not in context.bot.photos[0]
+    assert len(context.bot.messages) == 1
+    assert ADDRESS in context.bot.messages[0]
+    assert registry.page(1)[0][0].address == ADDRESS.lower()
+
+class FakeQuery:
+    def __init__(self, data: str):
+        self.data = data
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text=None):
+        self.answers.append(text)
+
+    async def edit_message_text(self, text, reply_markup, **kwargs):
+        self.edits.append((text, reply_markup))
+
+def show(token_id: int, user_id: int):
+    query = FakeQuery(f"token:{token_id}")
+    update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=user_id))
+    state = asyncio.run(mytokens.show_token(update, SimpleNamespace(user_data=None)))
+    return state, query
+
+def test_only_the_owner_sees_a_token(registry):
+    add(registry, 1, "tx")
+    token_id = registry.page(1)[0][0].id
+
+    state, query = show(token_id, user_id=2)
+    assert state == ConversationState.GET_TOKENS
+    assert query.answers == ["Token not found."]
+    assert query.edits == []
+
+    state, query = show(token_id + 1, user_id=1)
+    assert query.answers == ["Token not found."]
+
+    state, query = show(token_id, user_id=1)
+    assert state == ConversationState.MANAGE_TOKEN
+    text, keyboard = query.edits[0]
+    assert "not known yet" in text
+    # without an address there is nothing to airdrop
+    assert not any(button.callback_data.startswith("airdrop:") for row in keyboard.inline_keyboard for button in row)
+
+def test_a_token_with_an_address_can_be_airdropped(registry):
+    add(registry, 1, "tx", ADDRESS)
+    state, query = show(registry.page(1)[0][0].id, user_id=1)
+    text, keyboard = query.edits[0]
+    assert ADDRESS.lower() in text
+    assert keyboard.inline_keyboard[0][0].callback_data.startswith("airdrop:")
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from telegram import Update
+from uxly_1shot_client import WebhookPayload
+
+from updateprocessor import PerChatUpdateProcessor
+
+def chat_update(update_id: int, chat_id: int) -> Update:
+    return Update.de_json(
+        {"update_id": update_id, "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "hi"}},
+        None,
+    )
+
+def callback() -> WebhookPayload:
+    return WebhookPayload(
+        eventName="TransactionExecutionSuccess",
+        data={"businessId": "business", "chain": 11155111, "logs": None, "transactionExecutionId": "tx", "transactionExecutionMemo": None, "transactionId": "method"},
+        timestamp=0,
+        apiVersion=0,
+        signature="signed",
+    )
+
+def test_updates_of_a_chat_are_handled_in_order_while_other_chats_go_ahead():
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=8)
+        handled = []
+
+        async def handle(update_id: int, delay: float) -> None:
+            await asyncio.sleep(delay)
+            handled.append(update_id)
+
+        # the earlier updates of chat 1 take longest, they still finish first
+        await asyncio.gather(
+            *(processor.do_process_update(chat_update(n, 1), handle(n, 0.05 - n * 0.01)) for n in range(1, 5)),
+            processor.do_process_update(chat_update(5, 2), handle(5, 0)),
+        )
+        assert handled == [5, 1, 2, 3, 4]
+    asyncio.run(scenario())
+
+def test_a_chat_lock_is_dropped_once_its_last_update_is_done():
+    async def scenario():
+        processor = PerChatUpdateProcessor()
+        release = asyncio.Event()
+
+        async def wait() -> None:
+            await release.wait()
+
+        async def fail() -> None:
+            raise RuntimeError("handler failed")
+
+        first = asyncio.create_task(processor.do_process_update(chat_update(1, 1), wait()))
+        second = asyncio.create_task(processor.do_process_update(chat_update(2, 1), fail()))
+        await asyncio.sleep(0)
+        assert processor._chat_locks[1][1] == 2
+        release.set()
+        await first
+        with pytest.raises(RuntimeError):
+            await second
+        assert processor._chat_locks == {}
+    asyncio.run(scenario())
+
+def test_callbacks_do_not_wait_behind_chat_updates():
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=1, max_concurrent_webhooks=1)
+        release = asyncio.Event()
+        handled = []
+
+        async def wait() -> None:
+            await release.wait()
+            handled.append("chat")
+
+        async def handle(name: str) -> None:
+            handled.append(name)
+
+        # the only chat slot is taken, so another chat has to wait for it but a callback doesn't
+        busy = asyncio.create_task(processor.do_process_update(chat_update(1, 1), wait()))
+        waiting = asyncio.create_task(processor.do_process_update(chat_update(2, 2), handle("other chat")))
+        await asyncio.wait_for(processor.do_process_update(callback(), handle("callback")), 1)
+        assert handled == ["callback"]
+        release.set()
+        await asyncio.gather(busy, waiting)
+        assert handled == ["callback", "chat", "other chat"]
+    asyncio.run(scenario())